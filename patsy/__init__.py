@@ -113,5 +113,11 @@ _reexport(patsy.splines)
 import patsy.mgcv_cubic_splines
 _reexport(patsy.mgcv_cubic_splines)
 
+import patsy.sink
+_reexport(patsy.sink)
+
+import patsy.cache
+_reexport(patsy.cache)
+
 # XX FIXME: we aren't exporting any of the explicit parsing interface
 # yet. Need to figure out how to do that.
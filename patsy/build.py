@@ -5,8 +5,12 @@
 # This file defines the core design matrix building functions.
 
 # These are made available in the patsy.* namespace
-__all__ = ["design_matrix_builders", "build_design_matrices"]
+__all__ = ["design_matrix_builders", "build_design_matrices",
+           "build_design_matrices_iter"]
 
+import sys
+import mmap
+import threading
 import itertools
 import six
 
@@ -14,17 +18,21 @@ import numpy as np
 from patsy import PatsyError
 from patsy.categorical import (guess_categorical,
                                CategoricalSniffer,
-                               categorical_to_int)
+                               categorical_to_int,
+                               _HashedLevels)
 from patsy.util import (atleast_2d_column_default,
                         have_pandas, asarray_or_pandas,
-                        safe_issubdtype)
+                        safe_issubdtype, LRUCache)
 from patsy.design_info import (DesignMatrix, DesignInfo,
                                FactorInfo, SubtermInfo)
 from patsy.redundancy import pick_contrasts_for_term
-from patsy.eval import EvalEnvironment
-from patsy.contrasts import code_contrast_matrix, Treatment
+from patsy.eval import EvalEnvironment, _SubexpressionCache
+from patsy.contrasts import (code_contrast_matrix, Treatment,
+                             _IndicatorContrastMatrix)
 from patsy.compat import OrderedDict
 from patsy.missing import NAAction
+from patsy.sink import NpySink
+from patsy.cache import _fingerprint
 
 if have_pandas:
     import pandas
@@ -58,9 +66,25 @@ def test__max_allowed_dim():
     _max_allowed_dim(2, np.array([[1]]), f)
     assert_raises(PatsyError, _max_allowed_dim, 2, np.array([[[1]]]), f)
 
-def _eval_factor(factor_info, data, NA_action):
+# If 'subexpressions' (a _SubexpressionCache for 'data') is given, then it's
+# used to share common subexpressions with other factors.
+def _eval_factor(factor_info, data, NA_action, eval_cache=None,
+                 subexpressions=None):
+    factor = factor_info.factor
+    def eval_raw():
+        if subexpressions is None:
+            return factor.eval(factor_info.state, data)
+        return subexpressions.eval(factor, factor_info.state)
+    if eval_cache is None:
+        return _code_factor(factor_info, eval_raw(), NA_action)
+    def compute():
+        result = eval_cache._eval_raw(factor, factor_info.state, data,
+                                      eval_raw)
+        return _code_factor(factor_info, result, NA_action)
+    return eval_cache._eval_coded(factor_info, NA_action, data, compute)
+
+def _code_factor(factor_info, result, NA_action):
     factor = factor_info.factor
-    result = factor.eval(factor_info.state, data)
     # Returns either a 2d ndarray, or a DataFrame, plus is_NA mask
     if factor_info.type == "numerical":
         result = atleast_2d_column_default(result, preserve_pandas=True)
@@ -82,7 +106,8 @@ def _eval_factor(factor_info, data, NA_action):
     else:
         assert factor_info.type == "categorical"
         result = categorical_to_int(result, factor_info.categories, NA_action,
-                                    origin=factor_info.factor)
+                                    origin=factor_info.factor,
+                                    level_to_int=factor_info._category_to_int)
         assert result.ndim == 1
         return result, np.asarray(result == -1)
 
@@ -224,56 +249,184 @@ def _subterm_column_combinations(factor_infos, subterm):
     columns_per_factor = []
     for factor in subterm.factors:
         if factor in subterm.contrast_matrices:
-            columns = subterm.contrast_matrices[factor].matrix.shape[1]
+            columns = subterm.contrast_matrices[factor]._shape()[1]
         else:
             columns = factor_infos[factor].num_columns
         columns_per_factor.append(columns)
     return _column_combinations(columns_per_factor)
 
 def _subterm_column_names_iter(factor_infos, subterm):
-    total = 0
-    for i, column_idxs in enumerate(
-            _subterm_column_combinations(factor_infos, subterm)):
-        name_pieces = []
-        for factor, column_idx in zip(subterm.factors, column_idxs):
-            fi = factor_infos[factor]
-            if fi.type == "numerical":
-                if fi.num_columns > 1:
-                    name_pieces.append("%s[%s]"
-                                       % (factor.name(), column_idx))
-                else:
-                    assert column_idx == 0
-                    name_pieces.append(factor.name())
+    # Work out the name pieces for each factor's columns once, rather than
+    # once for every column of the subterm (which matters when there are a
+    # great many, e.g. for hashed factors).
+    pieces_per_factor = []
+    for factor in subterm.factors:
+        fi = factor_infos[factor]
+        if fi.type == "numerical":
+            if fi.num_columns > 1:
+                pieces = ["%s[%s]" % (factor.name(), column_idx)
+                          for column_idx in range(fi.num_columns)]
             else:
-                assert fi.type == "categorical"
-                contrast = subterm.contrast_matrices[factor]
-                suffix = contrast.column_suffixes[column_idx]
-                name_pieces.append("%s%s" % (factor.name(), suffix))
-        if not name_pieces:
-            yield "Intercept"
+                pieces = [factor.name()]
         else:
-            yield ":".join(name_pieces)
-        total += 1
+            assert fi.type == "categorical"
+            contrast = subterm.contrast_matrices[factor]
+            pieces = ["%s%s" % (factor.name(), suffix)
+                      for suffix in contrast.column_suffixes]
+        pieces_per_factor.append(pieces)
+    total = 0
+    if len(pieces_per_factor) == 1:
+        for name in pieces_per_factor[0]:
+            yield name
+            total += 1
+    else:
+        for column_idxs in _column_combinations(
+                [len(pieces) for pieces in pieces_per_factor]):
+            if not column_idxs:
+                yield "Intercept"
+            else:
+                yield ":".join([pieces[column_idx]
+                                for pieces, column_idx
+                                in zip(pieces_per_factor, column_idxs)])
+            total += 1
     assert total == subterm.num_columns
 
+# For interactions between categorical factors, e.g. a:b:c, each observation
+# falls into one cell of the combined factor, so rather than multiplying
+# together one block of columns per factor, we can work out a single
+# combined code for each row (using the same left-most-fastest order as
+# _column_combinations) and look up the whole row at once.
+#
+# Returns the combined codes along with the number of combined levels.
+def _combined_codes(codes_list, levels_list):
+    combined = np.zeros(len(codes_list[0]), dtype=np.intp)
+    stride = 1
+    for codes, levels in zip(codes_list, levels_list):
+        combined += codes * stride
+        stride *= levels
+    return combined, stride
+
+# If every factor in 'subterm' is categorical and coded with indicators,
+# returns, for each row, the column of the one non-zero entry in the
+# subterm's columns, or -1 if the row is all zeros. Otherwise returns None.
+def _combined_indicator_columns(subterm, factor_infos, factor_values):
+    if not subterm.factors:
+        return None
+    columns_list = []
+    num_columns_list = []
+    for factor in subterm.factors:
+        if factor_infos[factor].type != "categorical":
+            return None
+        contrast = subterm.contrast_matrices[factor]
+        if (not isinstance(contrast, _IndicatorContrastMatrix)
+            or not contrast._structured()):
+            return None
+        columns_list.append(contrast.columns[factor_values[factor]])
+        num_columns_list.append(contrast._shape()[1])
+    columns, _ = _combined_codes(columns_list, num_columns_list)
+    for factor_columns in columns_list:
+        columns[factor_columns < 0] = -1
+    return columns
+
+def test__combined_indicator_columns():
+    from patsy.contrasts import Treatment, ContrastMatrix
+    f1 = _MockFactor("f1")
+    f2 = _MockFactor("f2")
+    factor_infos = {f1: FactorInfo(f1, "categorical", {},
+                                   num_columns=None,
+                                   categories=["a", "b", "c"]),
+                    f2: FactorInfo(f2, "categorical", {},
+                                   num_columns=None, categories=["x", "y"]),
+                    }
+    full = Treatment().code_with_intercept(["a", "b", "c"])
+    reduced = Treatment().code_without_intercept(["x", "y"])
+    subterm = SubtermInfo([f1, f2], {f1: full, f2: reduced}, 3)
+    factor_values = {f1: np.asarray([0, 1, 2, 2]),
+                     f2: np.asarray([1, 1, 0, 1])}
+    columns = _combined_indicator_columns(subterm, factor_infos,
+                                          factor_values)
+    assert np.array_equal(columns, [0, 1, -1, 2])
+    dense = ContrastMatrix(full.matrix, full.column_suffixes)
+    subterm = SubtermInfo([f1, f2], {f1: dense, f2: reduced}, 3)
+    assert _combined_indicator_columns(subterm, factor_infos,
+                                       factor_values) is None
+    assert _combined_indicator_columns(SubtermInfo([], {}, 1),
+                                       {}, {}) is None
+
+def _build_categorical_subterm(subterm, factor_infos, factor_values, out):
+    # Returns True if 'out' was filled in by one of the fast paths for
+    # interactions between categorical factors, or False if the general code
+    # needs to be used.
+    columns = _combined_indicator_columns(subterm, factor_infos,
+                                          factor_values)
+    if columns is not None:
+        rows = np.flatnonzero(columns >= 0)
+        out[...] = 0
+        out[rows, columns[rows]] = 1
+        return True
+    if len(subterm.factors) < 2:
+        return False
+    codes_list = []
+    levels_list = []
+    for factor in subterm.factors:
+        if factor_infos[factor].type != "categorical":
+            return False
+        codes_list.append(factor_values[factor])
+        levels_list.append(subterm.contrast_matrices[factor]._shape()[0])
+    # The table has one row for each combination of levels, so it can get
+    # big. Only use it if it's no bigger than the output.
+    num_cells = np.prod(levels_list, dtype=float)
+    if num_cells * out.shape[1] > out.size:
+        return False
+    table = np.ones((1, 1), dtype=out.dtype)
+    for factor, num_levels in zip(subterm.factors, levels_list):
+        contrast = subterm.contrast_matrices[factor]
+        table = np.kron(contrast._rows(np.arange(num_levels), out.dtype),
+                        table)
+    combined, _ = _combined_codes(codes_list, levels_list)
+    out[...] = table[combined, :]
+    return True
+
 def _build_subterm(subterm, factor_infos, factor_values, out):
     assert subterm.num_columns == out.shape[1]
-    out[...] = 1
-    for i, column_idxs in enumerate(
-            _subterm_column_combinations(factor_infos, subterm)):
-        for factor, column_idx in zip(subterm.factors, column_idxs):
-            if factor_infos[factor].type == "categorical":
-                contrast = subterm.contrast_matrices[factor]
-                if np.any(factor_values[factor] < 0):
-                    raise PatsyError("can't build a design matrix "
-                                     "containing missing values", factor)
-                out[:, i] *= contrast.matrix[factor_values[factor],
-                                             column_idx]
-            else:
-                assert factor_infos[factor].type == "numerical"
-                assert (factor_values[factor].shape[1]
-                        == factor_infos[factor].num_columns)
-                out[:, i] *= factor_values[factor][:, column_idx]
+    for factor in subterm.factors:
+        if (factor_infos[factor].type == "categorical"
+            and np.any(factor_values[factor] < 0)):
+            raise PatsyError("can't build a design matrix "
+                             "containing missing values", factor)
+    if _build_categorical_subterm(subterm, factor_infos, factor_values, out):
+        return
+    # Each factor contributes an (n, c) block of columns -- for categorical
+    # factors, this is the contrast matrix row for each observation; for
+    # numerical factors it's just the values -- and the subterm's columns are
+    # the row-wise Kronecker product of these blocks. For consistency with
+    # _column_combinations, the left-most factor iterates fastest.
+    # Everything is computed directly in out.dtype, so that e.g. float32
+    # output never passes through float64 temporaries.
+    num_rows = out.shape[0]
+    result = None
+    for factor in subterm.factors:
+        if factor_infos[factor].type == "categorical":
+            contrast = subterm.contrast_matrices[factor]
+            block = contrast._rows(factor_values[factor], out.dtype)
+        else:
+            assert factor_infos[factor].type == "numerical"
+            assert (factor_values[factor].shape[1]
+                    == factor_infos[factor].num_columns)
+            block = factor_values[factor].astype(out.dtype, copy=False)
+        if result is None:
+            result = block
+        else:
+            product = np.empty((num_rows, block.shape[1], result.shape[1]),
+                               dtype=out.dtype)
+            np.multiply(block[:, :, np.newaxis], result[:, np.newaxis, :],
+                        out=product)
+            result = product.reshape((num_rows,
+                                      product.shape[1] * product.shape[2]))
+    if result is None:
+        out[...] = 1
+    else:
+        out[...] = result
 
 def test__subterm_column_names_iter_and__build_subterm():
     from nose.tools import assert_raises
@@ -334,6 +487,48 @@ def test__subterm_column_names_iter_and__build_subterm():
                               [0, 0, 0.5 * 3 * 2, 0.5 * 4 * 2],
                               [3 * 5 * -12, 3 * 6 * -12, 0, 0]])
 
+    # Column ordering for two categorical factors matches
+    # _column_combinations, and zero-row inputs work
+    f4 = _MockFactor("f4")
+    factor_infos4 = dict(factor_infos1)
+    factor_infos4[f4] = FactorInfo(f4, "categorical", {},
+                                   num_columns=None, categories=["x", "y"])
+    contrast4 = ContrastMatrix(np.array([[1, 2, 3],
+                                         [4, 5, 6]]),
+                               ["[d1]", "[d2]", "[d3]"])
+    subterm4 = SubtermInfo([f2, f4], {f2: contrast, f4: contrast4}, 6)
+    for codes2, codes4 in [([0, 1, 1], [1, 0, 1]), ([], [])]:
+        codes2 = np.asarray(codes2, dtype=int)
+        codes4 = np.asarray(codes4, dtype=int)
+        mat4 = np.empty((len(codes2), 6))
+        _build_subterm(subterm4, factor_infos4, {f2: codes2, f4: codes4},
+                       mat4)
+        for i, (c2, c4) in enumerate(_column_combinations([2, 3])):
+            assert np.allclose(mat4[:, i],
+                               contrast.matrix[codes2, c2]
+                               * contrast4.matrix[codes4, c4])
+    # Same, with enough rows that the combined contrast table is used, and
+    # with indicator coding (which is scattered directly)
+    from patsy.contrasts import Treatment
+    codes2 = np.asarray([0, 1, 1, 0, 1, 0, 0, 1, 1, 0])
+    codes4 = np.asarray([1, 0, 1, 1, 0, 0, 1, 1, 0, 0])
+    treatment4 = Treatment().code_without_intercept(["x", "y"])
+    for c4 in [contrast4, treatment4]:
+        subterm = SubtermInfo([f2, f4], {f2: contrast, f4: c4},
+                              2 * c4._shape()[1])
+        mat = np.empty((10, subterm.num_columns), dtype=np.float32)
+        _build_subterm(subterm, factor_infos4, {f2: codes2, f4: codes4}, mat)
+        expected = (c4.matrix[codes4, :, np.newaxis]
+                    * contrast.matrix[codes2, np.newaxis, :])
+        assert np.allclose(mat, expected.reshape((10, -1)))
+    subterm = SubtermInfo([f2, f4], {f2: Treatment().code_with_intercept(
+        ["a", "b"]), f4: treatment4}, 2)
+    mat = np.empty((10, 2), order="F")
+    _build_subterm(subterm, factor_infos4, {f2: codes2, f4: codes4}, mat)
+    assert np.array_equal(mat, [[codes2[i] == 0 and codes4[i] == 1,
+                                 codes2[i] == 1 and codes4[i] == 1]
+                                for i in range(10)])
+
 
     subterm_int = SubtermInfo([], {}, 1)
     assert list(_subterm_column_names_iter({}, subterm_int)) == ["Intercept"]
@@ -344,7 +539,150 @@ def test__subterm_column_names_iter_and__build_subterm():
                    mat3)
     assert np.allclose(mat3, 1)
 
-def _factors_memorize(factors, data_iter_maker, eval_env):
+def _import_scipy_sparse():
+    try:
+        import scipy.sparse
+    except ImportError:
+        raise PatsyError("sparse output was requested, but scipy "
+                         "is not installed")
+    return scipy.sparse
+
+# Takes two sparse matrices with the same number of rows, and returns the
+# row-wise Kronecker product (the "face-splitting product"): row i of the
+# result is kron(right[i, :], left[i, :]). I.e., the columns of 'left'
+# iterate fastest, matching the ordering used by _column_combinations.
+def _row_wise_kron(left, right):
+    sparse = _import_scipy_sparse()
+    left = left.tocsr()
+    right = right.tocsr()
+    assert left.shape[0] == right.shape[0]
+    num_rows = left.shape[0]
+    left_counts = np.diff(left.indptr)
+    right_rows = np.repeat(np.arange(num_rows), np.diff(right.indptr))
+    # Each stored entry in 'right' gets paired up with each of the stored
+    # entries in the same row of 'left':
+    pairs = left_counts[right_rows]
+    right_idx = np.repeat(np.arange(right.nnz), pairs)
+    pair_starts = np.cumsum(pairs) - pairs
+    left_idx = (np.repeat(left.indptr[:-1][right_rows] - pair_starts, pairs)
+                + np.arange(right_idx.shape[0]))
+    data = left.data[left_idx] * right.data[right_idx]
+    columns = (left.indices[left_idx]
+               + left.shape[1] * right.indices[right_idx])
+    return sparse.csr_matrix((data, (right_rows[right_idx], columns)),
+                             shape=(num_rows, left.shape[1] * right.shape[1]))
+
+def test__row_wise_kron():
+    sparse = _import_scipy_sparse()
+    left = np.array([[1, 0, 2],
+                     [0, 0, 0],
+                     [3, 4, 0]])
+    right = np.array([[5, 6],
+                      [7, 8],
+                      [0, 9]])
+    got = _row_wise_kron(sparse.csr_matrix(left), sparse.csc_matrix(right))
+    assert got.shape == (3, 6)
+    expected = np.row_stack([np.kron(right[i, :], left[i, :])
+                             for i in range(3)])
+    assert np.array_equal(got.toarray(), expected)
+
+def _build_subterm_sparse(subterm, factor_infos, factor_values, num_rows,
+                          dtype):
+    # Returns the columns for 'subterm' as a sparse matrix, without ever
+    # creating a dense version of them. Each factor is turned into a sparse
+    # block (for categorical factors, by picking out one row of the contrast
+    # matrix for each observation), and then the blocks are multiplied
+    # together row-by-row.
+    sparse = _import_scipy_sparse()
+    for factor in subterm.factors:
+        if (factor_infos[factor].type == "categorical"
+            and np.any(factor_values[factor] < 0)):
+            raise PatsyError("can't build a design matrix "
+                             "containing missing values", factor)
+    columns = _combined_indicator_columns(subterm, factor_infos,
+                                          factor_values)
+    if columns is not None:
+        # Interaction of indicator-coded factors: one scatter does it all
+        rows = np.flatnonzero(columns >= 0)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=dtype), (rows, columns[rows])),
+            shape=(num_rows, subterm.num_columns))
+    result = sparse.csr_matrix(np.ones((num_rows, 1), dtype=dtype))
+    for factor in subterm.factors:
+        if factor_infos[factor].type == "categorical":
+            contrast = subterm.contrast_matrices[factor]
+            block = contrast._sparse_rows(factor_values[factor], dtype,
+                                          sparse)
+        else:
+            assert factor_infos[factor].type == "numerical"
+            assert (factor_values[factor].shape[1]
+                    == factor_infos[factor].num_columns)
+            block = sparse.csr_matrix(np.asarray(factor_values[factor],
+                                                 dtype=dtype))
+        result = _row_wise_kron(result, block)
+    assert result.shape[1] == subterm.num_columns
+    return result
+
+def test__build_subterm_sparse():
+    from patsy.contrasts import ContrastMatrix
+    f1 = _MockFactor("f1")
+    f2 = _MockFactor("f2")
+    f3 = _MockFactor("f3")
+    contrast = ContrastMatrix(np.array([[0, 0.5],
+                                        [3, 0]]),
+                              ["[c1]", "[c2]"])
+    factor_infos = {f1: FactorInfo(f1, "numerical", {},
+                                   num_columns=2, categories=None),
+                    f2: FactorInfo(f2, "categorical", {},
+                                   num_columns=None, categories=["a", "b"]),
+                    f3: FactorInfo(f3, "numerical", {},
+                                   num_columns=1, categories=None),
+                    }
+    subterm = SubtermInfo([f1, f2, f3], {f2: contrast}, 4)
+    factor_values = {
+        f1: atleast_2d_column_default([[1, 2], [3, 4], [5, 6]]),
+        f2: np.asarray([0, 0, 1]),
+        f3: atleast_2d_column_default([7.5, 2, -12]),
+        }
+    dense = np.empty((3, 4))
+    _build_subterm(subterm, factor_infos, factor_values, dense)
+    got = _build_subterm_sparse(subterm, factor_infos, factor_values, 3,
+                                np.dtype(float))
+    assert got.shape == (3, 4)
+    assert got.dtype == np.dtype(float)
+    assert np.allclose(got.toarray(), dense)
+    # Zeros from the contrast matrix are not stored
+    assert got.nnz == 6
+
+    from nose.tools import assert_raises
+    factor_values[f2] = np.asarray([0, -1, 1])
+    assert_raises(PatsyError, _build_subterm_sparse,
+                  subterm, factor_infos, factor_values, 3, np.dtype(float))
+
+    # Indicator-coded interactions are scattered directly
+    from patsy.contrasts import Treatment
+    f4 = _MockFactor("f4")
+    factor_infos[f4] = FactorInfo(f4, "categorical", {},
+                                  num_columns=None, categories=["x", "y"])
+    subterm = SubtermInfo([f2, f4],
+                          {f2: Treatment().code_with_intercept(["a", "b"]),
+                           f4: Treatment().code_without_intercept(["x", "y"])},
+                          2)
+    factor_values = {f2: np.asarray([0, 1, 1]), f4: np.asarray([1, 1, 0])}
+    dense = np.empty((3, 2))
+    _build_subterm(subterm, factor_infos, factor_values, dense)
+    got = _build_subterm_sparse(subterm, factor_infos, factor_values, 3,
+                                np.dtype(float))
+    assert np.array_equal(got.toarray(), dense)
+    assert np.array_equal(dense, [[1, 0], [0, 1], [0, 0]])
+    assert got.nnz == 2
+
+    got_int = _build_subterm_sparse(SubtermInfo([], {}, 1), {}, {}, 3,
+                                    np.dtype(np.float32))
+    assert got_int.dtype == np.dtype(np.float32)
+    assert np.array_equal(got_int.toarray(), [[1], [1], [1]])
+
+def _factors_memorize(factors, data_iter_maker, eval_env, examiner=None):
     # First, start off the memorization process by setting up each factor's
     # state and finding out how many passes it will need:
     factor_states = {}
@@ -360,16 +698,30 @@ def _factors_memorize(factors, data_iter_maker, eval_env):
     for factor, passes in six.iteritems(passes_needed):
         if passes > 0:
             memorize_needed.add(factor)
+        elif examiner is not None:
+            examiner.add(factor, factor_states[factor])
     which_pass = 0
     while memorize_needed:
+        # Factors that are already fully memorized can have their types
+        # examined during the same sweep through the data, instead of
+        # needing a sweep of their own afterwards.
+        if examiner is not None:
+            examiner.start_sweep()
         for data in data_iter_maker():
+            subexpressions = _SubexpressionCache(data)
             for factor in memorize_needed:
                 state = factor_states[factor]
-                factor.memorize_chunk(state, which_pass, data)
+                subexpressions.memorize_chunk(factor, state, which_pass)
+            if examiner is not None:
+                examiner.examine_chunk(data, subexpressions)
+        if examiner is not None:
+            examiner.finish_sweep()
         for factor in list(memorize_needed):
             factor.memorize_finish(factor_states[factor], which_pass)
             if which_pass == passes_needed[factor] - 1:
                 memorize_needed.remove(factor)
+                if examiner is not None:
+                    examiner.add(factor, factor_states[factor])
         which_pass += 1
     return factor_states
 
@@ -434,37 +786,92 @@ def test__factors_memorize():
         }
     assert factor_states == expected
 
-def _examine_factor_types(factors, factor_states, data_iter_maker, NA_action):
-    num_column_counts = {}
-    cat_sniffers = {}
-    examine_needed = set(factors)
-    for data in data_iter_maker():
-        for factor in list(examine_needed):
-            value = factor.eval(factor_states[factor], data)
-            if factor in cat_sniffers or guess_categorical(value):
-                if factor not in cat_sniffers:
-                    cat_sniffers[factor] = CategoricalSniffer(NA_action,
-                                                              factor.origin)
-                done = cat_sniffers[factor].sniff(value)
+# Works out which factors are numerical (and how many columns they have) and
+# which are categorical (and what their levels are), by evaluating them on the
+# data. Factors are add()ed once they are fully memorized; each sweep through
+# the data is bracketed by start_sweep() and finish_sweep(), with
+# examine_chunk() called on every chunk in between. This lets
+# _factors_memorize examine the finished factors while it is making a
+# memorization pass for the others, so that e.g. a formula with no stateful
+# transforms only has to read through the data once.
+class _FactorTypeExaminer(object):
+    def __init__(self, NA_action, eval_cache=None):
+        self._NA_action = NA_action
+        self._eval_cache = eval_cache
+        self._factor_states = {}
+        # Factors waiting for the next sweep to start:
+        self._pending = set()
+        # Factors being examined in the current sweep:
+        self._examining = set()
+        self._num_column_counts = {}
+        self._cat_sniffers = {}
+
+    def add(self, factor, state):
+        self._factor_states[factor] = state
+        self._pending.add(factor)
+
+    def start_sweep(self):
+        self._examining.update(self._pending)
+        self._pending.clear()
+
+    # Returns True if there is nothing left to do in this sweep.
+    def examine_chunk(self, data, subexpressions):
+        for factor in list(self._examining):
+            state = self._factor_states[factor]
+            if self._eval_cache is None:
+                value = subexpressions.eval(factor, state)
+            else:
+                value = self._eval_cache._eval_raw(
+                    factor, state, data,
+                    lambda: subexpressions.eval(factor, state))
+            if factor in self._cat_sniffers or guess_categorical(value):
+                if factor not in self._cat_sniffers:
+                    self._cat_sniffers[factor] = CategoricalSniffer(
+                        self._NA_action, factor.origin)
+                done = self._cat_sniffers[factor].sniff(value)
                 if done:
-                    examine_needed.remove(factor)
+                    self._examining.remove(factor)
             else:
                 # Numeric
                 value = atleast_2d_column_default(value)
                 _max_allowed_dim(2, value, factor)
                 column_count = value.shape[1]
-                num_column_counts[factor] = column_count
-                examine_needed.remove(factor)
-        if not examine_needed:
-            break
-    # Pull out the levels
-    cat_levels_contrasts = {}
-    for factor, sniffer in six.iteritems(cat_sniffers):
-        cat_levels_contrasts[factor] = sniffer.levels_contrast()
-    return (num_column_counts, cat_levels_contrasts)
-
-def test__examine_factor_types():
+                self._num_column_counts[factor] = column_count
+                self._examining.remove(factor)
+        return not self._examining
+
+    def finish_sweep(self):
+        # Any factor that is still being examined has now seen all the data,
+        # so its sniffer knows everything there is to know.
+        self._examining.clear()
+
+    # Examines any factors that are left over, in a sweep of their own. This
+    # doesn't touch the data at all if there's nothing left to do, and stops
+    # reading as soon as it can.
+    def sweep(self, data_iter_maker):
+        self.start_sweep()
+        if self._examining:
+            for data in data_iter_maker():
+                if self.examine_chunk(data, _SubexpressionCache(data)):
+                    break
+        self.finish_sweep()
+
+    def results(self):
+        # Pull out the levels
+        cat_levels_contrasts = {}
+        for factor, sniffer in six.iteritems(self._cat_sniffers):
+            cat_levels_contrasts[factor] = sniffer.levels_contrast()
+        return (self._num_column_counts, cat_levels_contrasts)
+
+def test__FactorTypeExaminer():
     from patsy.categorical import C
+    def examine(factors, factor_states, data_iter_maker):
+        examiner = _FactorTypeExaminer(NAAction())
+        for factor in factors:
+            examiner.add(factor, factor_states[factor])
+        examiner.sweep(data_iter_maker)
+        return examiner.results()
+
     class MockFactor(object):
         def __init__(self):
             # You should check this using 'is', not '=='
@@ -520,8 +927,7 @@ def test__examine_factor_types():
 
     it = DataIterMaker()
     (num_column_counts, cat_levels_contrasts,
-     ) = _examine_factor_types(factor_states.keys(), factor_states, it,
-                               NAAction())
+     ) = examine(factor_states.keys(), factor_states, it)
     assert it.i == 2
     iterations = 0
     assert num_column_counts == {num_1dim: 1, num_1col: 1, num_4col: 4}
@@ -536,8 +942,7 @@ def test__examine_factor_types():
     it = DataIterMaker()
     no_read_necessary = [num_1dim, num_1col, num_4col, categ_1col, bool_1col]
     (num_column_counts, cat_levels_contrasts,
-     ) = _examine_factor_types(no_read_necessary, factor_states, it,
-                               NAAction())
+     ) = examine(no_read_necessary, factor_states, it)
     assert it.i == 0
     assert num_column_counts == {num_1dim: 1, num_1col: 1, num_4col: 4}
     assert cat_levels_contrasts == {
@@ -561,13 +966,103 @@ def test__examine_factor_types():
     for illegal_factor in illegal_factor_states:
         it = DataIterMaker()
         try:
-            _examine_factor_types([illegal_factor], illegal_factor_states, it,
-                                  NAAction())
+            examine([illegal_factor], illegal_factor_states, it)
         except PatsyError as e:
             assert e.origin is illegal_factor.origin
         else:
             assert False
 
+# Coding a contrast can be expensive (e.g. Poly does a QR decomposition, and
+# every contrast has to name its columns), and the same factor tends to be
+# coded in the same way over and over -- in every term it appears in, and
+# every time a formula is used -- so we remember the results. This means that
+# ContrastMatrix objects are shared between terms and between DesignInfo
+# objects, and must not be modified.
+_contrast_matrix_cache = LRUCache(256)
+
+# Levels have to be compared by type as well as by value: True == 1 == 1.0,
+# but they give different column names. (We can't use _fingerprint for this,
+# because it compares instances of plain classes by their __dict__, and such
+# levels are named by their identity-based repr().)
+def _levels_key(levels):
+    if isinstance(levels, _HashedLevels):
+        return (_HashedLevels, levels.n_buckets)
+    key = []
+    for level in levels:
+        if isinstance(level, tuple):
+            key.append((tuple, _levels_key(level)))
+        else:
+            key.append((type(level), level))
+    return tuple(key)
+
+def _code_contrast_matrix(intercept, levels, contrast):
+    # Contrast objects are compared by value, so that e.g. two separate
+    # Poly([1, 2, 5]) objects are recognized as being the same.
+    key = (intercept, _levels_key(levels), _fingerprint(contrast))
+    try:
+        coded = _contrast_matrix_cache.get(key)
+    except TypeError:
+        # unhashable levels
+        key = None
+        coded = None
+    if coded is None:
+        # This is where the default coding is set to Treatment:
+        coded = code_contrast_matrix(intercept, levels, contrast,
+                                     default=Treatment)
+        if key is not None:
+            _contrast_matrix_cache.put(key, coded)
+    return coded
+
+def test__code_contrast_matrix():
+    from patsy.contrasts import Poly, ContrastMatrix
+    calls = []
+    class CountingContrast(object):
+        def __init__(self, scale):
+            self.scale = scale
+        def code_with_intercept(self, levels):
+            calls.append(levels)
+            return ContrastMatrix(self.scale * np.eye(len(levels)),
+                                  ["[%s]" % (level,) for level in levels])
+        code_without_intercept = code_with_intercept
+    levels = ("a", "b", "c")
+    first = _code_contrast_matrix(True, levels, CountingContrast(1))
+    assert _code_contrast_matrix(True, levels, CountingContrast(1)) is first
+    assert len(calls) == 1
+    # Different intercept, levels or contrast parameters are different
+    _code_contrast_matrix(False, levels, CountingContrast(1))
+    _code_contrast_matrix(True, ("a", "b"), CountingContrast(1))
+    scaled = _code_contrast_matrix(True, levels, CountingContrast(2))
+    assert len(calls) == 4
+    assert np.array_equal(scaled.matrix, 2 * np.eye(3))
+    # The default is Treatment
+    assert (_code_contrast_matrix(False, levels, None).column_suffixes
+            == ["[T.b]", "[T.c]"])
+    assert (_code_contrast_matrix(False, levels, Poly([1, 2, 5]))
+            is _code_contrast_matrix(False, levels, Poly([1, 2, 5])))
+    assert (_code_contrast_matrix(False, levels, Poly([1, 2, 5]))
+            is not _code_contrast_matrix(False, levels, Poly([1, 2, 6])))
+    # Unhashable levels just don't get cached
+    unhashable = ([1], [2])
+    assert (_code_contrast_matrix(False, unhashable, None).column_suffixes
+            == ["[T.[2]]"])
+    # Levels that are equal but of different types are kept apart
+    for levels_a, levels_b in [((False, True), (0, 1)),
+                               ((1.0, 2.0), (1, 2)),
+                               ((("a", 1.0),), (("a", 1),))]:
+        coded_a = _code_contrast_matrix(True, levels_a, None)
+        coded_b = _code_contrast_matrix(True, levels_b, None)
+        assert coded_a is not coded_b
+        assert coded_b.column_suffixes == ["[%r]" % (level,)
+                                           for level in levels_b]
+    # Equal-looking instances of plain classes are kept apart too, since
+    # they're named by identity
+    class Level(object):
+        pass
+    levels_a = (Level(),)
+    levels_b = (Level(),)
+    assert (_code_contrast_matrix(True, levels_b, None).column_suffixes
+            != _code_contrast_matrix(True, levels_a, None).column_suffixes)
+
 def _make_subterm_infos(terms,
                         num_column_counts,
                         cat_levels_contrasts):
@@ -621,13 +1116,10 @@ def _make_subterm_infos(terms,
                     elif factor in factor_coding:
                         subterm_factors.append(factor)
                         levels, contrast = cat_levels_contrasts[factor]
-                        # This is where the default coding is set to
-                        # Treatment:
-                        coded = code_contrast_matrix(factor_coding[factor],
-                                                     levels, contrast,
-                                                     default=Treatment)
+                        coded = _code_contrast_matrix(factor_coding[factor],
+                                                      levels, contrast)
                         contrast_matrices[factor] = coded
-                        subterm_columns *= coded.matrix.shape[1]
+                        subterm_columns *= coded._shape()[1]
                 subterm_infos.append(SubtermInfo(subterm_factors,
                                                        contrast_matrices,
                                                        subterm_columns))
@@ -636,7 +1128,7 @@ def _make_subterm_infos(terms,
     return term_to_subterm_infos
 
 def design_matrix_builders(termlists, data_iter_maker, eval_env,
-                           NA_action="drop"):
+                           NA_action="drop", eval_cache=None):
     """Construct several :class:`DesignInfo` objects from termlists.
 
     This is one of Patsy's fundamental functions. This function and
@@ -661,6 +1153,10 @@ def design_matrix_builders(termlists, data_iter_maker, eval_env,
     :arg NA_action: An :class:`NAAction` object or string, used to determine
       what values count as 'missing' for purposes of determining the levels of
       categorical factors.
+    :arg eval_cache: Either None (the default), or a
+      :class:`FactorEvalCache`. Factors evaluated while determining their
+      types are looked up in, and stored in, this cache, so that they can be
+      reused by :func:`build_design_matrices`.
     :returns: A list of :class:`DesignInfo` objects, one for each
       termlist passed in.
 
@@ -674,6 +1170,8 @@ def design_matrix_builders(termlists, data_iter_maker, eval_env,
        The ``NA_action`` argument.
     .. versionadded:: 0.4.0
        The ``eval_env`` argument.
+    .. versionadded:: 0.5.0
+       The ``eval_cache`` argument.
     """
     # People upgrading from versions prior to 0.4.0 could potentially have
     # passed NA_action as the 3rd positional argument. Fortunately
@@ -686,14 +1184,15 @@ def design_matrix_builders(termlists, data_iter_maker, eval_env,
     for termlist in termlists:
         for term in termlist:
             all_factors.update(term.factors)
-    factor_states = _factors_memorize(all_factors, data_iter_maker, eval_env)
-    # Now all the factors have working eval methods, so we can evaluate them
-    # on some data to find out what type of data they return.
-    (num_column_counts,
-     cat_levels_contrasts) = _examine_factor_types(all_factors,
-                                                   factor_states,
-                                                   data_iter_maker,
-                                                   NA_action)
+    # Once a factor has a working eval method, we can evaluate it on some
+    # data to find out what type of data it returns. The examiner does this
+    # alongside the memorization passes wherever it can, and then we make a
+    # final sweep for whatever factors are left.
+    examiner = _FactorTypeExaminer(NA_action, eval_cache=eval_cache)
+    factor_states = _factors_memorize(all_factors, data_iter_maker, eval_env,
+                                      examiner)
+    examiner.sweep(data_iter_maker)
+    num_column_counts, cat_levels_contrasts = examiner.results()
     # Now we need the factor infos, which encapsulate the knowledge of
     # how to turn any given factor into a chunk of data:
     factor_infos = {}
@@ -736,40 +1235,222 @@ def design_matrix_builders(termlists, data_iter_maker, eval_env,
                                        term_codings=term_to_subterm_infos))
     return design_infos
 
-def _build_design_matrix(design_info, factor_info_to_values, dtype):
+def _design_factor_values(design_info, factor_info_to_values):
     factor_to_values = {}
-    need_reshape = False
-    num_rows = None
     for factor_info, value in six.iteritems(factor_info_to_values):
         # It's possible that the same factor appears in multiple different
         # FactorInfo objects (e.g. if someone is simultaneously building two
         # DesignInfo objects that started out as part of different
         # formulas). Skip any factor_info that is not our expected
         # factor_info.
-        if design_info.factor_infos.get(factor_info.factor) is not factor_info:
-            continue
-        factor_to_values[factor_info.factor] = value
-        if num_rows is not None:
-            assert num_rows == value.shape[0]
-        else:
-            num_rows = value.shape[0]
-    if num_rows is None:
-        # We have no dependence on the data -- e.g. an empty termlist, or
-        # only an intercept term.
-        num_rows = 1
-        need_reshape = True
-    shape = (num_rows, len(design_info.column_names))
-    m = DesignMatrix(np.empty(shape, dtype=dtype), design_info)
+        if design_info.factor_infos.get(factor_info.factor) is factor_info:
+            factor_to_values[factor_info.factor] = value
+    return factor_to_values
+
+def _check_n_jobs(n_jobs):
+    if n_jobs == -1:
+        import multiprocessing
+        n_jobs = multiprocessing.cpu_count()
+    if not isinstance(n_jobs, six.integer_types) or n_jobs < 1:
+        raise PatsyError("n_jobs must be a positive integer or -1, not %r"
+                         % (n_jobs,))
+    return n_jobs
+
+def _make_pool(n_jobs):
+    n_jobs = _check_n_jobs(n_jobs)
+    if n_jobs == 1:
+        return None
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(n_jobs)
+
+def _close_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+# Like [fn(item) for item in items], except that if 'pool' is not None then
+# the calls are made concurrently in the pool's threads. If any calls fail,
+# then the exception that gets raised is the one from the first failing item,
+# just like in the serial case, so errors don't depend on thread timing.
+def _ordered_map(pool, fn, items):
+    if pool is None:
+        return [fn(item) for item in items]
+    def call(item):
+        try:
+            return True, fn(item)
+        except Exception:
+            return False, sys.exc_info()
+    results = []
+    for ok, value in pool.map(call, items):
+        if not ok:
+            six.reraise(*value)
+        results.append(value)
+    return results
+
+def test__ordered_map():
+    from nose.tools import assert_raises
+    def fn(i):
+        if i in (5, 7):
+            raise ValueError(i)
+        return i * 2
+    for n_jobs in [1, 4]:
+        pool = _make_pool(n_jobs)
+        try:
+            assert _ordered_map(pool, fn, [3, 1, 2]) == [6, 2, 4]
+            assert _ordered_map(pool, fn, []) == []
+            try:
+                _ordered_map(pool, fn, range(10))
+            except ValueError as e:
+                assert e.args == (5,)
+            else:
+                assert False
+        finally:
+            _close_pool(pool)
+    assert _make_pool(1) is None
+    assert_raises(PatsyError, _make_pool, 0)
+    assert_raises(PatsyError, _make_pool, -2)
+    assert_raises(PatsyError, _make_pool, 1.5)
+
+# Gives access to each factor's values, keeping only the given rows (or all
+# of them, if 'rows' is None). The rows are picked out the first time a
+# factor is needed, and the copy is shared between all the subterms that use
+# that factor; once every one of them has called done(), the copy is dropped
+# again. So even when subterms are built concurrently, each factor is copied
+# at most once, and only while it's in use.
+class _KeptRows(object):
+    def __init__(self, factor_to_values, rows, subterms):
+        self._factor_to_values = factor_to_values
+        self._rows = rows
+        self._users = {}
+        for subterm in subterms:
+            for factor in subterm.factors:
+                self._users[factor] = self._users.get(factor, 0) + 1
+        self._kept = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, factor):
+        if self._rows is None:
+            return self._factor_to_values[factor]
+        with self._lock:
+            if factor not in self._kept:
+                # "..." to handle 1- versus 2-dim indexing
+                values = self._factor_to_values[factor]
+                self._kept[factor] = values[self._rows, ...]
+            return self._kept[factor]
+
+    def done(self, subterm):
+        with self._lock:
+            for factor in subterm.factors:
+                self._users[factor] -= 1
+                if not self._users[factor]:
+                    self._kept.pop(factor, None)
+
+def test__KeptRows():
+    from patsy.design_info import SubtermInfo
+    f1 = _MockFactor("f1")
+    f2 = _MockFactor("f2")
+    f1_values = np.arange(4)
+    f2_values = np.arange(8).reshape((4, 2))
+    s1 = SubtermInfo([f1], {}, 1)
+    s2 = SubtermInfo([f1, f2], {}, 2)
+    kept = _KeptRows({f1: f1_values, f2: f2_values}, np.array([0, 2]),
+                     [s1, s2])
+    assert np.array_equal(kept[f1], [0, 2])
+    assert np.array_equal(kept[f2], [[0, 1], [4, 5]])
+    # Each factor is only copied once
+    assert kept[f1] is kept[f1]
+    kept1 = kept[f1]
+    kept.done(s1)
+    # ... and the copy is dropped when the last subterm using it is done
+    assert kept[f1] is kept1
+    kept.done(s2)
+    assert kept[f1] is not kept1
+    # Without rows, the values are passed straight through
+    kept = _KeptRows({f1: f1_values}, None, [s1])
+    assert kept[f1] is f1_values
+    kept.done(s1)
+
+def _build_design_matrix(design_info, factor_info_to_values, num_rows, dtype,
+                         order="C", out=None, pool=None, rows=None):
+    factor_to_values = _design_factor_values(design_info,
+                                             factor_info_to_values)
+    shape = (num_rows, len(design_info.column_name_indexes))
+    if out is None:
+        out = np.empty(shape, dtype=dtype, order=order)
+    assert out.shape == shape
+    m = DesignMatrix(out, design_info)
+    # If we have no dependence on the data at all (e.g. an empty termlist, or
+    # only an intercept term), then every subterm has no factors, and
+    # _build_subterm just fills in the right number of 1s.
+    # Each subterm fills in its own block of columns, so they can be built
+    # independently.
+    jobs = []
     start_column = 0
     for term, subterms in six.iteritems(design_info.term_codings):
         for subterm in subterms:
             end_column = start_column + subterm.num_columns
-            m_slice = m[:, start_column:end_column]
-            _build_subterm(subterm, design_info.factor_infos,
-                           factor_to_values, m_slice)
+            jobs.append((subterm, m[:, start_column:end_column]))
             start_column = end_column
     assert start_column == m.shape[1]
-    return need_reshape, m
+    kept = _KeptRows(factor_to_values, rows, [job[0] for job in jobs])
+    def build_one(job):
+        subterm, m_slice = job
+        try:
+            _build_subterm(subterm, design_info.factor_infos, kept, m_slice)
+        finally:
+            kept.done(subterm)
+    _ordered_map(pool, build_one, jobs)
+    return m
+
+def _build_design_matrix_sparse(design_info, factor_info_to_values, num_rows,
+                                dtype, pool=None, rows=None):
+    sparse = _import_scipy_sparse()
+    factor_to_values = _design_factor_values(design_info,
+                                             factor_info_to_values)
+    all_subterms = []
+    for term, subterms in six.iteritems(design_info.term_codings):
+        all_subterms.extend(subterms)
+    kept = _KeptRows(factor_to_values, rows, all_subterms)
+    def build_one(subterm):
+        try:
+            return _build_subterm_sparse(subterm, design_info.factor_infos,
+                                         kept, num_rows, dtype)
+        finally:
+            kept.done(subterm)
+    blocks = _ordered_map(pool, build_one, all_subterms)
+    if blocks:
+        m = sparse.hstack(blocks, format="csc", dtype=dtype)
+    else:
+        m = sparse.csc_matrix((num_rows, 0), dtype=dtype)
+    assert m.shape == (num_rows, len(design_info.column_name_indexes))
+    m.design_info = design_info
+    return m
+
+def _check_out_array(i, out_array, design_info, num_rows, dtype):
+    if not isinstance(out_array, np.ndarray):
+        raise PatsyError("out[%s] should be an ndarray, not %r"
+                         % (i, type(out_array).__name__))
+    shape = (num_rows, len(design_info.column_name_indexes))
+    if out_array.shape != shape:
+        raise PatsyError("out[%s] has shape %s, but the design matrix "
+                         "has shape %s" % (i, out_array.shape, shape))
+    if out_array.dtype != np.dtype(dtype):
+        raise PatsyError("out[%s] has dtype %s, but dtype=%s was requested"
+                         % (i, out_array.dtype, np.dtype(dtype)))
+
+def _allocate_from_sink(i, sink, design_info, num_rows, dtype):
+    # Check everything up front, so we don't extend the file and then error
+    # out.
+    if (sink.design_info is not design_info
+        and sink.design_info.column_names != design_info.column_names):
+        raise PatsyError("out[%s] is a sink for a design matrix with columns "
+                         "%r, not %r"
+                         % (i, sink.design_info.column_names,
+                            design_info.column_names))
+    if sink.dtype != np.dtype(dtype):
+        raise PatsyError("out[%s] has dtype %s, but dtype=%s was requested"
+                         % (i, sink.dtype, np.dtype(dtype)))
+    return sink.allocate(num_rows)
 
 class _CheckMatch(object):
     def __init__(self, name, eq_fn):
@@ -797,7 +1478,12 @@ class _CheckMatch(object):
 def build_design_matrices(design_infos, data,
                           NA_action="drop",
                           return_type="matrix",
-                          dtype=np.dtype(float)):
+                          dtype=np.dtype(float),
+                          order="C",
+                          out=None,
+                          n_jobs=1,
+                          backend="threads",
+                          eval_cache=None):
     """Construct several design matrices from :class:`DesignMatrixBuilder`
     objects.
 
@@ -812,16 +1498,72 @@ def build_design_matrices(design_infos, data,
       ``"drop"`` them, ``"raise"`` an error, or for customization, pass an
       :class:`NAAction` object. See :class:`NAAction` for details on what
       values count as 'missing' (and how to alter this).
-    :arg return_type: Either ``"matrix"`` or ``"dataframe"``. See below.
+    :arg return_type: Either ``"matrix"``, ``"dataframe"``, or ``"sparse"``.
+      See below.
     :arg dtype: The dtype of the returned matrix. Useful if you want to use
       single-precision or extended-precision.
+    :arg order: The memory layout of the returned matrices: ``"C"`` (the
+      default) for row-major, or ``"F"`` for column-major (Fortran-order)
+      matrices, which many linear algebra routines prefer. Ignored for
+      ``return_type="sparse"``, which always produces column-oriented
+      matrices.
+    :arg out: Either None (the default), or a list with one entry per
+      :class:`DesignInfo` in `design_infos`. Each entry is either None or a
+      preallocated ndarray with the right shape (after any rows with missing
+      values have been removed) and `dtype`, which the corresponding design
+      matrix is written into; this can save repeated memory allocation when
+      building many matrices of the same size. The arrays may be C- or
+      Fortran-contiguous (a :class:`numpy.memmap` works too). The returned
+      :class:`DesignMatrix` objects are views onto these arrays. An entry
+      can also be an :class:`NpySink`, in which case the rows are appended
+      to a ``.npy`` file on disk and the matrix is built directly into a
+      memory map of them. Not supported for ``return_type="sparse"``.
+    :arg n_jobs: The number of threads to use. The default, 1, does
+      everything in the calling thread. With a larger number (or -1, meaning
+      one thread per CPU), independent factors are evaluated concurrently,
+      and then the column blocks for independent terms are filled in
+      concurrently. Most of this work is done by numpy, which releases the
+      GIL, so formulas with many terms can make good use of multiple cores.
+      The results (and any errors raised) are exactly the same as with
+      ``n_jobs=1``. Factors are evaluated in threads, so any functions they
+      call must be thread-safe.
+    :arg backend: How to use ``n_jobs``: ``"threads"`` (the default, see
+      above), or ``"processes"``. With ``"processes"``, the data is split
+      into ``n_jobs`` contiguous blocks of rows, and each block is built by
+      a separate worker process, writing directly into shared memory. This
+      can be much faster for very large data sets, especially if the
+      formula calls pure-Python code that holds the GIL. The workers are
+      started by forking, so they inherit the data and the memorized
+      :class:`DesignInfo` objects without having to pickle anything; this
+      backend therefore requires a platform with ``fork()`` (i.e., not
+      Windows). The data must be a :class:`pandas.DataFrame`, or a dict
+      whose array-like entries (arrays, lists, tuples, and pandas objects
+      like :class:`pandas.Categorical`) all have the same length, so that
+      it can be split up, and every factor must be computed row-by-row
+      (which is true for all of patsy's built-in stateful transforms, since
+      their state is memorized on the full data set). Formulas that take
+      whole columns from their environment rather than from ``data`` can't
+      be split up, so they are built as if ``backend="threads"`` had been
+      given. Row order, NA handling and indexes are exactly the same as for
+      a serial build. Not supported for ``return_type="sparse"``.
+    :arg eval_cache: Either None (the default), or a
+      :class:`FactorEvalCache`, which is used to reuse evaluated factors
+      across calls; see :class:`FactorEvalCache` for details. Not used with
+      ``backend="processes"``.
 
     This function returns either a list of :class:`DesignMatrix` objects (for
-    ``return_type="matrix"``) or a list of :class:`pandas.DataFrame` objects
-    (for ``return_type="dataframe"``). In both cases, all returned design
-    matrices will have ``.design_info`` attributes containing the appropriate
+    ``return_type="matrix"``), a list of :class:`pandas.DataFrame` objects
+    (for ``return_type="dataframe"``), or a list of
+    :class:`scipy.sparse.csc_matrix` objects (for
+    ``return_type="sparse"``). In all cases, all returned design matrices
+    will have ``.design_info`` attributes containing the appropriate
     :class:`DesignInfo` objects.
 
+    Sparse matrices are built directly from the integer codes of categorical
+    factors and the rows of their contrast matrices, without ever creating a
+    dense intermediate; this makes it possible to work with factors that
+    have very many levels. Using ``return_type="sparse"`` requires scipy.
+
     Note that unlike :func:`design_matrix_builders`, this function takes only
     a simple data argument, not any kind of iterator. That's because this
     function doesn't need a global view of the data -- everything that depends
@@ -861,47 +1603,149 @@ def build_design_matrices(design_infos, data,
 
     .. versionadded:: 0.2.0
        The ``NA_action`` argument.
+    .. versionadded:: 0.5.0
+       ``return_type="sparse"``, and the ``order``, ``out``, ``n_jobs``,
+       ``backend`` and ``eval_cache`` arguments.
 
     """
     if isinstance(NA_action, str):
         NA_action = NAAction(NA_action)
+    _check_build_options(return_type, order)
+    _check_out_option(design_infos, return_type, out)
+    if backend not in ("threads", "processes"):
+        raise PatsyError("unrecognized backend %r, should be 'threads' or "
+                         "'processes'" % (backend,))
+    if backend == "processes":
+        n_jobs = _check_n_jobs(n_jobs)
+        if n_jobs > 1 and _can_partition(design_infos, data):
+            return _build_design_matrices_processes(design_infos, data,
+                                                    NA_action, return_type,
+                                                    dtype, order, out, n_jobs)
+    pool = _make_pool(n_jobs)
+    try:
+        factor_info_to_values, rows, num_rows, pandas_index, _ = (
+            _eval_design_data(design_infos, data, NA_action,
+                              return_type, dtype, pool=pool,
+                              eval_cache=eval_cache))
+        return _build_design_matrices_from_values(design_infos,
+                                                  factor_info_to_values,
+                                                  rows, num_rows,
+                                                  pandas_index,
+                                                  return_type, dtype, order,
+                                                  out, pool=pool)
+    finally:
+        _close_pool(pool)
+
+def _check_build_options(return_type, order):
     if return_type == "dataframe" and not have_pandas:
         raise PatsyError("pandas.DataFrame was requested, but pandas "
                             "is not installed")
-    if return_type not in ("matrix", "dataframe"):
+    if return_type == "sparse":
+        _import_scipy_sparse()
+    if return_type not in ("matrix", "dataframe", "sparse"):
         raise PatsyError("unrecognized output type %r, should be "
-                            "'matrix' or 'dataframe'" % (return_type,))
-    # Evaluate factors
-    factor_info_to_values = {}
-    factor_info_to_isNAs = {}
+                            "'matrix', 'dataframe', or 'sparse'"
+                            % (return_type,))
+    if order not in ("C", "F"):
+        raise PatsyError("unrecognized order %r, should be 'C' or 'F'"
+                         % (order,))
+
+def _check_out_option(design_infos, return_type, out):
+    if out is not None:
+        if return_type == "sparse":
+            raise PatsyError("out= can't be used with return_type='sparse'")
+        if len(out) != len(design_infos):
+            raise PatsyError("out= has %s entries, but %s design matrices "
+                             "are being built"
+                             % (len(out), len(design_infos)))
+
+# NAAction objects can tell us which rows to keep, instead of making copies
+# of every factor's values with the NA rows removed. But NA_action might be
+# some other kind of object, or a subclass that handles NAs differently, and
+# then we have to let it do the copying.
+def _can_select_NA_rows(NA_action):
+    return (isinstance(NA_action, NAAction)
+            and six.get_unbound_function(type(NA_action).handle_NA)
+                is six.get_unbound_function(NAAction.handle_NA))
+
+def test__can_select_NA_rows():
+    class DropEverything(NAAction):
+        def handle_NA(self, values, is_NAs, origins):
+            return [v[:0, ...] for v in values]
+    class NotNAAction(object):
+        def handle_NA(self, values, is_NAs, origins):
+            return values
+    assert _can_select_NA_rows(NAAction())
+    assert not _can_select_NA_rows(DropEverything())
+    assert not _can_select_NA_rows(NotNAAction())
+
+# Evaluates all the factors needed by 'design_infos' on 'data', and then
+# applies NA_action. Returns a tuple:
+#   (factor_info_to_values, rows, num_rows, pandas_index, num_rows_before_NA)
+# where the number of rows (and pandas_index, which is only computed for
+# return_type="dataframe") are those left after NA handling. If no index is
+# found in the data, then the default index counts up from 'index_start'.
+#
+# If possible, rows containing NAs are not removed from the factor values;
+# instead 'rows' is an array giving the rows that should be kept, and it's up
+# to the builder to pick them out. Otherwise 'rows' is None, and the factor
+# values contain exactly the rows to use.
+def _eval_design_data(design_infos, data, NA_action, return_type, dtype,
+                      index_start=0, pool=None, eval_cache=None):
+    # We look at evaluators rather than factors here, because it might
+    # happen that we have the same factor twice, but with different
+    # memorized state.
+    factor_infos = []
+    seen = set()
+    for design_info in design_infos:
+        for factor_info in six.itervalues(design_info.factor_infos):
+            if factor_info not in seen:
+                seen.add(factor_info)
+                factor_infos.append(factor_info)
+    # Evaluate factors (possibly concurrently); everything that checks the
+    # results happens afterwards, in order, so errors are deterministic.
+    # Factors that have subexpressions in common (like np.log(x) in
+    # "np.log(x) + I(np.log(x) ** 2)") share their values.
+    subexpressions = _SubexpressionCache(data)
+    evaluated = _ordered_map(pool,
+                             lambda factor_info: _eval_factor(factor_info,
+                                                              data,
+                                                              NA_action,
+                                                              eval_cache,
+                                                              subexpressions),
+                             factor_infos)
+    factor_info_to_values = OrderedDict()
+    factor_info_to_isNAs = OrderedDict()
     rows_checker = _CheckMatch("Number of rows", lambda a, b: a == b)
     index_checker = _CheckMatch("Index", lambda a, b: a.equals(b))
     if have_pandas and isinstance(data, pandas.DataFrame):
         index_checker.check(data.index, "data.index", None)
         rows_checker.check(data.shape[0], "data argument", None)
-    for design_info in design_infos:
-        # We look at evaluators rather than factors here, because it might
-        # happen that we have the same factor twice, but with different
-        # memorized state.
-        for factor_info in six.itervalues(design_info.factor_infos):
-            if factor_info not in factor_info_to_values:
-                value, is_NA = _eval_factor(factor_info, data, NA_action)
-                factor_info_to_isNAs[factor_info] = is_NA
-                # value may now be a Series, DataFrame, or ndarray
-                name = factor_info.factor.name()
-                origin = factor_info.factor.origin
-                rows_checker.check(value.shape[0], name, origin)
-                if (have_pandas
-                    and isinstance(value, (pandas.Series, pandas.DataFrame))):
-                    index_checker.check(value.index, name, origin)
-                # Strategy: we work with raw ndarrays for doing the actual
-                # combining; DesignMatrixBuilder objects never sees pandas
-                # objects. Then at the end, if a DataFrame was requested, we
-                # convert. So every entry in this dict is either a 2-d array
-                # of floats, or a 1-d array of integers (representing
-                # categories).
-                value = np.asarray(value)
-                factor_info_to_values[factor_info] = value
+    for factor_info, (value, is_NA) in zip(factor_infos, evaluated):
+        factor_info_to_isNAs[factor_info] = is_NA
+        # value may now be a Series, DataFrame, or ndarray
+        name = factor_info.factor.name()
+        origin = factor_info.factor.origin
+        rows_checker.check(value.shape[0], name, origin)
+        if (have_pandas
+            and isinstance(value, (pandas.Series, pandas.DataFrame))):
+            index_checker.check(value.index, name, origin)
+        # Strategy: we work with raw ndarrays for doing the actual
+        # combining; DesignMatrixBuilder objects never sees pandas
+        # objects. Then at the end, if a DataFrame was requested, we
+        # convert. So every entry in this dict is either a 2-d array
+        # of floats, or a 1-d array of integers (representing
+        # categories).
+        value = np.asarray(value)
+        # If a lower-precision result was requested, convert numerical
+        # data now, so that dropping NAs and building the matrix
+        # never touch full-width temporaries.
+        if (factor_info.type == "numerical"
+            and value.dtype.kind == "f"
+            and value.dtype.itemsize > np.dtype(dtype).itemsize
+            and np.dtype(dtype).kind == "f"):
+            value = value.astype(dtype)
+        factor_info_to_values[factor_info] = value
     # Handle NAs
     values = list(factor_info_to_values.values())
     is_NAs = list(factor_info_to_isNAs.values())
@@ -909,56 +1753,352 @@ def build_design_matrices(design_infos, data,
                for factor_info in factor_info_to_values]
     pandas_index = index_checker.value
     num_rows = rows_checker.value
+    num_rows_before_NA = num_rows
     # num_rows is None iff evaluator_to_values (and associated sets like
     # 'values') are empty, i.e., we have no actual evaluators involved
     # (formulas like "~ 1").
     if return_type == "dataframe" and num_rows is not None:
         if pandas_index is None:
-            pandas_index = np.arange(num_rows)
-        values.append(pandas_index)
-        is_NAs.append(np.zeros(len(pandas_index), dtype=bool))
-        origins.append(None)
-    new_values = NA_action.handle_NA(values, is_NAs, origins)
-    # NA_action may have changed the number of rows.
-    if new_values:
-        num_rows = new_values[0].shape[0]
-    if return_type == "dataframe" and num_rows is not None:
-        pandas_index = new_values.pop()
-    factor_info_to_values = dict(zip(factor_info_to_values, new_values))
-    # Build factor values into matrices
-    results = []
-    for design_info in design_infos:
-        results.append(_build_design_matrix(design_info,
+            pandas_index = np.arange(index_start, index_start + num_rows)
+    rows = None
+    if _can_select_NA_rows(NA_action):
+        rows = NA_action.handle_NA_rows(is_NAs, origins)
+        if rows is not None:
+            num_rows = len(rows)
+            if return_type == "dataframe":
+                pandas_index = pandas_index[rows]
+        factor_info_to_values = dict(factor_info_to_values)
+    else:
+        if return_type == "dataframe" and num_rows is not None:
+            values.append(pandas_index)
+            is_NAs.append(np.zeros(len(pandas_index), dtype=bool))
+            origins.append(None)
+        new_values = NA_action.handle_NA(values, is_NAs, origins)
+        # NA_action may have changed the number of rows.
+        if new_values:
+            num_rows = new_values[0].shape[0]
+        if return_type == "dataframe" and num_rows is not None:
+            pandas_index = new_values.pop()
+        factor_info_to_values = dict(zip(factor_info_to_values, new_values))
+    if num_rows is None:
+        # There is no data-dependence, at all -- a formula like "1 ~ 1". We
+        # could build such matrices with any number of rows, if only we
+        # knew how many that should be...
+        raise PatsyError(
+            "No design matrix has any non-trivial factors, "
+            "the data object is not a DataFrame. "
+            "I can't tell how many rows the design matrix should "
+            "have!"
+            )
+    return (factor_info_to_values, rows, num_rows, pandas_index,
+            num_rows_before_NA)
+
+def _build_design_matrices_from_values(design_infos, factor_info_to_values,
+                                       rows, num_rows, pandas_index,
+                                       return_type, dtype, order, out,
+                                       pool=None):
+    if return_type == "sparse":
+        return [_build_design_matrix_sparse(design_info,
                                             factor_info_to_values,
-                                            dtype))
+                                            num_rows, dtype, pool=pool,
+                                            rows=rows)
+                for design_info in design_infos]
+    # Build factor values into matrices
+    if out is None:
+        out = [None] * len(design_infos)
     matrices = []
-    for need_reshape, matrix in results:
-        if need_reshape:
-            # There is no data-dependence, at all -- a formula like "1 ~ 1".
-            # In this case the builder just returns a single-row matrix, and
-            # we have to broadcast it vertically to the appropriate size. If
-            # we can figure out what that is...
-            assert matrix.shape[0] == 1
-            if num_rows is not None:
-                matrix = DesignMatrix(np.repeat(matrix, num_rows, axis=0),
-                                      matrix.design_info)
+    for i, (design_info, out_array) in enumerate(zip(design_infos, out)):
+        if isinstance(out_array, NpySink):
+            out_array = _allocate_from_sink(i, out_array, design_info,
+                                            num_rows, dtype)
+        if out_array is not None:
+            _check_out_array(i, out_array, design_info, num_rows, dtype)
+        matrices.append(_build_design_matrix(design_info,
+                                             factor_info_to_values,
+                                             num_rows, dtype, order=order,
+                                             out=out_array, pool=pool,
+                                             rows=rows))
+    if return_type == "dataframe":
+        _convert_to_dataframes(matrices, pandas_index)
+    return matrices
+
+def _convert_to_dataframes(matrices, pandas_index):
+    assert have_pandas
+    for i, matrix in enumerate(matrices):
+        di = matrix.design_info
+        matrices[i] = pandas.DataFrame(matrix,
+                                       columns=di.column_names,
+                                       index=pandas_index)
+        matrices[i].design_info = di
+
+# Building with backend="processes":
+#
+# The data is split into contiguous blocks of rows, and each block is built
+# in a worker process. Everything the workers need (the data, the
+# DesignInfos with their memorized factor states, the NAAction) is inherited
+# by forking, rather than being pickled -- which is just as well, since
+# patsy's objects deliberately refuse to be pickled. The workers write their
+# rows directly into anonymous shared memory maps (created before forking)
+# that are big enough to hold every row, and just report back how many rows
+# they kept after NA handling; the parent then packs the kept rows together.
+# Since all stateful transforms were memorized on the full data set, and
+# NA handling is row-by-row, the result is identical to a serial build.
+_process_build_lock = threading.Lock()
+_process_build_state = None
+
+def _fork_context():
+    import multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        try:
+            return multiprocessing.get_context("fork")
+        except ValueError: # pragma: no cover
+            return None
+    if sys.platform == "win32": # pragma: no cover
+        return None
+    return multiprocessing
+
+def _is_row_column(value):
+    if have_pandas and isinstance(value, (pandas.Series, pandas.DataFrame,
+                                          pandas.Index, pandas.Categorical)):
+        return True
+    if isinstance(value, np.ndarray):
+        return value.ndim >= 1
+    return isinstance(value, (list, tuple))
+
+def _num_data_rows(data):
+    if have_pandas and isinstance(data, pandas.DataFrame):
+        return data.shape[0]
+    lengths = set()
+    for key in data.keys():
+        if _is_row_column(data[key]):
+            lengths.add(len(data[key]))
+    if len(lengths) != 1:
+        raise PatsyError("backend='processes' requires the data to be a "
+                         "DataFrame, or a dict whose array-like entries "
+                         "all have the same length")
+    return lengths.pop()
+
+def _data_rows(data, start, stop):
+    if have_pandas and isinstance(data, pandas.DataFrame):
+        return data.iloc[start:stop]
+    sliced = {}
+    for key in data.keys():
+        value = data[key]
+        if _is_row_column(value):
+            if (have_pandas
+                and isinstance(value, (pandas.Series, pandas.DataFrame))):
+                value = value.iloc[start:stop]
             else:
-                raise PatsyError(
-                    "No design matrix has any non-trivial factors, "
-                    "the data object is not a DataFrame. "
-                    "I can't tell how many rows the design matrix should "
-                    "have!"
-                    )
-        matrices.append(matrix)
+                # Slicing keeps Categoricals, Indexes and tuples as they are
+                value = value[start:stop]
+        sliced[key] = value
+    return sliced
+
+# Splitting up the data only works if every factor gets all of its rows from
+# the data. A factor that takes an array of the same length from its
+# environment (e.g., "x + y" with only y in the data) would see all of it in
+# every partition, so those formulas are built serially instead.
+def _uses_environment_rows(design_infos, data, total_rows):
+    for design_info in design_infos:
+        for factor_info in six.itervalues(design_info.factor_infos):
+            state = factor_info.state
+            if not isinstance(state, dict) or "eval_env" not in state:
+                continue
+            namespace = state["eval_env"].namespace
+            for name in state["compiled_eval_code"][1]:
+                if name in data or name not in namespace:
+                    continue
+                value = namespace[name]
+                if _is_row_column(value) and len(value) == total_rows:
+                    return True
+    return False
+
+def _can_partition(design_infos, data):
+    return not _uses_environment_rows(design_infos, data,
+                                      _num_data_rows(data))
+
+def _shared_empty(shape, dtype, order):
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes == 0:
+        # mmap refuses to create empty mappings
+        return np.empty(shape, dtype=dtype, order=order)
+    return np.ndarray(shape, dtype=dtype, order=order,
+                      buffer=mmap.mmap(-1, nbytes))
+
+def _build_partition(state, i):
+    start, stop = state["bounds"][i]
+    factor_info_to_values, rows, num_rows, pandas_index, _ = (
+        _eval_design_data(state["design_infos"],
+                          _data_rows(state["data"], start, stop),
+                          state["NA_action"], state["return_type"],
+                          state["dtype"], index_start=start))
+    for design_info, buf in zip(state["design_infos"], state["buffers"]):
+        _build_design_matrix(design_info, factor_info_to_values, num_rows,
+                             state["dtype"], out=buf[start:start + num_rows],
+                             rows=rows)
+    if state["return_type"] != "dataframe":
+        # Don't bother sending it back
+        pandas_index = None
+    return num_rows, pandas_index
+
+def _process_build_worker(i):
+    try:
+        return True, _build_partition(_process_build_state, i)
+    except Exception:
+        # The exception might not survive pickling, so the parent will
+        # re-raise it itself.
+        return False, None
+
+def _build_design_matrices_processes(design_infos, data, NA_action,
+                                     return_type, dtype, order, out, n_jobs):
+    global _process_build_state
+    context = _fork_context()
+    if context is None: # pragma: no cover
+        raise PatsyError("backend='processes' requires a platform that "
+                         "supports fork()")
+    if return_type == "sparse":
+        raise PatsyError("backend='processes' can't be used with "
+                         "return_type='sparse'")
+    total_rows = _num_data_rows(data)
+    edges = np.linspace(0, total_rows, n_jobs + 1).astype(int)
+    bounds = [(start, stop) for (start, stop) in zip(edges[:-1], edges[1:])
+              if start < stop]
+    if not bounds:
+        bounds = [(0, 0)]
+    buffers = [_shared_empty((total_rows, len(di.column_name_indexes)),
+                             dtype, order)
+               for di in design_infos]
+    state = {"design_infos": design_infos,
+             "data": data,
+             "NA_action": NA_action,
+             "return_type": return_type,
+             "dtype": dtype,
+             "bounds": bounds,
+             "buffers": buffers,
+             }
+    with _process_build_lock:
+        _process_build_state = state
+        try:
+            pool = context.Pool(len(bounds))
+            try:
+                results = pool.map(_process_build_worker, range(len(bounds)))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _process_build_state = None
+    kept_rows = []
+    pandas_indexes = []
+    for i, (ok, result) in enumerate(results):
+        if not ok:
+            # Redo the first failed partition here, to raise its error.
+            _build_partition(state, i)
+            raise PatsyError("building rows %s-%s failed in a worker "
+                             "process" % bounds[i]) # pragma: no cover
+        kept_rows.append(result[0])
+        pandas_indexes.append(result[1])
+    num_rows = sum(kept_rows)
+    if out is None:
+        out = [None] * len(design_infos)
+    matrices = []
+    for i, (design_info, buf, out_array) in enumerate(zip(design_infos,
+                                                          buffers, out)):
+        if isinstance(out_array, NpySink):
+            out_array = _allocate_from_sink(i, out_array, design_info,
+                                            num_rows, dtype)
+        if out_array is not None:
+            _check_out_array(i, out_array, design_info, num_rows, dtype)
+        elif num_rows == total_rows:
+            # Nothing was dropped, so the shared buffer is already the
+            # design matrix.
+            out_array = buf
+        else:
+            out_array = np.empty((num_rows, buf.shape[1]), dtype=dtype,
+                                 order=order)
+        if out_array is not buf:
+            pos = 0
+            for (start, stop), kept in zip(bounds, kept_rows):
+                out_array[pos:pos + kept] = buf[start:start + kept]
+                pos += kept
+        matrices.append(DesignMatrix(out_array, design_info))
     if return_type == "dataframe":
-        assert have_pandas
-        for i, matrix in enumerate(matrices):
-            di = matrix.design_info
-            matrices[i] = pandas.DataFrame(matrix,
-                                           columns=di.column_names,
-                                           index=pandas_index)
-            matrices[i].design_info = di
+        pandas_index = pandas.Index(pandas_indexes[0])
+        if len(pandas_indexes) > 1:
+            pandas_index = pandas_index.append([pandas.Index(index)
+                                                for index
+                                                in pandas_indexes[1:]])
+        _convert_to_dataframes(matrices, pandas_index)
     return matrices
 
+def build_design_matrices_iter(design_infos, data_iter,
+                               NA_action="drop",
+                               return_type="matrix",
+                               dtype=np.dtype(float),
+                               order="C",
+                               out=None,
+                               n_jobs=1,
+                               eval_cache=None):
+    """Construct design matrices chunk by chunk from an iterable of data.
+
+    This is the streaming counterpart to :func:`build_design_matrices`, and
+    pairs naturally with :func:`incr_dbuilder` and
+    :func:`design_matrix_builders`: once the :class:`DesignInfo` objects have
+    been learned from a pass over the data, this function lets you make a
+    second pass that builds the design matrices one chunk at a time, so that
+    the full matrices never need to be held in memory at once.
+
+    :arg design_infos: A list of :class:`DesignInfo` objects describing the
+      design matrices to be built.
+    :arg data_iter: An iterable of dict-like objects (e.g., pandas
+      DataFrames), each of which is one chunk of data.
+    :arg NA_action: As for :func:`build_design_matrices`. The same
+      :class:`NAAction` is applied to every chunk.
+    :arg return_type: As for :func:`build_design_matrices`.
+    :arg dtype: As for :func:`build_design_matrices`.
+    :arg order: As for :func:`build_design_matrices`.
+    :arg out: As for :func:`build_design_matrices`. This is mostly useful
+      with :class:`NpySink` objects, which receive the rows from every chunk
+      in turn; see :class:`NpySink` for an example.
+    :arg n_jobs: As for :func:`build_design_matrices`. The same threads are
+      used for every chunk.
+    :arg eval_cache: As for :func:`build_design_matrices`.
+
+    This is a generator which, for each chunk of data, yields a list with one
+    design matrix per entry in `design_infos`, exactly as
+    :func:`build_design_matrices` would return it for that chunk.
+
+    Index handling: if a chunk has an index of its own (e.g. it is a
+    :class:`pandas.DataFrame`), then that index is used, as usual. Otherwise,
+    the default index continues on from the previous chunks, rather than
+    starting over at 0 -- so with ``return_type="dataframe"``, the rows of the
+    concatenated chunks are numbered ``0, 1, 2, ...`` exactly as if the whole
+    data set had been passed to :func:`build_design_matrices` at once, and
+    the index still reveals which rows were dropped due to NAs.
+
+    .. versionadded:: 0.5.0
+    """
+    if isinstance(NA_action, str):
+        NA_action = NAAction(NA_action)
+    _check_build_options(return_type, order)
+    _check_out_option(design_infos, return_type, out)
+    pool = _make_pool(n_jobs)
+    try:
+        rows_seen = 0
+        for data in data_iter:
+            (factor_info_to_values, rows, num_rows, pandas_index,
+             chunk_rows) = _eval_design_data(design_infos, data, NA_action,
+                                             return_type, dtype,
+                                             index_start=rows_seen,
+                                             pool=pool, eval_cache=eval_cache)
+            rows_seen += chunk_rows
+            yield _build_design_matrices_from_values(design_infos,
+                                                     factor_info_to_values,
+                                                     rows, num_rows,
+                                                     pandas_index,
+                                                     return_type, dtype,
+                                                     order, out, pool=pool)
+    finally:
+        _close_pool(pool)
+
 # It should be possible to do just the factors -> factor_infos stuff
 # alone, since that, well, makes logical sense to do.
@@ -13,11 +13,11 @@ __all__ = ["I", "Q"]
 from patsy.contrasts import ContrastMatrix, Treatment, Poly, Sum, Helmert, Diff
 __all__ += ["ContrastMatrix", "Treatment", "Poly", "Sum", "Helmert", "Diff"]
 
-from patsy.categorical import C
-__all__ += ["C"]
+from patsy.categorical import C, H
+__all__ += ["C", "H"]
 
-from patsy.state import center, standardize, scale
-__all__ += ["center", "standardize", "scale"]
+from patsy.state import center, standardize, scale, lump
+__all__ += ["center", "standardize", "scale", "lump"]
 
 from patsy.splines import bs
 __all__ += ["bs"]
@@ -0,0 +1,349 @@
+# This file is part of Patsy
+# Copyright (C) 2016 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# Caching evaluated factors across calls to build_design_matrices and
+# friends.
+#
+# When the same data is run through many similar formulas (e.g. in a model
+# selection loop), the same factors get evaluated over and over again. A
+# FactorEvalCache remembers the results. The tricky part is the cache key:
+# each call memorizes its own copies of all the stateful transforms, so we
+# can't just use the identity of the factor state; instead we compute a
+# "fingerprint" of its contents, that compares equal whenever two states are
+# equal (and the rare things we can't fingerprint fall back on identity, which
+# just means a cache miss). The data is keyed by identity, and each cache
+# entry holds a reference to it, so that its id() can't be reused while the
+# entry exists.
+
+import sys
+import types
+import hashlib
+import numpy as np
+import six
+from patsy.util import LRUCache, no_pickling, assert_no_pickling
+from patsy.missing import NAAction
+from patsy.eval import EvalEnvironment
+
+# These are made available in the patsy.* namespace
+__all__ = ["FactorEvalCache"]
+
+class _Identity(object):
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and self.obj is other.obj
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __repr__(self):
+        return "_Identity(<%s object at 0x%x>)" % (type(self.obj).__name__,
+                                                  id(self.obj))
+
+_ATOMIC_TYPES = (bool, float, complex, six.binary_type,
+                 six.text_type) + six.integer_types
+_IDENTITY_TYPES = (type, types.ModuleType, types.FunctionType,
+                   types.BuiltinFunctionType, types.MethodType)
+
+# The bytes that make up an array's values. x87 extended precision floats
+# (np.longdouble on x86, which Center uses for its running sums) only use 10
+# bytes of their 12 or 16, and the rest is uninitialized padding that we have
+# to skip.
+def _array_bytes(arr):
+    arr = np.ascontiguousarray(arr)
+    if (arr.dtype.kind in "fc"
+        and np.finfo(arr.dtype).nmant == 63
+        and arr.dtype.itemsize > 10):
+        part_size = arr.dtype.itemsize
+        if arr.dtype.kind == "c":
+            part_size //= 2
+        return arr.view(np.uint8).reshape((-1, part_size))[:, :10].tobytes()
+    return arr.tobytes()
+
+def test__array_bytes():
+    assert _array_bytes(np.array([1, 2], dtype="<i4")) == b"\x01\0\0\0\x02\0\0\0"
+    for dtype in [np.longdouble, np.clongdouble]:
+        a = np.ones(3, dtype=dtype)
+        b = np.empty(3, dtype=dtype)
+        b.view(np.uint8)[...] = 0xff
+        b[...] = 1
+        assert _array_bytes(a) == _array_bytes(b)
+        b[1] = 2
+        assert _array_bytes(a) != _array_bytes(b)
+
+def _fingerprint(obj, _active=None):
+    if obj is None or isinstance(obj, _ATOMIC_TYPES):
+        return (type(obj), obj)
+    if _active is None:
+        _active = set()
+    if id(obj) in _active:
+        # reference cycle
+        return _Identity(obj)
+    _active.add(id(obj))
+    try:
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject:
+                return (np.ndarray, obj.shape,
+                        tuple([_fingerprint(x, _active)
+                               for x in obj.ravel()]))
+            digest = hashlib.sha1(_array_bytes(obj))
+            return (np.ndarray, obj.dtype.str, obj.shape, digest.hexdigest())
+        if isinstance(obj, EvalEnvironment):
+            # EvalFactor gives each state its own copy of the (relevant
+            # part of the) environment, so these must be compared by value
+            # too.
+            return (EvalEnvironment, obj.flags,
+                    tuple([_fingerprint(namespace, _active)
+                           for namespace in obj._namespaces]))
+        if isinstance(obj, np.generic):
+            return (type(obj), _array_bytes(np.asarray(obj)))
+        if isinstance(obj, dict):
+            items = [(_fingerprint(key, _active), _fingerprint(value, _active))
+                     for key, value in six.iteritems(obj)]
+            items.sort(key=lambda item: repr(item[0]))
+            return (dict, tuple(items))
+        if isinstance(obj, (list, tuple)):
+            return (type(obj), tuple([_fingerprint(x, _active) for x in obj]))
+        if isinstance(obj, (set, frozenset)):
+            return (type(obj), frozenset([_fingerprint(x, _active)
+                                          for x in obj]))
+        # Objects which use the default identity-based hash, but which
+        # carry their state around in their __dict__ -- like stateful
+        # transforms -- are compared by value. (But not modules, classes and
+        # functions, which are what they are.)
+        if (type(obj).__hash__ is object.__hash__
+            and hasattr(obj, "__dict__")
+            and not isinstance(obj, _IDENTITY_TYPES)):
+            return (type(obj), _fingerprint(vars(obj), _active))
+        # Otherwise, anything hashable (e.g. a function or a module)
+        # represents itself, and anything else is compared by identity.
+        try:
+            hash(obj)
+        except TypeError:
+            return _Identity(obj)
+        return obj
+    finally:
+        _active.discard(id(obj))
+
+def test__fingerprint():
+    from patsy.state import Center
+    def center_of(data):
+        c = Center()
+        c.memorize_chunk(np.asarray(data))
+        c.memorize_finish()
+        return c
+    state1 = {"transforms": {"c": center_of([1, 2, 3])},
+              "code": "center(x)", "bins": [set(["c"])]}
+    state2 = {"transforms": {"c": center_of([1, 2, 3])},
+              "code": "center(x)", "bins": [set(["c"])]}
+    state3 = {"transforms": {"c": center_of([1, 2, 4])},
+              "code": "center(x)", "bins": [set(["c"])]}
+    assert _fingerprint(state1) == _fingerprint(state2)
+    assert hash(_fingerprint(state1)) == hash(_fingerprint(state2))
+    assert _fingerprint(state1) != _fingerprint(state3)
+    assert _fingerprint(1) != _fingerprint(1.0)
+    assert _fingerprint(np.array([1, 2])) != _fingerprint(np.array([1.0, 2]))
+    assert _fingerprint(np.array([1, 2])) == _fingerprint(np.array([1, 2]))
+    obj_arr = np.array(["a", None], dtype=object)
+    assert _fingerprint(obj_arr) == _fingerprint(obj_arr.copy())
+    assert _fingerprint(np.float64(1)) == _fingerprint(np.float64(1))
+    env1 = EvalEnvironment([{"np": np}]).subset(["np"])
+    env2 = EvalEnvironment([{"np": np}]).subset(["np"])
+    assert _fingerprint(env1) == _fingerprint(env2)
+    assert _fingerprint(env1) != _fingerprint(EvalEnvironment([{"np": 1}]))
+    # Functions with the same (empty) __dict__ are still different
+    def f(x):
+        return x
+    def g(x):
+        return x
+    assert _fingerprint(f) == _fingerprint(f)
+    assert _fingerprint(f) != _fingerprint(g)
+    # Unhashable things are compared by identity
+    class Unhashable(object):
+        __slots__ = ()
+        __hash__ = None
+    u = Unhashable()
+    assert _fingerprint([u]) == _fingerprint([u])
+    assert _fingerprint([u]) != _fingerprint([Unhashable()])
+    # Cycles don't cause infinite recursion
+    cyclic = []
+    cyclic.append(cyclic)
+    assert _fingerprint(cyclic) == _fingerprint(cyclic)
+
+def _nbytes(obj):
+    if isinstance(obj, (tuple, list)):
+        return sum([_nbytes(x) for x in obj])
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "values") and isinstance(obj.values, np.ndarray):
+        # pandas objects
+        return obj.values.nbytes
+    if hasattr(obj, "data"):
+        # e.g. the return value from C()
+        return _nbytes(obj.data)
+    return sys.getsizeof(obj)
+
+class FactorEvalCache(object):
+    """A cache of evaluated factors, that can be shared between calls to
+    :func:`build_design_matrices`, :func:`dmatrix`, :func:`dmatrices`,
+    etc.
+
+    Evaluating factors like ``np.log(income)``, ``C(region)`` or ``bs(age,
+    df=5)`` can be a large part of the cost of building a design matrix. If
+    you build many design matrices from the same data -- for instance, when
+    trying out many different models -- then the same factors end up being
+    evaluated again and again. To avoid this, create a
+    :class:`FactorEvalCache`, and pass it as the ``eval_cache=`` argument to
+    each call::
+
+      cache = FactorEvalCache()
+      for formula in formulas:
+          y, X = dmatrices(formula, data, eval_cache=cache)
+          ...
+
+    Both the raw values of the factors and their coded values (e.g. the
+    integer codes of categorical factors) are remembered. A cached value is
+    reused when the same factor code, with the same memorized state (e.g.,
+    the same knots for a spline), is evaluated on the same data object. Note
+    that data objects are recognized by identity, so if you modify your
+    data in place, you must call :meth:`clear` before using the cache
+    again.
+
+    :arg max_bytes: The maximum total size of the cached values. When the
+      cache is full, the least recently used values are discarded.
+
+    The attributes ``hits`` and ``misses`` count how many lookups were
+    satisfied from the cache, and how many had to be computed.
+
+    .. versionadded:: 0.5.0
+    """
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUCache(max_bytes)
+        self._fingerprints = LRUCache(1000)
+
+    @property
+    def nbytes(self):
+        """The total size of the values currently in the cache."""
+        return self._cache.size
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        """Discard all cached values."""
+        self._cache.clear()
+        self._fingerprints.clear()
+
+    # Fingerprinting a factor's state can be expensive (it hashes every
+    # array in the state, including any captured from the environment), but
+    # states don't change once they've been memorized, so we only do it once
+    # for each state object. Remembered objects are kept alive, so that
+    # their ids can't be reused.
+    def _fingerprint_of(self, obj):
+        entry = self._fingerprints.get(id(obj))
+        if entry is not None and entry[0] is obj:
+            return entry[1]
+        fingerprint = _fingerprint(obj)
+        self._fingerprints.put(id(obj), (obj, fingerprint))
+        return fingerprint
+
+    def _lookup(self, key, data, compute):
+        key = key + (id(data),)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] is data:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        self._cache.put(key, (data, value), _nbytes(value))
+        return value
+
+    # The raw value of a factor, i.e. factor.eval(state, data)
+    def _eval_raw(self, factor, state, data, compute=None):
+        if compute is None:
+            compute = lambda: factor.eval(state, data)
+        return self._lookup(("raw", factor, self._fingerprint_of(state)),
+                            data,
+                            compute)
+
+    # The coded value of a factor, as computed by 'compute'
+    def _eval_coded(self, factor_info, NA_action, data, compute):
+        if isinstance(NA_action, NAAction):
+            NA_key = (type(NA_action), NA_action.NA_types)
+        else:
+            NA_key = _Identity(NA_action)
+        key = ("coded", factor_info.factor,
+               self._fingerprint_of(factor_info.state),
+               factor_info.type, factor_info.num_columns,
+               self._fingerprint_of(factor_info.categories), NA_key)
+        return self._lookup(key, data, compute)
+
+    __getstate__ = no_pickling
+
+def test_FactorEvalCache():
+    class CountingFactor(object):
+        calls = 0
+        def eval(self, state, data):
+            self.calls += 1
+            return np.asarray(data["x"]) * state["scale"]
+    factor = CountingFactor()
+    data = {"x": np.arange(100.0)}
+    other_data = {"x": np.arange(100.0)}
+    cache = FactorEvalCache()
+    assert_no_pickling(cache)
+    first = cache._eval_raw(factor, {"scale": 2}, data)
+    assert np.array_equal(first, np.arange(100.0) * 2)
+    assert cache._eval_raw(factor, {"scale": 2}, data) is first
+    assert factor.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache) == 1
+    assert cache.nbytes == first.nbytes
+    # Different state or different data is a miss
+    cache._eval_raw(factor, {"scale": 3}, data)
+    cache._eval_raw(factor, {"scale": 2}, other_data)
+    assert factor.calls == 3
+    cache.clear()
+    assert len(cache) == 0
+    cache._eval_raw(factor, {"scale": 2}, data)
+    assert factor.calls == 4
+
+    # Each state is only fingerprinted once
+    class CountingState(dict):
+        fingerprints = 0
+        def items(self):
+            CountingState.fingerprints += 1
+            return dict.items(self)
+        def iteritems(self):
+            CountingState.fingerprints += 1
+            return dict.iteritems(self)
+    state = CountingState(scale=5)
+    for i in range(3):
+        cache._eval_raw(factor, state, data)
+        cache._eval_raw(factor, state, other_data)
+    assert CountingState.fingerprints == 1
+    assert factor.calls == 6
+    # ... but equal states are still recognized as the same
+    cache._eval_raw(factor, CountingState(scale=5), data)
+    assert CountingState.fingerprints == 2
+    assert factor.calls == 6
+
+    # Least recently used values get evicted
+    small = FactorEvalCache(max_bytes=2 * first.nbytes)
+    for scale in [1, 2, 3]:
+        small._eval_raw(factor, {"scale": scale}, data)
+    assert len(small) == 2
+    calls = factor.calls
+    small._eval_raw(factor, {"scale": 3}, data)
+    assert factor.calls == calls
+    small._eval_raw(factor, {"scale": 1}, data)
+    assert factor.calls == calls + 1
@@ -2,7 +2,7 @@
 # Copyright (C) 2011-2013 Nathaniel Smith <njs@pobox.com>
 # See file LICENSE.txt for license information.
 
-__all__ = ["C", "guess_categorical", "CategoricalSniffer",
+__all__ = ["C", "H", "guess_categorical", "CategoricalSniffer",
            "categorical_to_int"]
 
 # How we handle categorical data: the big picture
@@ -33,6 +33,7 @@ __all__ = ["C", "guess_categorical", "CategoricalSniffer",
 # provides a set of plain old functions which are used by patsy.build to
 # handle the different stages of categorical data munging.
 
+import zlib
 import numpy as np
 import six
 from patsy import PatsyError
@@ -47,6 +48,7 @@ from patsy.util import (SortAnythingKey,
                         pandas_Categorical_codes,
                         safe_issubdtype,
                         no_pickling, assert_no_pickling)
+from patsy.contrasts import _IndicatorContrastMatrix
 
 if have_pandas:
     import pandas
@@ -93,6 +95,12 @@ def C(data, contrast=None, levels=None):
         :ref:`categorical-coding` for more details.
       * A callable that returns one of the above.
     """
+    if isinstance(data, _HashedBox):
+        if levels is not None:
+            raise PatsyError("can't set the levels of hashed data")
+        if contrast is None:
+            contrast = data.contrast
+        return _HashedBox(data.data, contrast, data.n_buckets)
     if isinstance(data, _CategoricalBox):
         if contrast is None:
             contrast = data.contrast
@@ -122,6 +130,125 @@ def test_C():
 
     assert_no_pickling(c4)
 
+# The levels of hashed data: the integers 0, ..., n_buckets - 1. There can
+# be a great many of them, so building this tuple (and anything derived from
+# it, like the column names) is only done once per design; everything that
+# codes data just compares n_buckets.
+class _HashedLevels(tuple):
+    def __new__(cls, n_buckets):
+        self = tuple.__new__(cls, range(n_buckets))
+        self.n_buckets = n_buckets
+        return self
+
+# Like _CategoricalBox, but the levels are the integers 0, ..., n_buckets - 1,
+# and the data still needs to be hashed to get them.
+class _HashedBox(_CategoricalBox):
+    def __init__(self, data, contrast, n_buckets):
+        self.data = data
+        self.contrast = contrast
+        self.n_buckets = n_buckets
+
+    # Only built if someone asks for it.
+    @property
+    def levels(self):
+        return _HashedLevels(self.n_buckets)
+
+def H(data, n_buckets=2 ** 18):
+    """
+    Marks some `data` as being categorical, to be coded using the "hashing
+    trick".
+
+    Each value is assigned to one of `n_buckets` levels by hashing it, and
+    the factor is then coded with one indicator column per level. This is
+    useful for categorical data with a huge or unknown number of distinct
+    values (like user IDs or URLs): no pass over the data is needed to find
+    out what the levels are, and the number of columns is known in advance::
+
+      dmatrix("H(user_id, n_buckets=2 ** 20)", data, return_type="sparse")
+
+    Different values will sometimes end up in the same bucket, and the
+    indicator columns are not reduced to avoid redundancy with the intercept.
+    Because most of these columns are zero in any given row, you will almost
+    always want to use ``return_type="sparse"``.
+
+    Values are hashed via their string representation (using the full
+    precision ``repr()`` for floats), so the result is the same across Python
+    sessions and versions. Missing values are detected as usual before
+    hashing (see :class:`NAAction`).
+
+    .. versionadded:: 0.5.0
+    """
+    if (not isinstance(n_buckets, six.integer_types + (np.integer,))
+        or n_buckets < 1):
+        raise PatsyError("n_buckets must be a positive integer, not %r"
+                         % (n_buckets,))
+    return _HashedBox(data, _HashedCoding(), int(n_buckets))
+
+# Hashed factors are always coded as full-rank indicators, since there's no
+# meaningful level to use as a reference.
+class _HashedCoding(object):
+    def code_with_intercept(self, levels):
+        # (levels are always range(n_buckets))
+        return _IndicatorContrastMatrix(np.arange(len(levels)),
+                                        ["[%s]" % (level,)
+                                         for level in levels])
+
+    code_without_intercept = code_with_intercept
+
+    __getstate__ = no_pickling
+
+# Stable across Python sessions (unlike hash(), which is randomized for
+# strings on py3).
+def _hash_bucket(value, n_buckets):
+    if isinstance(value, (float, np.floating)):
+        # str() rounds floats to 12 significant digits on py2, but repr() of
+        # a Python float is the shortest round-tripping form everywhere
+        value = repr(float(value))
+    elif isinstance(value, (complex, np.complexfloating)):
+        value = repr(complex(value))
+    if not isinstance(value, six.binary_type):
+        value = six.text_type(value).encode("utf-8")
+    return (zlib.crc32(value) & 0xffffffff) % n_buckets
+
+def test_H():
+    from nose.tools import assert_raises
+    h = H(["a", "b"], n_buckets=10)
+    assert isinstance(h, _HashedBox)
+    assert isinstance(h.levels, _HashedLevels)
+    assert h.levels.n_buckets == 10
+    assert h.data == ["a", "b"]
+    assert tuple(h.levels) == tuple(range(10))
+    assert h.n_buckets == 10
+    h2 = C(h, "CONTRAST")
+    assert isinstance(h2, _HashedBox)
+    assert h2.contrast == "CONTRAST"
+    assert h2.n_buckets == 10
+    assert isinstance(C(h).contrast, _HashedCoding)
+    assert_raises(PatsyError, C, h, levels=[1, 2])
+    assert_raises(PatsyError, H, [1], n_buckets=0)
+    assert_raises(PatsyError, H, [1], n_buckets=1.5)
+
+    coded = _HashedCoding().code_without_intercept(range(3))
+    assert np.array_equal(coded.matrix, np.eye(3))
+    assert coded.column_suffixes == ["[0]", "[1]", "[2]"]
+
+    # These values are fixed, whatever the Python version or session
+    assert _hash_bucket("a", 2 ** 32) == 0xe8b7be43
+    assert _hash_bucket(six.u("a"), 10) == _hash_bucket(b"a", 10)
+    assert _hash_bucket(1, 2 ** 32) == _hash_bucket("1", 2 ** 32)
+    assert _hash_bucket(2.5, 2 ** 32) == _hash_bucket("2.5", 2 ** 32)
+    assert _hash_bucket(np.float64(2.5), 10) == _hash_bucket(2.5, 10)
+    # Floats are hashed at full precision (py2's str() would round this to
+    # 0.1, and so collide with it)
+    assert (_hash_bucket(0.1000000000000001, 2 ** 32)
+            == _hash_bucket("0.1000000000000001", 2 ** 32))
+    assert (_hash_bucket(0.1000000000000001, 2 ** 32)
+            != _hash_bucket(0.1, 2 ** 32))
+    for value in ["a", 1, 2.5, None, ("x", 1)]:
+        assert 0 <= _hash_bucket(value, 7) < 7
+
+    assert_no_pickling(h)
+
 def guess_categorical(data):
     if safe_is_pandas_categorical(data):
         return True
@@ -162,6 +289,43 @@ def _categorical_shape_fix(data):
         data = [data]
     return data
 
+# Returns an iterable containing every distinct value in 'data' at least once
+# (but possibly more than once). For arrays this is computed in bulk, which is
+# much faster than iterating over every entry.
+def _distinct_values(data):
+    if not (hasattr(data, "dtype") and data.dtype.kind in "iufUSO"):
+        return data
+    data = np.asarray(data)
+    factorized = _factorize(data)
+    if factorized is None:
+        return data
+    codes, uniques = factorized
+    if data.dtype.kind == "O":
+        # Any True or False objects in the data would be hidden by values
+        # that compare equal to them (like 1 and 0), but the caller needs to
+        # see them.
+        for value in uniques:
+            try:
+                if value in (True, False):
+                    return data
+            except Exception:
+                pass
+    # pandas considers None and NaN to be missing, but our NA_action might
+    # not, so those entries have to be returned as is.
+    return uniques + list(data[codes == -1])
+
+def test__distinct_values():
+    def t(data, expected):
+        got = _distinct_values(data)
+        assert set(got) == set(expected)
+    t(["b", "a", "b"], ["a", "b"])
+    t(np.asarray(["b", "a", "b"]), ["a", "b"])
+    t(np.asarray([3, 1, 3]), [1, 3])
+    t(np.asarray(["b", None, "b"], dtype=object), ["b", None])
+    assert True in _distinct_values(np.asarray([1, True, 2], dtype=object))
+    if have_pandas:
+        t(pandas.Series([1.5, 2.5, 1.5]), [1.5, 2.5])
+
 class CategoricalSniffer(object):
     def __init__(self, NA_action, origin=None):
         self._NA_action = NA_action
@@ -173,14 +337,23 @@ class CategoricalSniffer(object):
     def levels_contrast(self):
         if self._levels is None:
             levels = list(self._level_set)
-            levels.sort(key=SortAnythingKey)
-            self._levels = levels
-        return tuple(self._levels), self._contrast
+            # SortAnythingKey only differs from the default ordering when the
+            # default ordering raises an error, and it's much slower, so
+            # only use it when necessary.
+            try:
+                levels.sort()
+            except TypeError:
+                levels.sort(key=SortAnythingKey)
+            self._levels = tuple(levels)
+        return self._levels, self._contrast
 
     def sniff(self, data):
         if hasattr(data, "contrast"):
             self._contrast = data.contrast
         # returns a bool: are we confident that we found all the levels?
+        if isinstance(data, _HashedBox):
+            self._levels = _HashedLevels(data.n_buckets)
+            return True
         if isinstance(data, _CategoricalBox):
             if data.levels is not None:
                 self._levels = tuple(data.levels)
@@ -201,8 +374,10 @@ class CategoricalSniffer(object):
 
         data = _categorical_shape_fix(data)
 
-        for value in data:
-            if self._NA_action.is_categorical_NA(value):
+        values = _distinct_values(data)
+        is_NA = _is_categorical_NA_array(self._NA_action, values)
+        for value, value_is_NA in zip(values, is_NA):
+            if value_is_NA:
                 continue
             if value is True or value is False:
                 self._level_set.update([True, False])
@@ -291,10 +466,30 @@ def test_CategoricalSniffer():
     # no box
     t([], [[10, 30], [20]], False, (10, 20, 30))
     t([], [["b", "a"], ["a"]], False, ("a", "b"))
+    # arrays
+    t([], [np.asarray(["b", "a", "b"]), np.asarray(["c"])], False,
+      ("a", "b", "c"))
+    t([], [np.asarray([3, 1, 3]), np.asarray([2.5])], False, (1, 2.5, 3))
+    t(["None", "NaN"], [np.asarray(["b", None, np.nan, "a"], dtype=object)],
+      False, ("a", "b"))
+    sniffer = CategoricalSniffer(NAAction(NA_types=["NaN"]))
+    sniffer.sniff(np.asarray([1, np.nan, None, 1], dtype=object))
+    levels, _ = sniffer.levels_contrast()
+    assert set(levels) == set([None, 1])
+    t([], [np.asarray([0, 1, True], dtype=object)], True, (False, True))
 
     # 0d
     t([], ["b"], False, ("b",))
 
+    # hashed data keeps its levels' n_buckets
+    sniffer = CategoricalSniffer(NAAction())
+    assert sniffer.sniff(H(["a"], n_buckets=5))
+    levels, contrast = sniffer.levels_contrast()
+    assert isinstance(levels, _HashedLevels)
+    assert levels == (0, 1, 2, 3, 4)
+    assert levels.n_buckets == 5
+    assert isinstance(contrast, _HashedCoding)
+
     from nose.tools import assert_raises
 
     # unhashable level error:
@@ -304,8 +499,172 @@ def test_CategoricalSniffer():
     # >1d is illegal
     assert_raises(PatsyError, sniffer.sniff, np.asarray([["b"]]))
 
+# Splits a 1d array into its distinct values. Returns a tuple (codes, uniques),
+# where uniques is a list of values and data[i] == uniques[codes[i]] -- except
+# that if codes[i] == -1, then data[i] is something that pandas considers to be
+# missing, and needs to be looked at individually. Returns None if the data
+# can't be handled in bulk (e.g., because it contains unhashable objects).
+def _factorize(data):
+    if have_pandas:
+        try:
+            codes, uniques = pandas.factorize(data)
+        except TypeError:
+            return None
+        return np.asarray(codes), list(uniques)
+    if data.dtype.kind == "O":
+        # Objects may not be sortable, and without pandas we have no hash
+        # table to put them in
+        return None
+    uniques, codes = np.unique(data, return_inverse=True)
+    return codes, list(uniques)
+
+def test__factorize():
+    def t(data):
+        codes, uniques = _factorize(np.asarray(data))
+        assert len(set(uniques)) == len(uniques)
+        for value, code in zip(data, codes):
+            if code == -1:
+                assert value is None or safe_scalar_isnan(value)
+            else:
+                assert uniques[code] == value
+    t(["b", "a", "b"])
+    t([b"b", b"a", b"b"])
+    t([3, 1, 2, 1])
+    t([1.5, 2.5, 1.5])
+    t(np.asarray(["b", ("a", 1), "b"], dtype=object))
+    if have_pandas:
+        t([1.0, np.nan, 2.0])
+        t(np.asarray(["a", None, np.nan], dtype=object))
+        assert _factorize(np.asarray([{}], dtype=object)) is None
+        import patsy.categorical
+        had_pandas = patsy.categorical.have_pandas
+        try:
+            patsy.categorical.have_pandas = False
+            t(["b", "a", "b"])
+            t([1.0, 2.0, 1.0])
+            assert _factorize(np.asarray(["a"], dtype=object)) is None
+        finally:
+            patsy.categorical.have_pandas = had_pandas
+
+# Returns a boolean array saying which of 'values' (a 1-d array, or a list of
+# values that were taken from an array with the given dtype) are missing.
+# NA_action may be any object implementing the NAAction interface, and if it
+# doesn't have is_categorical_NA_array, then we check each value separately.
+def _is_categorical_NA_array(NA_action, values, dtype=None):
+    if not hasattr(NA_action, "is_categorical_NA_array"):
+        return np.asarray([NA_action.is_categorical_NA(value)
+                           for value in values], dtype=bool)
+    if not hasattr(values, "dtype"):
+        if dtype is not None and dtype.kind != "O":
+            values = np.asarray(values, dtype=dtype)
+        else:
+            # np.asarray would turn e.g. a list of tuples into a 2-d array
+            array = np.empty(len(values), dtype=object)
+            for i, value in enumerate(values):
+                array[i] = value
+            values = array
+    return NA_action.is_categorical_NA_array(values)
+
+def test__is_categorical_NA_array():
+    from patsy.missing import NAAction
+    class ScalarOnlyNAAction(object):
+        def is_categorical_NA(self, obj):
+            return obj == "x"
+    def t(values, dtype, NA_action, expected):
+        got = _is_categorical_NA_array(NA_action, values, dtype)
+        assert got.dtype == np.dtype(bool)
+        assert list(got) == expected
+    t(["a", "x", None], None, ScalarOnlyNAAction(), [False, True, False])
+    t(["a", "x", None], None, NAAction(), [False, False, True])
+    t([(1, 2), None, (3, 4)], None, NAAction(), [False, True, False])
+    t([1.0, np.nan], np.dtype(float), NAAction(), [False, True])
+    t(["a", "nan"], np.dtype("U3"), NAAction(), [False, True])
+    t(np.asarray(["a", None], dtype=object), None, NAAction(),
+      [False, True])
+    t([], None, NAAction(), [])
+
+# The equivalent of the item-by-item loop in categorical_to_int, but where the
+# NA checking and level lookup is done once per distinct value, instead of
+# once per observation. Returns None if the data can't be handled this way, or
+# if it contains something surprising (e.g., an unknown level); the caller
+# then falls back on the item-by-item loop, which takes care of reporting
+# errors.
+def _categorical_to_int_bulk(data, level_to_int, NA_action):
+    data = np.asarray(data)
+    factorized = _factorize(data)
+    if factorized is None:
+        return None
+    codes, uniques = factorized
+    uniques_NA = _is_categorical_NA_array(NA_action, uniques, data.dtype)
+    others = np.flatnonzero(codes == -1)
+    others_NA = _is_categorical_NA_array(NA_action, data[others])
+    try:
+        unique_ints = np.asarray([-1 if is_NA else level_to_int[value]
+                                  for value, is_NA in zip(uniques, uniques_NA)]
+                                 + [-1], dtype=int)
+        # codes of -1 pick out the extra entry on the end
+        out = unique_ints[codes]
+        for i, is_NA in zip(others, others_NA):
+            if not is_NA:
+                out[i] = level_to_int[data[i]]
+    except (KeyError, TypeError):
+        return None
+    return out
+
+def test__categorical_to_int_bulk():
+    from patsy.missing import NAAction
+    level_to_int = {"a": 0, "b": 1, None: 2}
+    def t(data, NA_action, expected):
+        got = _categorical_to_int_bulk(data, level_to_int, NA_action)
+        if expected is None:
+            assert got is None
+        else:
+            assert np.array_equal(got, expected)
+    t(np.asarray(["b", "a", "b"]), NAAction(), [1, 0, 1])
+    t(np.asarray(["b", "a", None], dtype=object), NAAction(), [1, 0, -1])
+    t(np.asarray(["b", "a", None], dtype=object), NAAction(NA_types=[]),
+      [1, 0, 2])
+    # unknown levels are left for the caller to report
+    t(np.asarray(["b", "c"]), NAAction(), None)
+    t(np.asarray(["b", np.nan], dtype=object), NAAction(NA_types=[]), None)
+    t(np.asarray(["b", {}], dtype=object), NAAction(), None)
+    t(np.asarray([1.0, np.nan]), NAAction(), None)
+    level_to_int = {1: 0, 2: 1}
+    t(np.asarray([1.0, np.nan, 2.0]), NAAction(), [0, -1, 1])
+    t(np.asarray([2, 1, 2]), NAAction(), [1, 0, 1])
+
+# The categorical_to_int for hashed data -- the code for each value is its
+# bucket.
+def _hashed_to_int(box, NA_action):
+    data = _categorical_shape_fix(box.data)
+    def values_to_ints(values, dtype=None):
+        is_NA = _is_categorical_NA_array(NA_action, values, dtype)
+        return np.asarray([-1 if value_is_NA
+                           else _hash_bucket(value, box.n_buckets)
+                           for value, value_is_NA in zip(values, is_NA)],
+                          dtype=int)
+    factorized = None
+    if hasattr(data, "dtype") and data.dtype.kind in "biufUSO":
+        factorized = _factorize(np.asarray(data))
+    if factorized is None:
+        out = values_to_ints(data)
+    else:
+        codes, uniques = factorized
+        # codes of -1 pick out the extra entry on the end
+        out = np.append(values_to_ints(uniques, data.dtype), -1)[codes]
+        others = np.flatnonzero(codes == -1)
+        out[others] = values_to_ints(np.asarray(data)[others])
+    if have_pandas and isinstance(data, pandas.Series):
+        out = pandas.Series(out, index=data.index)
+    return out
+
 # returns either a 1d ndarray or a pandas.Series
-def categorical_to_int(data, levels, NA_action, origin=None):
+#
+# If the caller codes a lot of data with the same levels, then they can pass
+# in level_to_int (a dict mapping each level to its index in 'levels') to save
+# us from rebuilding it on every call.
+def categorical_to_int(data, levels, NA_action, origin=None,
+                       level_to_int=None):
     assert isinstance(levels, tuple)
     # In this function, missing values are always mapped to -1
 
@@ -318,6 +677,19 @@ def categorical_to_int(data, levels, NA_action, origin=None):
         # second-guess its NA detection, so we can just pass it back.
         return pandas_Categorical_codes(data)
 
+    if isinstance(data, _HashedBox):
+        # Comparing n_buckets is much quicker than comparing the levels
+        # themselves, when we know that they're hashed levels.
+        if isinstance(levels, _HashedLevels):
+            matches = (levels.n_buckets == data.n_buckets)
+        else:
+            matches = (levels == tuple(range(data.n_buckets)))
+        if not matches:
+            raise PatsyError("mismatching levels: expected %s levels, got "
+                             "data hashed into %s buckets"
+                             % (len(levels), data.n_buckets), origin)
+        return _hashed_to_int(data, NA_action)
+
     if isinstance(data, _CategoricalBox):
         if data.levels is not None and tuple(data.levels) != levels:
             raise PatsyError("mismatching levels: expected %r, got %r"
@@ -326,44 +698,53 @@ def categorical_to_int(data, levels, NA_action, origin=None):
 
     data = _categorical_shape_fix(data)
 
-    try:
-        level_to_int = dict(zip(levels, range(len(levels))))
-    except TypeError:
-        raise PatsyError("Error interpreting categorical data: "
-                         "all items must be hashable", origin)
+    if level_to_int is None:
+        try:
+            level_to_int = dict(zip(levels, range(len(levels))))
+        except TypeError:
+            raise PatsyError("Error interpreting categorical data: "
+                             "all items must be hashable", origin)
 
     # fastpath to avoid doing an item-by-item iteration over boolean arrays,
     # as requested by #44
     if hasattr(data, "dtype") and safe_issubdtype(data.dtype, np.bool_):
         if level_to_int[False] == 0 and level_to_int[True] == 1:
             return data.astype(np.int_)
-    out = np.empty(len(data), dtype=int)
-    for i, value in enumerate(data):
-        if NA_action.is_categorical_NA(value):
-            out[i] = -1
-        else:
-            try:
-                out[i] = level_to_int[value]
-            except KeyError:
-                SHOW_LEVELS = 4
-                level_strs = []
-                if len(levels) <= SHOW_LEVELS:
-                    level_strs += [repr(level) for level in levels]
-                else:
-                    level_strs += [repr(level)
-                                   for level in levels[:SHOW_LEVELS//2]]
-                    level_strs.append("...")
-                    level_strs += [repr(level)
-                                   for level in levels[-SHOW_LEVELS//2:]]
-                level_str = "[%s]" % (", ".join(level_strs))
-                raise PatsyError("Error converting data to categorical: "
-                                 "observation with value %r does not match "
-                                 "any of the expected levels (expected: %s)"
-                                 % (value, level_str), origin)
-            except TypeError:
-                raise PatsyError("Error converting data to categorical: "
-                                 "encountered unhashable value %r"
-                                 % (value,), origin)
+    # For arrays, try to avoid the item-by-item iteration below, which is
+    # very slow on big data.
+    out = None
+    if hasattr(data, "dtype") and data.dtype.kind in "biufUSO":
+        out = _categorical_to_int_bulk(data, level_to_int, NA_action)
+    if out is None:
+        out = np.empty(len(data), dtype=int)
+        is_NA = _is_categorical_NA_array(NA_action, data)
+        for i, value in enumerate(data):
+            if is_NA[i]:
+                out[i] = -1
+            else:
+                try:
+                    out[i] = level_to_int[value]
+                except KeyError:
+                    SHOW_LEVELS = 4
+                    level_strs = []
+                    if len(levels) <= SHOW_LEVELS:
+                        level_strs += [repr(level) for level in levels]
+                    else:
+                        level_strs += [repr(level)
+                                       for level in levels[:SHOW_LEVELS//2]]
+                        level_strs.append("...")
+                        level_strs += [repr(level)
+                                       for level in levels[-SHOW_LEVELS//2:]]
+                    level_str = "[%s]" % (", ".join(level_strs))
+                    raise PatsyError("Error converting data to categorical: "
+                                     "observation with value %r does not "
+                                     "match any of the expected levels "
+                                     "(expected: %s)"
+                                     % (value, level_str), origin)
+                except TypeError:
+                    raise PatsyError("Error converting data to categorical: "
+                                     "encountered unhashable value %r"
+                                     % (value,), origin)
     if have_pandas and isinstance(data, pandas.Series):
         out = pandas.Series(out, index=data.index)
     return out
@@ -411,6 +792,10 @@ def test_categorical_to_int():
     def t(data, levels, expected, NA_action=NAAction()):
         got = categorical_to_int(data, levels, NA_action)
         assert np.array_equal(got, expected)
+        level_to_int = dict(zip(levels, range(len(levels))))
+        got = categorical_to_int(data, levels, NA_action,
+                                 level_to_int=level_to_int)
+        assert np.array_equal(got, expected)
 
     t(["a", "b", "a"], ("a", "b"), [0, 1, 0])
     t(np.asarray(["a", "b", "a"]), ("a", "b"), [0, 1, 0])
@@ -443,6 +828,33 @@ def test_categorical_to_int():
                   np.asarray([["a", "b"], ["b", "a"]]),
                   ("a", "b"), NAAction())
 
+    # hashed data
+    buckets = tuple(range(1000))
+    expected = [_hash_bucket(value, 1000) for value in ["b", "a", "b"]]
+    t(H(["b", "a", "b"], 1000), buckets, expected)
+    t(H(np.asarray(["b", "a", "b"]), 1000), buckets, expected)
+    t(H(np.asarray(["b", None, np.nan, "a"], dtype=object), 1000), buckets,
+      [expected[0], -1, -1, expected[1]])
+    t(H(["b", None], 1000), buckets, [expected[0], -1])
+    t(H(["b", None], 1000), buckets,
+      [expected[0], _hash_bucket(None, 1000)], NAAction(NA_types=[]))
+    t(H("b", 1000), buckets, [expected[0]])
+    assert_raises(PatsyError, categorical_to_int,
+                  H(["a"], 1000), tuple(range(10)), NAAction())
+    assert_raises(PatsyError, categorical_to_int,
+                  H(["a"], 1000), tuple(range(1, 1001)), NAAction())
+    assert np.array_equal(
+        categorical_to_int(H(["b", "a", "b"], 1000), _HashedLevels(1000),
+                           NAAction()),
+        expected)
+    assert_raises(PatsyError, categorical_to_int,
+                  H(["a"], 1000), _HashedLevels(10), NAAction())
+    if have_pandas:
+        s = pandas.Series(["b", "a", "b"], index=[10, 20, 30])
+        c_pandas = categorical_to_int(H(s, 1000), buckets, NAAction())
+        assert np.all(c_pandas == expected)
+        assert np.all(c_pandas.index == [10, 20, 30])
+
     # levels must be hashable
     assert_raises(PatsyError, categorical_to_int,
                   ["a", "b"], ("a", "b", {}), NAAction())
@@ -455,6 +867,24 @@ def test_categorical_to_int():
       NAAction(NA_types=["None", "NaN"]))
     t(["b", None, np.nan, "a"], ("a", "b", None), [1, 2, -1, 0],
       NAAction(NA_types=["NaN"]))
+    # same again, but as arrays (which take a different code path)
+    obj_arr = np.asarray(["b", None, np.nan, "a"], dtype=object)
+    t(obj_arr, ("a", "b"), [1, -1, -1, 0],
+      NAAction(NA_types=["None", "NaN"]))
+    t(obj_arr, ("a", "b", None), [1, 2, -1, 0], NAAction(NA_types=["NaN"]))
+    assert_raises(PatsyError, categorical_to_int,
+                  obj_arr, ("a", "b", None), NAAction(NA_types=["None"]))
+    t(np.asarray([2.0, np.nan, 1.0]), (1, 2), [1, -1, 0])
+    assert_raises(PatsyError, categorical_to_int,
+                  np.asarray([2.0, np.nan, 1.0]), (1, 2),
+                  NAAction(NA_types=[]))
+    assert_raises(PatsyError, categorical_to_int,
+                  np.asarray(["a", "b", "q"]), ("a", "b"), NAAction())
+    if have_pandas:
+        s = pandas.Series([20, 10, 20], index=[1, 2, 3])
+        c_pandas = categorical_to_int(s, (10, 20), NAAction())
+        assert np.all(c_pandas == [1, 0, 1])
+        assert np.all(c_pandas.index == [1, 2, 3])
 
     # Smoke test for the branch that formats the ellipsized list of levels in
     # the error message:
@@ -47,12 +47,41 @@ class ContrastMatrix(object):
     def _repr_pretty_(self, p, cycle):
         repr_pretty_impl(p, self, [self.matrix, self.column_suffixes])
 
+    # Returns (number of levels, number of columns). Used by the builder,
+    # which shouldn't assume that .matrix is cheap to access.
+    def _shape(self):
+        return self.matrix.shape
+
+    # Returns a 2d array of the given dtype, with one row of the matrix for
+    # each entry in 'codes' (an array of level indices).
+    def _rows(self, codes, dtype):
+        return self.matrix.astype(dtype, copy=False)[codes, :]
+
+    # Like _rows, but returns a scipy.sparse CSR matrix. ('sparse' is the
+    # scipy.sparse module, which we don't import ourselves.)
+    def _sparse_rows(self, codes, dtype, sparse):
+        codes = np.asarray(codes)
+        num_levels, num_columns = self._shape()
+        indicators = sparse.csr_matrix(
+            (np.ones(len(codes), dtype=dtype), (np.arange(len(codes)), codes)),
+            shape=(len(codes), num_levels))
+        return indicators * sparse.csr_matrix(np.asarray(self.matrix,
+                                                         dtype=dtype))
+
     __getstate__ = no_pickling
 
 def test_ContrastMatrix():
     cm = ContrastMatrix([[1, 0], [0, 1]], ["a", "b"])
     assert np.array_equal(cm.matrix, np.eye(2))
     assert cm.column_suffixes == ["a", "b"]
+    assert cm._shape() == (2, 2)
+    rows = cm._rows(np.array([1, 1, 0]), np.float32)
+    assert rows.dtype == np.float32
+    assert np.array_equal(rows, [[0, 1], [0, 1], [1, 0]])
+    import scipy.sparse
+    rows = cm._sparse_rows(np.array([1, 1, 0]), np.float32, scipy.sparse)
+    assert rows.dtype == np.float32
+    assert np.array_equal(rows.toarray(), [[0, 1], [0, 1], [1, 0]])
     # smoke test
     repr(cm)
 
@@ -61,6 +90,232 @@ def test_ContrastMatrix():
 
     assert_no_pickling(cm)
 
+# Base class for ContrastMatrix objects whose entries follow a simple pattern.
+# Rather than storing the matrix, they compute the rows for any given levels
+# on demand, which lets the builder skip the dense level-by-column matrix
+# (which for a factor with thousands of levels is very big) and the gather
+# from it. .matrix is still available, but is only created on request; once
+# it has been, it's used just like a plain ContrastMatrix's, since whoever
+# asked for it might have modified it (or replaced it).
+#
+# Subclasses set num_levels and column_suffixes, and define _fill(codes, out),
+# which fills the zero-initialized 'out' with the rows for 'codes'. If
+# 'intercept' is true, then an extra column of ones is added on the left.
+class _StructuredContrastMatrix(ContrastMatrix):
+    def __init__(self, num_levels, column_suffixes, intercept=False):
+        self.num_levels = num_levels
+        self.column_suffixes = column_suffixes
+        self.intercept = intercept
+        self._matrix = None
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = self._structured_rows(np.arange(self.num_levels),
+                                                 float)
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self._matrix = np.asarray(matrix)
+
+    # Are the entries still known to follow our pattern?
+    def _structured(self):
+        return self._matrix is None
+
+    def _shape(self):
+        if not self._structured():
+            return ContrastMatrix._shape(self)
+        return (self.num_levels, len(self.column_suffixes))
+
+    def _rows(self, codes, dtype):
+        if not self._structured():
+            return ContrastMatrix._rows(self, codes, dtype)
+        return self._structured_rows(codes, dtype)
+
+    # Our rows are dense anyway, unless a subclass knows better.
+    def _sparse_rows(self, codes, dtype, sparse):
+        if not self._structured():
+            return ContrastMatrix._sparse_rows(self, codes, dtype, sparse)
+        return sparse.csr_matrix(self._structured_rows(codes, dtype))
+
+    def _structured_rows(self, codes, dtype):
+        codes = np.asarray(codes)
+        out = np.zeros((len(codes), len(self.column_suffixes)), dtype=dtype)
+        if self.intercept:
+            out[:, 0] = 1
+            self._fill(codes, out[:, 1:])
+        else:
+            self._fill(codes, out)
+        return out
+
+    def _fill(self, codes, out):
+        raise NotImplementedError
+
+# Each row contains a single 1 and is otherwise 0 (or is entirely 0), as
+# produced by dummy coding. 'columns' gives the column where each row's 1
+# goes, or -1 for rows that are all 0. (The builder uses this to scatter ones
+# directly into sparse matrices.)
+class _IndicatorContrastMatrix(_StructuredContrastMatrix):
+    def __init__(self, columns, column_suffixes):
+        columns = np.asarray(columns, dtype=np.intp)
+        _StructuredContrastMatrix.__init__(self, len(columns),
+                                           column_suffixes)
+        self.columns = columns
+        if (self.columns.ndim != 1
+            or np.any(self.columns >= len(column_suffixes))
+            or np.any(self.columns < -1)):
+            raise PatsyError("columns and column_suffixes don't conform")
+
+    def _repr_pretty_(self, p, cycle):
+        repr_pretty_impl(p, self, [self.columns, self.column_suffixes])
+
+    def _fill(self, codes, out):
+        columns = self.columns[codes]
+        rows = np.flatnonzero(columns >= 0)
+        out[rows, columns[rows]] = 1
+
+    def _sparse_rows(self, codes, dtype, sparse):
+        if not self._structured():
+            return ContrastMatrix._sparse_rows(self, codes, dtype, sparse)
+        # We can place the ones directly
+        columns = self.columns[codes]
+        rows = np.flatnonzero(columns >= 0)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=dtype), (rows, columns[rows])),
+            shape=(len(columns), len(self.column_suffixes)))
+
+# Like dummy coding with one level omitted, except that the omitted level's
+# row is all -1's.
+class _SumContrastMatrix(_StructuredContrastMatrix):
+    def __init__(self, num_levels, omit_i, column_suffixes, intercept=False):
+        _StructuredContrastMatrix.__init__(self, num_levels, column_suffixes,
+                                           intercept)
+        self.omit_i = omit_i
+
+    def _repr_pretty_(self, p, cycle):
+        repr_pretty_impl(p, self, [self.num_levels, self.omit_i,
+                                   self.column_suffixes],
+                         [("intercept", self.intercept)])
+
+    def _fill(self, codes, out):
+        omitted = (codes == self.omit_i)
+        rows = np.flatnonzero(~omitted)
+        columns = codes[rows] - (codes[rows] > self.omit_i)
+        out[rows, columns] = 1
+        out[omitted, :] = -1
+
+    def _sparse_rows(self, codes, dtype, sparse):
+        if not self._structured():
+            return ContrastMatrix._sparse_rows(self, codes, dtype, sparse)
+        codes = np.asarray(codes)
+        num_columns = len(self.column_suffixes)
+        first = 1 if self.intercept else 0
+        omitted = np.flatnonzero(codes == self.omit_i)
+        kept = np.flatnonzero(codes != self.omit_i)
+        num_coded = num_columns - first
+        row_parts = [kept, np.repeat(omitted, num_coded)]
+        column_parts = [codes[kept] - (codes[kept] > self.omit_i) + first,
+                        np.tile(np.arange(first, num_columns), len(omitted))]
+        value_parts = [np.ones(len(kept)), -np.ones(len(omitted) * num_coded)]
+        if self.intercept:
+            row_parts.append(np.arange(len(codes)))
+            column_parts.append(np.zeros(len(codes), dtype=int))
+            value_parts.append(np.ones(len(codes)))
+        return sparse.csr_matrix(
+            (np.concatenate(value_parts).astype(dtype),
+             (np.concatenate(row_parts), np.concatenate(column_parts))),
+            shape=(len(codes), num_columns))
+
+# Row i has -1 in columns i, i + 1, ..., and i in column i - 1.
+class _HelmertContrastMatrix(_StructuredContrastMatrix):
+    def _repr_pretty_(self, p, cycle):
+        repr_pretty_impl(p, self, [self.num_levels, self.column_suffixes],
+                         [("intercept", self.intercept)])
+
+    def _fill(self, codes, out):
+        column_idxs = np.arange(out.shape[1])
+        out[codes[:, np.newaxis] <= column_idxs] = -1
+        rows = np.flatnonzero(codes >= 1)
+        out[rows, codes[rows] - 1] = codes[rows]
+
+# Row i, column j is (j + 1)/n, minus 1 if i <= j.
+class _DiffContrastMatrix(_StructuredContrastMatrix):
+    def _repr_pretty_(self, p, cycle):
+        repr_pretty_impl(p, self, [self.num_levels, self.column_suffixes],
+                         [("intercept", self.intercept)])
+
+    def _fill(self, codes, out):
+        column_idxs = np.arange(out.shape[1])
+        fractions = (column_idxs + 1) / float(self.num_levels)
+        np.subtract(fractions.astype(out.dtype),
+                    codes[:, np.newaxis] <= column_idxs,
+                    out=out)
+
+def test__StructuredContrastMatrix():
+    from nose.tools import assert_raises
+    def check_rows(cm, expected):
+        codes = np.array([2, 0, 2, 1, 0]) % expected.shape[0]
+        for dtype in [np.float32, np.float64]:
+            rows = cm._rows(codes, dtype)
+            assert rows.dtype == dtype
+            assert np.allclose(rows, expected[codes, :])
+        assert cm._rows(np.array([], dtype=int), float).shape == (
+            0, expected.shape[1])
+        import scipy.sparse
+        for dtype in [np.float32, np.float64]:
+            rows = cm._sparse_rows(codes, dtype, scipy.sparse)
+            assert scipy.sparse.isspmatrix_csr(rows)
+            assert rows.dtype == dtype
+            assert np.allclose(rows.toarray(), expected[codes, :])
+        assert cm._sparse_rows(np.array([], dtype=int), float,
+                               scipy.sparse).shape == (0, expected.shape[1])
+
+    def t(cm, expected):
+        assert isinstance(cm, ContrastMatrix)
+        expected = np.asarray(expected)
+        assert cm._shape() == expected.shape
+        check_rows(cm, expected)
+        assert cm._structured()
+        assert cm.matrix.dtype == float
+        assert np.array_equal(cm.matrix, expected)
+        # The matrix is only built once
+        assert cm.matrix is cm.matrix
+        # smoke test
+        repr(cm)
+        assert_no_pickling(cm)
+        # Changes to the matrix are respected
+        cm.matrix[0, :] = 7
+        expected = expected.copy()
+        expected[0, :] = 7
+        assert not cm._structured()
+        check_rows(cm, expected)
+        cm.matrix = expected[:, ::-1]
+        assert np.array_equal(cm.matrix, expected[:, ::-1])
+        check_rows(cm, expected[:, ::-1])
+
+    t(_IndicatorContrastMatrix([1, -1, 0], ["a", "b"]),
+      [[0, 1], [0, 0], [1, 0]])
+    assert_raises(PatsyError, _IndicatorContrastMatrix, [2], ["a", "b"])
+    assert_raises(PatsyError, _IndicatorContrastMatrix, [-2], ["a", "b"])
+    assert_raises(PatsyError, _IndicatorContrastMatrix, [[0]], ["a"])
+
+    t(_SumContrastMatrix(3, 1, ["a", "c"]),
+      [[1, 0], [-1, -1], [0, 1]])
+    t(_SumContrastMatrix(3, 2, ["m", "a", "b"], intercept=True),
+      [[1, 1, 0], [1, 0, 1], [1, -1, -1]])
+    t(_HelmertContrastMatrix(4, ["b", "c", "d"]),
+      [[-1, -1, -1], [1, -1, -1], [0, 2, -1], [0, 0, 3]])
+    t(_HelmertContrastMatrix(3, ["i", "b", "c"], intercept=True),
+      [[1, -1, -1], [1, 1, -1], [1, 0, 2]])
+    t(_DiffContrastMatrix(4, ["a", "b", "c"]),
+      [[-3/4., -1/2., -1/4.],
+       [1/4., -1/2., -1/4.],
+       [1/4., 1/2., -1/4.],
+       [1/4., 1/2., 3/4.]])
+    t(_DiffContrastMatrix(2, ["a", "b"], intercept=True),
+      [[1, -1/2.], [1, 1/2.]])
+
 # This always produces an object of the type that Python calls 'str' (whether
 # that be a Python 2 string-of-bytes or a Python 3 string-of-unicode). It does
 # *not* make any particular guarantees about being reversible or having other
@@ -108,7 +363,8 @@ def test__name_levels():
     assert _name_levels("a", ["b", "c"]) == ["[ab]", "[ac]"]
 
 def _dummy_code(levels):
-    return ContrastMatrix(np.eye(len(levels)), _name_levels("", levels))
+    return _IndicatorContrastMatrix(np.arange(len(levels)),
+                                    _name_levels("", levels))
 
 def _get_level(levels, level_ref):
     if level_ref in levels:
@@ -180,12 +436,13 @@ class Treatment(object):
             reference = 0
         else:
             reference = _get_level(levels, self.reference)
-        eye = np.eye(len(levels) - 1)
-        contrasts = np.vstack((eye[:reference, :],
-                                np.zeros((1, len(levels) - 1)),
-                                eye[reference:, :]))
+        # The reference level gets a row of zeros, and the others get their
+        # own column
+        columns = np.arange(len(levels)) - 1
+        columns[:reference] += 1
+        columns[reference] = -1
         names = _name_levels("T.", levels[:reference] + levels[reference + 1:])
-        return ContrastMatrix(contrasts, names)
+        return _IndicatorContrastMatrix(columns, names)
 
     __getstate__ = no_pickling
 
@@ -375,28 +632,20 @@ class Sum(object):
         else:
             return _get_level(levels, self.omit)
 
-    def _sum_contrast(self, levels):
-        n = len(levels)
+    def _sum_contrast(self, levels, intercept):
         omit_i = self._omit_i(levels)
-        eye = np.eye(n - 1)
-        out = np.empty((n, n - 1))
-        out[:omit_i, :] = eye[:omit_i, :]
-        out[omit_i, :] = -1
-        out[omit_i + 1:, :] = eye[omit_i:, :]
-        return out
+        included_levels = levels[:omit_i] + levels[omit_i + 1:]
+        column_suffixes = _name_levels("S.", included_levels)
+        if intercept:
+            column_suffixes = ["[mean]"] + column_suffixes
+        return _SumContrastMatrix(len(levels), omit_i, column_suffixes,
+                                  intercept=intercept)
 
     def code_with_intercept(self, levels):
-        contrast = self.code_without_intercept(levels)
-        matrix = np.column_stack((np.ones(len(levels)),
-                                  contrast.matrix))
-        column_suffixes = ["[mean]"] + contrast.column_suffixes
-        return ContrastMatrix(matrix, column_suffixes)
+        return self._sum_contrast(levels, True)
 
     def code_without_intercept(self, levels):
-        matrix = self._sum_contrast(levels)
-        omit_i = self._omit_i(levels)
-        included_levels = levels[:omit_i] + levels[omit_i + 1:]
-        return ContrastMatrix(matrix, _name_levels("S.", included_levels))
+        return self._sum_contrast(levels, False)
 
     __getstate__ = no_pickling
 
@@ -460,38 +709,18 @@ class Helmert(object):
 
     This is equivalent to R's `contr.helmert`.
     """
-    def _helmert_contrast(self, levels):
-        n = len(levels)
-        #http://www.ats.ucla.edu/stat/sas/webbooks/reg/chapter5/sasreg5.htm#HELMERT
-        #contr = np.eye(n - 1)
-        #int_range = np.arange(n - 1., 1, -1)
-        #denom = np.repeat(int_range, np.arange(n - 2, 0, -1))
-        #contr[np.tril_indices(n - 1, -1)] = -1. / denom
-
-        #http://www.ats.ucla.edu/stat/r/library/contrast_coding.htm#HELMERT
-        #contr = np.zeros((n - 1., n - 1))
-        #int_range = np.arange(n, 1, -1)
-        #denom = np.repeat(int_range[:-1], np.arange(n - 2, 0, -1))
-        #contr[np.diag_indices(n - 1)] = (int_range - 1.) / int_range
-        #contr[np.tril_indices(n - 1, -1)] = -1. / denom
-        #contr = np.vstack((contr, -1./int_range))
-
-        #r-like
-        contr = np.zeros((n, n - 1))
-        contr[1:][np.diag_indices(n - 1)] = np.arange(1, n)
-        contr[np.triu_indices(n - 1)] = -1
-        return contr
-
+    # The R-like version; see _HelmertContrastMatrix for the actual values.
+    # Other versions can be found at:
+    #   http://www.ats.ucla.edu/stat/sas/webbooks/reg/chapter5/sasreg5.htm#HELMERT
+    #   http://www.ats.ucla.edu/stat/r/library/contrast_coding.htm#HELMERT
     def code_with_intercept(self, levels):
-        contrast = np.column_stack((np.ones(len(levels)),
-                                    self._helmert_contrast(levels)))
         column_suffixes = _name_levels("H.", ["intercept"] + list(levels[1:]))
-        return ContrastMatrix(contrast, column_suffixes)
+        return _HelmertContrastMatrix(len(levels), column_suffixes,
+                                      intercept=True)
 
     def code_without_intercept(self, levels):
-        contrast = self._helmert_contrast(levels)
-        return ContrastMatrix(contrast,
-                              _name_levels("H.", levels[1:]))
+        return _HelmertContrastMatrix(len(levels),
+                                      _name_levels("H.", levels[1:]))
 
     __getstate__ = no_pickling
 
@@ -533,32 +762,13 @@ class Diff(object):
        # Full rank
        dmatrix("0 + C(a, Diff)", balanced(a=3))
     """
-    def _diff_contrast(self, levels):
-        nlevels = len(levels)
-        contr = np.zeros((nlevels, nlevels-1))
-        int_range = np.arange(1, nlevels)
-        upper_int = np.repeat(int_range, int_range)
-        row_i, col_i = np.triu_indices(nlevels-1)
-        # we want to iterate down the columns not across the rows
-        # it would be nice if the index functions had a row/col order arg
-        col_order = np.argsort(col_i)
-        contr[row_i[col_order],
-              col_i[col_order]] = (upper_int-nlevels)/float(nlevels)
-        lower_int = np.repeat(int_range, int_range[::-1])
-        row_i, col_i = np.tril_indices(nlevels-1)
-        # we want to iterate down the columns not across the rows
-        col_order = np.argsort(col_i)
-        contr[row_i[col_order]+1, col_i[col_order]] = lower_int/float(nlevels)
-        return contr
-
     def code_with_intercept(self, levels):
-        contrast = np.column_stack((np.ones(len(levels)),
-                                    self._diff_contrast(levels)))
-        return ContrastMatrix(contrast, _name_levels("D.", levels))
+        return _DiffContrastMatrix(len(levels), _name_levels("D.", levels),
+                                   intercept=True)
 
     def code_without_intercept(self, levels):
-        contrast = self._diff_contrast(levels)
-        return ContrastMatrix(contrast, _name_levels("D.", levels[:-1]))
+        return _DiffContrastMatrix(len(levels),
+                                   _name_levels("D.", levels[:-1]))
 
     __getstate__ = no_pickling
 
@@ -95,9 +95,25 @@ class FactorInfo(object):
             if num_columns is not None:
                 raise ValueError("For categorical factors, num_columns "
                                  "must be None")
-            categories = tuple(categories)
+            # (Tuple subclasses are kept as they are, because hashed levels
+            # carry their n_buckets around.)
+            if not isinstance(categories, tuple):
+                categories = tuple(categories)
         self.num_columns = num_columns
         self.categories = categories
+        # A dict mapping each category to its position, built once here so
+        # that coding new data doesn't have to rebuild it every time (which
+        # is slow for factors with very many categories). If the categories
+        # are unhashable, then we leave it to categorical_to_int to complain.
+        # Hashed data is coded by hashing it, so it doesn't need one.
+        self._category_to_int = None
+        if (categories is not None
+            and getattr(categories, "n_buckets", None) is None):
+            try:
+                self._category_to_int = dict(zip(categories,
+                                                 range(len(categories))))
+            except TypeError:
+                pass
 
     __repr__ = repr_pretty_delegate
     def _repr_pretty_(self, p, cycle):
@@ -139,6 +155,8 @@ def test_FactorInfo():
     assert fi2.type == "categorical"
     assert fi2.num_columns is None
     assert fi2.categories == ("z", "j")
+    assert fi2._category_to_int == {"z": 0, "j": 1}
+    assert fi1._category_to_int is None
 
     # smoke test
     repr(fi2)
@@ -269,7 +287,8 @@ class DesignInfo(object):
     """
 
     def __init__(self, column_names,
-                 factor_infos=None, term_codings=None):
+                 factor_infos=None, term_codings=None,
+                 term_name_slices=None):
         self.column_name_indexes = OrderedDict(zip(column_names,
                                                    range(len(column_names))))
 
@@ -325,25 +344,47 @@ class DesignInfo(object):
                             exp_cols *= fi.num_columns
                         else:
                             assert fi.type == "categorical"
-                            cm = subterm.contrast_matrices[factor].matrix
-                            if cm.shape[0] != len(fi.categories):
+                            cm = subterm.contrast_matrices[factor]
+                            num_levels, num_cm_columns = cm._shape()
+                            if num_levels != len(fi.categories):
                                 raise ValueError("Mismatched contrast matrix "
                                                  "for factor %r" % (factor,))
                             cat_factors.add(factor)
-                            exp_cols *= cm.shape[1]
+                            exp_cols *= num_cm_columns
                     if cat_factors != set(subterm.contrast_matrices):
                         raise ValueError("Mismatch between contrast_matrices "
                                          "and categorical factors")
                     if exp_cols != subterm.num_columns:
                         raise ValueError("Unexpected num_columns")
 
+        if term_codings is not None and term_name_slices is not None:
+            raise ValueError("term_name_slices= can't be combined with "
+                             "term_codings=")
+
         if term_codings is None:
             # Need to invent term information
             self.term_slices = None
-            # We invent one term per column, with the same name as the column
-            term_names = column_names
-            slices = [slice(i, i + 1) for i in range(len(column_names))]
-            self.term_name_slices = OrderedDict(zip(term_names, slices))
+            if term_name_slices is None:
+                # We invent one term per column, with the same name as the
+                # column
+                term_names = column_names
+                slices = [slice(i, i + 1) for i in range(len(column_names))]
+                self.term_name_slices = OrderedDict(zip(term_names, slices))
+            else:
+                self.term_name_slices = OrderedDict(term_name_slices)
+                covered = 0
+                for slice_ in six.itervalues(self.term_name_slices):
+                    if (not isinstance(slice_, slice)
+                        or slice_.step not in (None, 1)
+                        or slice_.start != covered
+                        or slice_.stop is None
+                        or slice_.stop < slice_.start):
+                        raise ValueError("term_name_slices must be slices "
+                                         "covering the columns in order")
+                    covered = slice_.stop
+                if covered != len(self.column_name_indexes):
+                    raise ValueError("mismatch between column_names and "
+                                     "columns covered by term_name_slices")
         else:
             # Need to derive term information from term_codings
             self.term_slices = OrderedDict()
@@ -759,12 +800,38 @@ def test_DesignInfo():
     # Check intercept handling in describe()
     assert DesignInfo(["Intercept", "a", "b"]).describe() == "1 + a + b"
 
+    # One with term names but without term objects
+    di = DesignInfo(["Intercept", "a[T.b]", "a[T.c]", "x"],
+                    term_name_slices=[("Intercept", slice(0, 1)),
+                                      ("a", slice(1, 3)),
+                                      ("x", slice(3, 4))])
+    assert di.term_names == ["Intercept", "a", "x"]
+    assert di.terms is None
+    assert di.term_slices is None
+    assert di.slice("a") == slice(1, 3)
+    assert di.describe() == "1 + a + x"
+    # slices have to cover the columns exactly, in order
+    for bad_slices in [[("a", slice(0, 1))],
+                       [("a", slice(0, 1)), ("b", slice(2, 3))],
+                       [("a", slice(1, 2)), ("b", slice(0, 1))],
+                       [("a", slice(0, 2, 2))],
+                       [("a", 0), ("b", 1)]]:
+        assert_raises(ValueError, DesignInfo, ["a", "b"],
+                      term_name_slices=bad_slices)
+    # and columns and terms can't disagree about shared names
+    assert_raises(ValueError, DesignInfo, ["a", "b"],
+                  term_name_slices=[("b", slice(0, 1)), ("a", slice(1, 2))])
+
     # Failure modes
     # must specify either both or neither of factor_infos and term_codings:
     assert_raises(ValueError, DesignInfo,
                   ["x1", "x2", "x3", "y"], factor_infos=factor_infos)
     assert_raises(ValueError, DesignInfo,
                   ["x1", "x2", "x3", "y"], term_codings=term_codings)
+    # term_name_slices only makes sense without term_codings
+    assert_raises(ValueError, DesignInfo,
+                  ["x1", "x2", "x3", "y"], factor_infos, term_codings,
+                  term_name_slices=[("x", slice(0, 3)), ("y", slice(3, 4))])
     # factor_infos must be a dict
     assert_raises(ValueError, DesignInfo,
                   ["x1", "x2", "x3", "y"], list(factor_infos), term_codings)
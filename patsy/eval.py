@@ -13,14 +13,17 @@
 __all__ = ["EvalEnvironment", "EvalFactor"]
 
 import sys
+import threading
 import __future__
 import inspect
 import tokenize
 import ast
 import numbers
 import six
+import numpy as np
 from patsy import PatsyError
-from patsy.util import PushbackAdapter, no_pickling, assert_no_pickling
+from patsy.util import (PushbackAdapter, no_pickling, assert_no_pickling,
+                        LRUCache)
 from patsy.tokens import (pretty_untokenize, normalize_token_spacing,
                              python_tokenize)
 from patsy.compat import call_and_wrap_exc
@@ -73,6 +76,35 @@ class VarLookupDict(object):
     __getstate__ = no_pickling
 
 
+# A dict of variables that have been looked up in advance. Any other variable
+# (e.g., one that's looked up by Q()) is found by looking in each of
+# 'namespaces' in turn, like VarLookupDict does. Variables that are in the
+# dict are found much faster, though, because Python can use its regular dict
+# lookup for them.
+class _ResolvedNamespace(dict):
+    def __init__(self, namespaces):
+        dict.__init__(self)
+        self._namespaces = namespaces
+
+    def __missing__(self, key):
+        for namespace in self._namespaces:
+            try:
+                return namespace[key]
+            except KeyError:
+                pass
+        raise KeyError(key)
+
+    __getstate__ = no_pickling
+
+def test__ResolvedNamespace():
+    ns = _ResolvedNamespace([{"a": 1}, {"a": 2, "b": 3}])
+    ns["c"] = 4
+    assert ns["a"] == 1
+    assert ns["b"] == 3
+    assert ns["c"] == 4
+    from nose.tools import assert_raises
+    assert_raises(KeyError, ns.__getitem__, "d")
+
 def test_VarLookupDict():
     d1 = {"a": 1}
     d2 = {"a": 2, "b": 3}
@@ -128,6 +160,29 @@ def test_ast_names_disallowed_nodes():
         assert_raises(PatsyError, list_ast_names, "{x: True for x in range(10)}")
         assert_raises(PatsyError, list_ast_names, "{x + 1 for x in range(10)}")
 
+# Compiling an expression can take much longer than evaluating it on a small
+# amount of data, and the same expressions tend to get evaluated over and over
+# (e.g., every time a model is used to make predictions), so we hang on to
+# the compiled code.
+_compiled_code_cache = LRUCache(1000)
+
+def _compile(expr, source_name, flags):
+    key = (expr, source_name, flags)
+    code = _compiled_code_cache.get(key)
+    if code is None:
+        code = compile(expr, source_name, "eval", flags, False)
+        _compiled_code_cache.put(key, code)
+    return code
+
+def test__compile():
+    code = _compile("a + 1", "<test>", 0)
+    assert _compile("a + 1", "<test>", 0) is code
+    assert eval(code, {}, {"a": 1}) == 2
+    assert _compile("a + 1", "<other>", 0) is not code
+    assert _compile("a + 2", "<test>", 0) is not code
+    from nose.tools import assert_raises
+    assert_raises(SyntaxError, _compile, "a +", "<test>", 0)
+
 class EvalEnvironment(object):
     """Represents a Python execution environment.
 
@@ -161,10 +216,31 @@ class EvalEnvironment(object):
           when `expr` attempts to access any variables.
         :returns: The value of `expr`.
         """
-        code = compile(expr, source_name, "eval", self.flags, False)
+        code = _compile(expr, source_name, self.flags)
+        return self._eval_compiled(code, inner_namespace)
+
+    # Like eval, but takes a code object from _compile(..., self.flags).
+    def _eval_compiled(self, code, inner_namespace):
         return eval(code, {}, VarLookupDict([inner_namespace]
                                             + self._namespaces))
 
+    # Like _eval_compiled, but rather than having Python look up each
+    # variable through a VarLookupDict as it's used, we look up all of 'names'
+    # (the names that appear in the code) before starting, and put them in a
+    # dict. This is much faster for code that uses lots of variables.
+    # inner_namespaces are checked first, in order.
+    def _eval_resolved(self, code, names, inner_namespaces):
+        namespaces = list(inner_namespaces) + self._namespaces
+        local_namespace = _ResolvedNamespace(namespaces)
+        for name in names:
+            for namespace in namespaces:
+                try:
+                    local_namespace[name] = namespace[name]
+                except KeyError:
+                    continue
+                break
+        return eval(code, {}, local_namespace)
+
     @classmethod
     def capture(cls, eval_env=0, reference=0):
         """Capture an execution environment from the stack.
@@ -356,6 +432,22 @@ def test_EvalEnvironment_eval_namespace():
     assert env3.eval("2 * a") == 2
     assert env3.eval("2 * b") == 6
 
+def test_EvalEnvironment__eval_resolved():
+    env = EvalEnvironment([{"a": 1}, {"a": 10, "b": 3}])
+    def t(expr, inner_namespaces):
+        code = _compile(expr, "<test>", env.flags)
+        return env._eval_resolved(code, tuple(set(ast_names(expr))),
+                                  inner_namespaces)
+    assert t("a + b", []) == 4
+    assert t("a + b", [{"b": 5}, {"b": 6, "a": 7}]) == 12
+    # builtins are still found
+    assert t("len([a, b])", []) == 2
+    # and so are names that don't appear in the code, for Q()
+    import patsy.builtins
+    assert t("Q('a') + Q('the b')", [{"Q": patsy.builtins.Q, "the b": 4}]) == 5
+    from nose.tools import assert_raises
+    assert_raises(NameError, t, "a + c", [{}])
+
 def test_EvalEnvironment_eval_flags():
     from nose.tools import assert_raises
     if sys.version_info >= (3,):
@@ -510,6 +602,29 @@ class EvalFactor(object):
                              + ".memorize_chunk"
                              + transform_call_code[len(transform_call_name):])
             state["memorize_code"][obj_name] = memorize_code
+        # Compile everything now, rather than every time we evaluate the
+        # factor (which may be many times, on small chunks of data).
+        # We also figure out which variables each piece of code uses, so
+        # that they can be looked up directly when it's evaluated.
+        state["compiled_eval_code"] = self._compile(eval_code, eval_env)
+        state["compiled_memorize_code"] = dict(
+            (obj_name, self._compile(memorize_code, eval_env))
+            for obj_name, memorize_code in six.iteritems(
+                state["memorize_code"]))
+        # Factors that just refer to a variable, like "x" or
+        # 'Q("weight.in.kg")', are very common, and we can look those up
+        # directly without running any code at all.
+        state["variable"] = None
+        if not state["transforms"]:
+            state["variable"] = _variable_reference(self.code)
+        # And versions of the code where pure subexpressions (like np.log(x))
+        # are pulled out, so that they can be shared with other factors.
+        state["shared_eval_code"] = _share_subexpressions(eval_code,
+                                                          eval_env)
+        state["shared_memorize_code"] = dict(
+            (obj_name, _share_subexpressions(memorize_code, eval_env))
+            for obj_name, memorize_code in six.iteritems(
+                state["memorize_code"]))
         # Then sort the codes into bins, so that every item in bin number i
         # depends only on items in bin (i-1) or less. (By 'depends', we mean
         # that in something like:
@@ -542,28 +657,89 @@ class EvalFactor(object):
 
         return len(pass_bins)
 
-    def _eval(self, code, memorize_state, data):
-        inner_namespace = VarLookupDict([data, memorize_state["transforms"]])
+    # Returns a tuple (code object, names used by the code).
+    def _compile(self, code, eval_env):
+        compiled = call_and_wrap_exc("Error evaluating factor",
+                                     self,
+                                     _compile,
+                                     code, "<string>", eval_env.flags)
+        return compiled, tuple(set(ast_names(code)))
+
+    # Evaluates 'compiled' (from _compile). If a _SubexpressionCache is
+    # given, then 'shared' (from _share_subexpressions) is evaluated instead,
+    # if there is one.
+    def _eval(self, compiled, shared, memorize_state, data,
+              subexpressions=None):
+        eval_env = memorize_state["eval_env"]
+        inner_namespaces = [data, memorize_state["transforms"]]
+        if subexpressions is None or shared is None:
+            code, names = compiled
+            return call_and_wrap_exc("Error evaluating factor",
+                                     self,
+                                     eval_env._eval_resolved,
+                                     code,
+                                     names,
+                                     inner_namespaces)
+        code, names, shared_subexpressions = shared
+        def eval_shared():
+            values = {}
+            for name, key, sub_code, sub_names in shared_subexpressions:
+                values[name] = subexpressions._value(key, sub_code, sub_names,
+                                                     eval_env,
+                                                     inner_namespaces)
+            return eval_env._eval_resolved(code, names,
+                                           [values] + inner_namespaces)
         return call_and_wrap_exc("Error evaluating factor",
                                  self,
-                                 memorize_state["eval_env"].eval,
-                                 code,
-                                 inner_namespace=inner_namespace)
+                                 eval_shared)
 
     def memorize_chunk(self, state, which_pass, data):
+        self._memorize_chunk(state, which_pass, data)
+
+    def _memorize_chunk(self, state, which_pass, data, subexpressions=None):
         for obj_name in state["pass_bins"][which_pass]:
-            self._eval(state["memorize_code"][obj_name],
+            self._eval(state["compiled_memorize_code"][obj_name],
+                       state["shared_memorize_code"][obj_name],
                        state,
-                       data)
+                       data,
+                       subexpressions)
 
     def memorize_finish(self, state, which_pass):
         for obj_name in state["pass_bins"][which_pass]:
             state["transforms"][obj_name].memorize_finish()
 
+    # Returns the value of the variable referred to by memorize_state's
+    # "variable" entry, or _NOT_FOUND if it isn't there (or Q has been
+    # replaced by something else), in which case the caller should just
+    # evaluate the code as usual.
+    def _lookup_variable(self, memorize_state, data):
+        quoting_function, name = memorize_state["variable"]
+        namespace = VarLookupDict([data, memorize_state["transforms"]]
+                                  + memorize_state["eval_env"]._namespaces)
+        try:
+            if (quoting_function is not None
+                and namespace[quoting_function] is not patsy.builtins.Q):
+                return _NOT_FOUND
+            return namespace[name]
+        except KeyError:
+            return _NOT_FOUND
+
     def eval(self, memorize_state, data):
-        return self._eval(memorize_state["eval_code"],
+        return self._eval_value(memorize_state, data)
+
+    def _eval_value(self, memorize_state, data, subexpressions=None):
+        if memorize_state["variable"] is not None:
+            value = call_and_wrap_exc("Error evaluating factor",
+                                      self,
+                                      self._lookup_variable,
+                                      memorize_state, data)
+            if value is not _NOT_FOUND:
+                return value
+        return self._eval(memorize_state["compiled_eval_code"],
+                          memorize_state["shared_eval_code"],
                           memorize_state,
-                          data)
+                          data,
+                          subexpressions)
 
     __getstate__ = no_pickling
 
@@ -620,6 +796,19 @@ def test_EvalFactor_memorize_passes_needed():
                                        "_patsy_stobj2__foo__",
                                        "_patsy_stobj3__quux__"]),
                                   set(["_patsy_stobj1__bar__"])]
+    flags = state["eval_env"].flags
+    code, names = state["compiled_eval_code"]
+    assert code is _compile(state["eval_code"], "<string>", flags)
+    assert set(names) == set(["_patsy_stobj0__foo__", "_patsy_stobj1__bar__",
+                              "_patsy_stobj2__foo__", "_patsy_stobj3__quux__",
+                              "x", "y", "z", "w"])
+    code, names = state["compiled_memorize_code"]["_patsy_stobj1__bar__"]
+    assert code is _compile(state["memorize_code"]["_patsy_stobj1__bar__"],
+                            "<string>", flags)
+    assert set(names) == set(["_patsy_stobj1__bar__", "_patsy_stobj2__foo__",
+                              "y"])
+    assert (set(state["compiled_memorize_code"])
+            == set(state["memorize_code"]))
 
 class _MockTransform(object):
     # Adds up all memorized data, then subtracts that sum from each datum
@@ -691,6 +880,365 @@ def test_EvalFactor_end_to_end():
                           "y": np.array([10, 11, 100, 3])})
                   == [254, 256, 355, 236])
 
+_NOT_FOUND = object()
+
+if sys.version_info >= (3, 8):
+    _AST_CONSTANTS = (ast.Constant,)
+else:
+    _AST_CONSTANTS = tuple([getattr(ast, name)
+                            for name in ["Num", "Str", "Bytes", "NameConstant"]
+                            if hasattr(ast, name)])
+
+# Returns the object that an expression like "np.log" refers to in
+# 'namespace', or None.
+def _resolve_function(node, namespace):
+    attrs = []
+    while isinstance(node, ast.Attribute):
+        attrs.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    value = namespace.get(node.id)
+    for attr in reversed(attrs):
+        value = getattr(value, attr, None)
+    return value
+
+# Functions whose results depend only on their arguments, and which have no
+# side-effects, so that if several factors call them with the same arguments,
+# the result can be computed once and shared. That's numpy's own ufuncs, but
+# not ones made with np.frompyfunc, which can run arbitrary Python code.
+def _is_pure_function(value):
+    if isinstance(value, np.ufunc):
+        return getattr(np, value.__name__, None) is value
+    return value is patsy.builtins.I or value is patsy.builtins.Q
+
+# Is this a call to a pure function, which doesn't write to any of its
+# arguments? (Extra positional arguments to a ufunc are output arrays, which
+# it writes to.)
+def _is_pure_call(node, namespace):
+    function = _resolve_function(node.func, namespace)
+    return (_is_pure_function(function)
+            and not (isinstance(function, np.ufunc)
+                     and len(node.args) > function.nin))
+
+# Is this expression made up of nothing but variables, constants, arithmetic
+# and calls to pure functions?
+def _is_pure(node, namespace):
+    if isinstance(node, (ast.Name, ast.operator, ast.unaryop, ast.cmpop)
+                  + _AST_CONSTANTS):
+        return True
+    if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare)):
+        return all([_is_pure(child, namespace)
+                    for child in ast.iter_child_nodes(node)])
+    if isinstance(node, ast.Call):
+        return (_is_pure_call(node, namespace)
+                and not node.keywords
+                and getattr(node, "starargs", None) is None
+                and getattr(node, "kwargs", None) is None
+                and all([_is_pure(arg, namespace) for arg in node.args]))
+    return False
+
+class _SubexpressionFinder(ast.NodeTransformer):
+    def __init__(self, namespace, tree):
+        self._namespace = namespace
+        self._parents = {}
+        for parent in ast.walk(tree):
+            for child in ast.iter_child_nodes(parent):
+                self._parents[child] = parent
+        self.found = []
+
+    # Every factor using a shared value gets the very same object, so it can
+    # only be handed to something that won't modify it: an operator, a pure
+    # function, or (at the top level) patsy itself. I() passes its argument
+    # straight through, so that depends on what I() is passed to.
+    def _consumer_is_safe(self, node):
+        parent = self._parents.get(node)
+        if parent is None or isinstance(parent, ast.Expression):
+            return True
+        if isinstance(parent, (ast.BinOp, ast.UnaryOp, ast.Compare)):
+            return True
+        if isinstance(parent, ast.Call) and node in parent.args:
+            function = _resolve_function(parent.func, self._namespace)
+            if function is patsy.builtins.I:
+                return self._consumer_is_safe(parent)
+            return _is_pure_call(parent, self._namespace)
+        return False
+
+    def visit_Call(self, node):
+        # I() and Q() are too cheap to be worth sharing in themselves
+        function = _resolve_function(node.func, self._namespace)
+        if (function is patsy.builtins.I
+            or function is patsy.builtins.Q
+            or not _is_pure(node, self._namespace)
+            or not self._consumer_is_safe(node)):
+            return self.generic_visit(node)
+        name = "_patsy_subexpr%s__" % (len(self.found),)
+        self.found.append((name, node))
+        return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+def _names_in(node):
+    return tuple(set([child.id for child in ast.walk(node)
+                      if isinstance(child, ast.Name)]))
+
+# Looks for calls to pure functions in 'code' (e.g., np.log(x) in
+# "I(np.log(x) ** 2)"), which can be shared with other factors evaluated on
+# the same data. If there are any, returns a tuple
+#   (code object, names, subexpressions)
+# where the code object has each call replaced by a new variable, and
+# subexpressions is a list of tuples
+#   (variable name, key, code object, names)
+# which say how to compute those variables. The keys identify the
+# subexpressions independently of which factor they came from. (Of course,
+# the same subexpression can still have different values in different
+# factors, if it refers to variables in different environments; see
+# _SubexpressionCache.) Otherwise returns None.
+def _share_subexpressions(code, eval_env):
+    tree = ast.parse(code, mode="eval")
+    finder = _SubexpressionFinder(eval_env.namespace, tree)
+    tree = ast.fix_missing_locations(finder.visit(tree))
+    if not finder.found:
+        return None
+    subexpressions = []
+    for name, node in finder.found:
+        sub_code = compile(ast.Expression(body=node), "<string>", "eval",
+                           eval_env.flags, False)
+        key = (eval_env.flags, ast.dump(node))
+        subexpressions.append((name, key, sub_code, _names_in(node)))
+    shared_code = compile(tree, "<string>", "eval", eval_env.flags, False)
+    return shared_code, _names_in(tree), subexpressions
+
+def test__share_subexpressions():
+    env = EvalEnvironment([{"np": np, "I": patsy.builtins.I,
+                            "Q": patsy.builtins.Q, "f": lambda x: x,
+                            "g": np.frompyfunc(lambda x: x, 1, 1)}])
+    code, names, subexpressions = _share_subexpressions(
+        "I(np.log(x + 1) ** 2) + f(np.exp(-y) + 1) + np.log(x + 1)", env)
+    assert len(subexpressions) == 3
+    assert subexpressions[0][1] == subexpressions[2][1]
+    assert subexpressions[0][1] != subexpressions[1][1]
+    assert set(subexpressions[0][3]) == set(["np", "x"])
+    assert set(subexpressions[1][3]) == set(["np", "y"])
+    assert set(names) == set(["I", "f", "_patsy_subexpr0__",
+                              "_patsy_subexpr1__", "_patsy_subexpr2__"])
+    values = {"I": patsy.builtins.I, "f": lambda x: x,
+              "_patsy_subexpr0__": 2, "_patsy_subexpr1__": 3,
+              "_patsy_subexpr2__": 4}
+    assert eval(code, {}, values) == 12
+    # Calls to anything else (including ufuncs made from Python functions),
+    # with keyword arguments, or with output arrays, aren't shared
+    for code in ["x + y", "f(x)", "np.log(f(x))", "np.log(x, out=y)",
+                 "I(x)", "Q('x')", "np.log(x.y)", "np.log(*x)", "g(x)",
+                 "np.log(g(x))", "np.log(x, y)", "np.add(x, 1, y)"]:
+        assert _share_subexpressions(code, env) is None
+    assert _share_subexpressions("np.log(Q('x') * 2 < 3)", env) is not None
+    assert _share_subexpressions("np.add(x, 1)", env) is not None
+    # Shared values are only passed to things that can't modify them
+    for code in ["f(np.log(x))", "f(I(np.log(x)))", "np.log(x).sort()",
+                 "f(y=np.log(x))", "f(np.log(x) if y else 1)",
+                 "[np.log(x)]"]:
+        assert _share_subexpressions(code, env) is None
+    for code in ["f(np.log(x) + 1)", "f(I(np.log(x)) * 2)",
+                 "f(np.exp(np.log(x)))", "I(I(np.log(x)))"]:
+        assert _share_subexpressions(code, env) is not None
+
+# Holds the values of subexpressions that have been computed while
+# evaluating factors on one chunk of data, so that other factors can reuse
+# them. The same subexpression might refer to different variables in
+# different factors (e.g., because they come from formulas with different
+# environments), so values are looked up by the subexpression's key together
+# with the identities of the objects its variables refer to.
+class _SubexpressionCache(object):
+    def __init__(self, data):
+        self.data = data
+        self._values = {}
+        self._lock = threading.Lock()
+
+    # Factors that we can't share subexpressions for are just evaluated as
+    # usual.
+    def _shares(self, factor):
+        return (isinstance(factor, EvalFactor)
+                and (six.get_unbound_function(type(factor).eval)
+                     is six.get_unbound_function(EvalFactor.eval))
+                and (six.get_unbound_function(type(factor).memorize_chunk)
+                     is six.get_unbound_function(EvalFactor.memorize_chunk)))
+
+    def eval(self, factor, state):
+        if self._shares(factor):
+            return factor._eval_value(state, self.data, self)
+        return factor.eval(state, self.data)
+
+    def memorize_chunk(self, factor, state, which_pass):
+        if self._shares(factor):
+            factor._memorize_chunk(state, which_pass, self.data, self)
+        else:
+            factor.memorize_chunk(state, which_pass, self.data)
+
+    def _value(self, key, code, names, eval_env, inner_namespaces):
+        namespaces = list(inner_namespaces) + eval_env._namespaces
+        lookup = VarLookupDict(namespaces + [six.moves.builtins.__dict__])
+        local_namespace = _ResolvedNamespace(namespaces)
+        try:
+            for name in names:
+                local_namespace[name] = lookup[name]
+        except KeyError:
+            # Let eval report the problem
+            return eval(code, {}, local_namespace)
+        bound = tuple([local_namespace[name] for name in names])
+        key = key + tuple([id(value) for value in bound])
+        with self._lock:
+            entry = self._values.get(key)
+        if entry is not None:
+            return entry[1]
+        value = eval(code, {}, local_namespace)
+        with self._lock:
+            # Keeping the bound objects alive guarantees that their ids
+            # aren't reused for anything else while this entry exists.
+            self._values[key] = (bound, value)
+        return value
+
+    __getstate__ = no_pickling
+
+class _ExpCounted(np.ndarray):
+    # Records each time np.exp is applied to one of these
+    calls = []
+    def __array_wrap__(self, out_arr, context=None, *args):
+        if context is not None and context[0] is np.exp:
+            self.calls.append(context)
+        return np.ndarray.__array_wrap__(self, out_arr, context, *args)
+
+def test__SubexpressionCache():
+    calls = _ExpCounted.calls
+    del calls[:]
+    env = EvalEnvironment([{"np": np, "g": np.exp, "I": patsy.builtins.I}])
+    other_env = EvalEnvironment([{"np": np, "g": np.exp,
+                                  "y": np.array([5.0])}])
+    def make(code, env):
+        factor = EvalFactor(code)
+        state = {}
+        factor.memorize_passes_needed(state, env)
+        return factor, state
+    f1, s1 = make("g(x)", env)
+    f2, s2 = make("I(g(x) * 2)", env)
+    f3, s3 = make("g(y)", env)
+    f4, s4 = make("g(y)", other_env)
+    data = {"x": np.array([1.0]).view(_ExpCounted),
+            "y": np.array([2.0]).view(_ExpCounted)}
+    cache = _SubexpressionCache(data)
+    assert np.allclose(cache.eval(f1, s1).astype(float), np.exp([1.0]))
+    assert np.allclose(cache.eval(f2, s2).astype(float), 2 * np.exp([1.0]))
+    assert len(calls) == 1
+    # Same code, but different variables
+    assert np.allclose(cache.eval(f3, s3).astype(float), np.exp([2.0]))
+    assert len(calls) == 2
+    # The data comes first, so other_env's y doesn't matter here
+    cache.eval(f4, s4)
+    assert len(calls) == 2
+    # A new chunk starts over
+    cache = _SubexpressionCache(data)
+    cache.eval(f1, s1)
+    assert len(calls) == 3
+    # Evaluating directly doesn't use any cache
+    assert np.allclose(f2.eval(s2, data).astype(float), 2 * np.exp([1.0]))
+    assert len(calls) == 4
+    # Missing variables are reported as usual (on py2, call_and_wrap_exc
+    # lets the original exception escape)
+    from nose.tools import assert_raises
+    f5, s5 = make("g(z)", env)
+    assert_raises(PatsyError if six.PY3 else NameError, cache.eval, f5, s5)
+    # Other kinds of factors are just evaluated
+    class MyFactor(EvalFactor):
+        def eval(self, memorize_state, data):
+            return "mine"
+    f6, s6 = make("g(x)", env)
+    f6.__class__ = MyFactor
+    assert cache.eval(f6, s6) == "mine"
+
+    # Memorization shares subexpressions too (but stateful transforms are
+    # never passed a shared value directly, since they might modify it)
+    from patsy.state import stateful_transform
+    foo = stateful_transform(_MockTransform)
+    env = env.with_outer_namespace({"foo": foo})
+    f7, s7 = make("foo(g(x) * 2)", env)
+    f8, s8 = make("foo(g(x) + 1)", env)
+    del calls[:]
+    cache = _SubexpressionCache(data)
+    for factor, state in [(f7, s7), (f8, s8)]:
+        cache.memorize_chunk(factor, state, 0)
+        factor.memorize_finish(state, 0)
+    assert len(calls) == 1
+    sums = [list(state["transforms"].values())[0]._sum for state in [s7, s8]]
+    assert np.allclose(np.asarray(sums, dtype=float),
+                       [2 * np.exp(1.0), np.exp(1.0) + 1])
+
+# If 'code' is just a reference to a variable -- either a bare name like
+# "x", or a quoted one like 'Q("x")' -- returns a tuple (quoting function
+# name or None, variable name). Otherwise returns None.
+def _variable_reference(code):
+    node = ast.parse(code, mode="eval").body
+    if isinstance(node, ast.Name):
+        return (None, node.id)
+    if (isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and len(node.args) == 1
+        and not node.keywords
+        and getattr(node, "starargs", None) is None
+        and getattr(node, "kwargs", None) is None):
+        name = _string_literal(node.args[0])
+        if name is not None:
+            return (node.func.id, name)
+    return None
+
+def _string_literal(node):
+    if sys.version_info >= (3, 8):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+    elif isinstance(node, ast.Str):
+        return node.s
+    return None
+
+def test__variable_reference():
+    assert _variable_reference("x") == (None, "x")
+    assert _variable_reference("Q('a b')") == ("Q", "a b")
+    assert _variable_reference("foo(\"x\")") == ("foo", "x")
+    for code in ["x + 1", "x.y", "Q(x)", "Q('x', 'y')", "Q(*'x')",
+                 "Q(name='x')", "'x'", "f(x)('y')", "np.log(x)"]:
+        assert _variable_reference(code) is None
+
+def test_EvalFactor_variable_lookup():
+    from nose.tools import assert_raises
+    from patsy.state import stateful_transform
+    import numpy as np
+    data = {"x": np.array([1, 2]), "a b": np.array([3, 4]),
+            "y": np.array([5, 6])}
+    def check(code, expected, variable, data=data):
+        e = EvalFactor(code)
+        state = {}
+        e.memorize_passes_needed(state, EvalEnvironment.capture(1))
+        assert state["variable"] == variable
+        assert np.array_equal(e.eval(state, data), expected)
+    check("x", [1, 2], (None, "x"))
+    check("Q('a b')", [3, 4], ("Q", "a b"))
+    x = np.array([7, 8])
+    check("x", [7, 8], (None, "x"), {})
+    check("x + y", [6, 8], None)
+    # Data can override Q
+    check("Q('x')", [10, 20], ("Q", "x"),
+          dict(data, Q=lambda name: data[name] * 10))
+    # Stateful transforms are never just lookups
+    foo = stateful_transform(_MockTransform)
+    check("foo(x)", [1, 2], None)
+    # Missing data is reported as usual (on py2, call_and_wrap_exc lets the
+    # original exception escape)
+    exc = PatsyError if six.PY3 else NameError
+    e = EvalFactor("z")
+    state = {}
+    e.memorize_passes_needed(state, EvalEnvironment.capture(0))
+    assert_raises(exc, e.eval, state, data)
+    e = EvalFactor("Q('z')")
+    state = {}
+    e.memorize_passes_needed(state, EvalEnvironment.capture(0))
+    assert_raises(exc, e.eval, state, data)
+
 def annotated_tokens(code):
     prev_was_dot = False
     it = PushbackAdapter(python_tokenize(code))
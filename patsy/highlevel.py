@@ -20,7 +20,8 @@ from patsy.design_info import DesignMatrix, DesignInfo
 from patsy.eval import EvalEnvironment
 from patsy.desc import ModelDesc
 from patsy.build import (design_matrix_builders,
-                         build_design_matrices)
+                         build_design_matrices,
+                         _import_scipy_sparse)
 from patsy.util import (have_pandas, asarray_or_pandas,
                         atleast_2d_column_default)
 
@@ -31,7 +32,7 @@ if have_pandas:
 # data source. If formula_like is not capable of doing this, then returns
 # None.
 def _try_incr_builders(formula_like, data_iter_maker, eval_env,
-                       NA_action):
+                       NA_action, eval_cache=None):
     if isinstance(formula_like, DesignInfo):
         return (design_matrix_builders([[]], data_iter_maker, eval_env, NA_action)[0],
                 formula_like)
@@ -67,7 +68,8 @@ def _try_incr_builders(formula_like, data_iter_maker, eval_env,
                                        formula_like.rhs_termlist],
                                       data_iter_maker,
                                       eval_env,
-                                      NA_action)
+                                      NA_action,
+                                      eval_cache=eval_cache)
     else:
         return None
 
@@ -152,21 +154,29 @@ def incr_dbuilders(formula_like, data_iter_maker, eval_env=0,
 #   (DesignInfo, DesignInfo)
 #   any object with a special method __patsy_get_model_desc__
 def _do_highlevel_design(formula_like, data, eval_env,
-                         NA_action, return_type):
+                         NA_action, return_type, order, eval_cache=None):
     if return_type == "dataframe" and not have_pandas:
         raise PatsyError("pandas.DataFrame was requested, but pandas "
                             "is not installed")
-    if return_type not in ("matrix", "dataframe"):
+    if return_type == "sparse":
+        _import_scipy_sparse()
+    if return_type not in ("matrix", "dataframe", "sparse"):
         raise PatsyError("unrecognized output type %r, should be "
-                            "'matrix' or 'dataframe'" % (return_type,))
+                            "'matrix', 'dataframe', or 'sparse'"
+                            % (return_type,))
+    if order not in ("C", "F"):
+        raise PatsyError("unrecognized order %r, should be 'C' or 'F'"
+                         % (order,))
     def data_iter_maker():
         return iter([data])
     design_infos = _try_incr_builders(formula_like, data_iter_maker, eval_env,
-                                      NA_action)
+                                      NA_action, eval_cache=eval_cache)
     if design_infos is not None:
         return build_design_matrices(design_infos, data,
                                      NA_action=NA_action,
-                                     return_type=return_type)
+                                     return_type=return_type,
+                                     order=order,
+                                     eval_cache=eval_cache)
     else:
         # No builders, but maybe we can still get matrices
         if isinstance(formula_like, tuple):
@@ -198,8 +208,16 @@ def _do_highlevel_design(formula_like, data, eval_env,
                 m.columns = di.column_names
                 m.design_info = di
                 return (m, orig_index)
+            elif return_type == "sparse":
+                m = _import_scipy_sparse().csc_matrix(
+                    np.asarray(DesignMatrix(m, di)))
+                m.design_info = di
+                return (m, orig_index)
             else:
-                return (DesignMatrix(m, di), orig_index)
+                m = DesignMatrix(m, di)
+                if order == "F" and not m.flags.f_contiguous:
+                    m = DesignMatrix(np.asfortranarray(m), di)
+                return (m, orig_index)
         rhs, rhs_orig_index = _regularize_matrix(rhs, "x")
         if lhs is None:
             lhs = np.zeros((rhs.shape[0], 0), dtype=float)
@@ -223,7 +241,8 @@ def _do_highlevel_design(formula_like, data, eval_env,
         return (lhs, rhs)
 
 def dmatrix(formula_like, data={}, eval_env=0,
-            NA_action="drop", return_type="matrix"):
+            NA_action="drop", return_type="matrix", order="C",
+            eval_cache=None):
     """Construct a single design matrix given a formula_like and data.
 
     :arg formula_like: An object that can be used to construct a design
@@ -242,7 +261,13 @@ def dmatrix(formula_like, data={}, eval_env=0,
       ``"drop"`` them, ``"raise"`` an error, or for customization, pass an
       :class:`NAAction` object. See :class:`NAAction` for details on what
       values count as 'missing' (and how to alter this).
-    :arg return_type: Either ``"matrix"`` or ``"dataframe"``. See below.
+    :arg return_type: Either ``"matrix"``, ``"dataframe"``, or ``"sparse"``.
+      See below.
+    :arg order: Either ``"C"`` (the default) or ``"F"``; the memory layout
+      of the returned matrix. See :func:`build_design_matrices`.
+    :arg eval_cache: Either None (the default), or a
+      :class:`FactorEvalCache`, which lets evaluated factors be reused
+      across calls with the same `data`. See :class:`FactorEvalCache`.
 
     The `formula_like` can take a variety of forms. You can use any of the
     following:
@@ -275,9 +300,10 @@ def dmatrix(formula_like, data={}, eval_env=0,
 
     * A :class:`DesignMatrix`, if ``return_type="matrix"`` (the default)
     * A :class:`pandas.DataFrame`, if ``return_type="dataframe"``.
+    * A :class:`scipy.sparse.csc_matrix`, if ``return_type="sparse"``.
 
-    The actual contents of the design matrix is identical in both cases, and
-    in both cases a :class:`DesignInfo` object will be available in a
+    The actual contents of the design matrix is identical in all cases, and
+    in all cases a :class:`DesignInfo` object will be available in a
     ``.design_info`` attribute on the return value. However, for
     ``return_type="dataframe"``, any pandas indexes on the input (either in
     `data` or directly passed through `formula_like`) will be preserved, which
@@ -285,17 +311,22 @@ def dmatrix(formula_like, data={}, eval_env=0,
 
     .. versionadded:: 0.2.0
        The ``NA_action`` argument.
+    .. versionadded:: 0.5.0
+       ``return_type="sparse"``, and the ``order`` and ``eval_cache``
+       arguments.
     """
     eval_env = EvalEnvironment.capture(eval_env, reference=1)
     (lhs, rhs) = _do_highlevel_design(formula_like, data, eval_env,
-                                      NA_action, return_type)
+                                      NA_action, return_type, order,
+                                      eval_cache=eval_cache)
     if lhs.shape[1] != 0:
         raise PatsyError("encountered outcome variables for a model "
                             "that does not expect them")
     return rhs
 
 def dmatrices(formula_like, data={}, eval_env=0,
-              NA_action="drop", return_type="matrix"):
+              NA_action="drop", return_type="matrix", order="C",
+              eval_cache=None):
     """Construct two design matrices given a formula_like and data.
 
     This function is identical to :func:`dmatrix`, except that it requires
@@ -307,7 +338,8 @@ def dmatrices(formula_like, data={}, eval_env=0,
     """
     eval_env = EvalEnvironment.capture(eval_env, reference=1)
     (lhs, rhs) = _do_highlevel_design(formula_like, data, eval_env,
-                                      NA_action, return_type)
+                                      NA_action, return_type, order,
+                                      eval_cache=eval_cache)
     if lhs.shape[1] == 0:
         raise PatsyError("model is missing required outcome variables")
     return (lhs, rhs)
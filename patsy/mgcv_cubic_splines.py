@@ -10,7 +10,8 @@ __all__ = ["cr", "cc", "te"]
 import numpy as np
 
 from patsy.util import (have_pandas, atleast_2d_column_default,
-                        no_pickling, assert_no_pickling, safe_string_eq)
+                        no_pickling, assert_no_pickling, safe_string_eq,
+                        float_dtype_for)
 from patsy.state import stateful_transform
 
 if have_pandas:
@@ -679,6 +680,8 @@ class CubicRegressionSpline(object):
                              % (self._name,))
         dm = _get_crs_dmatrix(x, self._all_knots,
                               self._constraints, cyclic=self._cyclic)
+        # Single-precision input gives single-precision output
+        dm = dm.astype(float_dtype_for(x), copy=False)
         if have_pandas:
             if isinstance(x_orig, (pandas.Series, pandas.DataFrame)):
                 dm = pandas.DataFrame(dm)
@@ -938,7 +941,9 @@ class TE(object):
                                  "a 2-d array or 1-d vector.")
             args_2d.append(arg)
 
-        return _get_te_dmatrix(args_2d, self._constraints)
+        dtype = np.result_type(*[float_dtype_for(arg) for arg in args_2d])
+        dm = _get_te_dmatrix(args_2d, self._constraints)
+        return dm.astype(dtype, copy=False)
 
     __getstate__ = no_pickling
 
@@ -972,6 +977,18 @@ def test_te_1smooth():
     assert np.allclose(cr(x, df=3, constraints=center_constraint),
                        te(cr(x, df=4), constraints=center_constraint))
 
+def test_te_float32():
+    from patsy.splines import bs
+    # Single-precision input gives single-precision output
+    x = np.linspace(0, 1, 20)
+    x32 = x.astype(np.float32)
+    for spline in [cr(x32, df=5), cc(x32, df=5), bs(x32, df=5),
+                   te(cr(x32, df=3), cc(x32, df=4))]:
+        assert spline.dtype == np.dtype(np.float32)
+    assert np.allclose(cr(x32, df=5), cr(x, df=5), atol=1e-6)
+    assert te(cr(x32, df=3), cr(x, df=3)).dtype == np.dtype(float)
+    assert cr(np.arange(20), df=5).dtype == np.dtype(float)
+
 
 def test_te_2smooths():
     from patsy.highlevel import incr_dbuilder, build_design_matrices
@@ -37,9 +37,14 @@
 # though).
 
 import numpy as np
+import six
 from patsy import PatsyError
 from patsy.util import (safe_isnan, safe_scalar_isnan,
-                        no_pickling, assert_no_pickling)
+                        no_pickling, assert_no_pickling,
+                        have_pandas)
+
+if have_pandas:
+    import pandas
 
 # These are made available in the patsy.* namespace
 __all__ = ["NAAction"]
@@ -126,6 +131,55 @@ class NAAction(object):
             return True
         return False
 
+    def is_categorical_NA_array(self, arr):
+        """Returns a 1-d mask array indicating which entries in an array of
+        categorical values are NA values.
+
+        This gives the same answers as calling :meth:`is_categorical_NA` on
+        each entry, but works on the whole array at once, which is much
+        faster for big arrays.
+
+        Note that here `arr` is a 1-d numpy array or pandas Series.
+
+        .. versionadded:: 0.5.0
+        """
+        arr = np.asarray(arr)
+        if (six.get_unbound_function(type(self).is_categorical_NA)
+            is not six.get_unbound_function(NAAction.is_categorical_NA)):
+            # A subclass has changed what counts as NA, so we have to ask it
+            # about every entry.
+            return self._is_categorical_NA_each(arr)
+        kind = arr.dtype.kind
+        if kind in "biu":
+            return np.zeros(arr.shape, dtype=bool)
+        elif kind == "f":
+            if "NaN" in self.NA_types:
+                return np.isnan(arr)
+            return np.zeros(arr.shape, dtype=bool)
+        elif kind in "US":
+            if "NaN" in self.NA_types:
+                return _isnan_strings(arr)
+            return np.zeros(arr.shape, dtype=bool)
+        elif kind == "O" and have_pandas:
+            # Check each distinct value once. pandas gives entries it thinks
+            # are missing a code of -1, but it doesn't necessarily agree with
+            # us, so those are checked individually.
+            try:
+                codes, uniques = pandas.factorize(arr)
+            except TypeError:
+                return self._is_categorical_NA_each(arr)
+            unique_mask = self._is_categorical_NA_each(uniques)
+            mask = np.append(unique_mask, False)[codes]
+            for i in np.flatnonzero(codes == -1):
+                mask[i] = self.is_categorical_NA(arr[i])
+            return mask
+        else:
+            return self._is_categorical_NA_each(arr)
+
+    def _is_categorical_NA_each(self, arr):
+        return np.asarray([self.is_categorical_NA(value) for value in arr],
+                          dtype=bool)
+
     def is_numerical_NA(self, arr):
         """Returns a 1-d mask array indicating which rows in an array of
         numerical values contain at least one NA value.
@@ -166,6 +220,32 @@ class NAAction(object):
         else: # pragma: no cover
             assert False
 
+    def handle_NA_rows(self, is_NAs, origins):
+        """Like :meth:`handle_NA`, but rather than returning copies of the
+        data with some rows removed, returns the indices of the rows that
+        should be kept, so that the caller can pick them out as needed.
+
+        :arg is_NAs: As for :meth:`handle_NA`.
+        :arg origins: As for :meth:`handle_NA`.
+        :returns: None if all rows should be kept, or otherwise a 1-d array
+          containing the indices of the rows to keep, in increasing order.
+
+        .. versionadded:: 0.5.0
+        """
+        assert len(is_NAs) == len(origins)
+        if len(is_NAs) == 0:
+            return None
+        if self.on_NA == "raise":
+            self._handle_NA_raise(None, is_NAs, origins)
+            return None
+        elif self.on_NA == "drop":
+            total_mask = _any_NA(is_NAs)
+            if not np.any(total_mask):
+                return None
+            return np.flatnonzero(~total_mask)
+        else: # pragma: no cover
+            assert False
+
     def _handle_NA_raise(self, values, is_NAs, origins):
         for is_NA, origin in zip(is_NAs, origins):
             if np.any(is_NA):
@@ -173,15 +253,32 @@ class NAAction(object):
         return values
 
     def _handle_NA_drop(self, values, is_NAs, origins):
-        total_mask = np.zeros(is_NAs[0].shape[0], dtype=bool)
-        for is_NA in is_NAs:
-            total_mask |= is_NA
+        total_mask = _any_NA(is_NAs)
+        if not np.any(total_mask):
+            # Nothing to drop, so don't bother copying anything
+            return list(values)
         good_mask = ~total_mask
         # "..." to handle 1- versus 2-dim indexing
         return [v[good_mask, ...] for v in values]
 
     __getstate__ = no_pickling
 
+# Returns a mask of the rows where any of the is_NAs masks are true.
+def _any_NA(is_NAs):
+    total_mask = np.zeros(is_NAs[0].shape[0], dtype=bool)
+    for is_NA in is_NAs:
+        total_mask |= is_NA
+    return total_mask
+
+# float() accepts strings like "nan", " NaN" and "-nan", so these are NaN as
+# far as safe_scalar_isnan is concerned.
+def _isnan_strings(arr):
+    if arr.dtype.kind == "S":
+        nans = [b"nan", b"+nan", b"-nan"]
+    else:
+        nans = [u"nan", u"+nan", u"-nan"]
+    return np.in1d(np.char.lower(np.char.strip(arr)), nans)
+
 def test_NAAction_basic():
     from nose.tools import assert_raises
     assert_raises(ValueError, NAAction, on_NA="pord")
@@ -214,6 +311,51 @@ def test_NAAction_NA_types_categorical():
         assert action.is_categorical_NA(None) == ("None" in NA_types)
         assert action.is_categorical_NA(np.nan) == ("NaN" in NA_types)
 
+def test_NAAction_is_categorical_NA_array():
+    import patsy.missing
+    class Unhashable(object):
+        __hash__ = None
+    unhashable = Unhashable()
+    arrays = [np.asarray([1, 2, 3]),
+              np.asarray([True, False]),
+              np.asarray([1.5, np.nan, 2.5]),
+              np.asarray(["a", "nan", " -NaN ", "nana", ""]),
+              np.asarray([b"a", b"NAN", b"b"]),
+              np.asarray([], dtype=object),
+              np.asarray(["a", None, np.nan, "nan", 1, None, np.float32("nan"),
+                          (1, 2)], dtype=object),
+              np.asarray([None, unhashable, np.nan], dtype=object),
+              np.asarray(["2012-01-01", "NaT"], dtype="M8[D]"),
+              ]
+    def check_all():
+        for NA_types in [[], ["NaN"], ["None"], ["NaN", "None"]]:
+            action = NAAction(NA_types=NA_types)
+            for arr in arrays:
+                expected = [action.is_categorical_NA(value) for value in arr]
+                got = action.is_categorical_NA_array(arr)
+                assert got.dtype == np.dtype(bool)
+                assert got.shape == arr.shape
+                assert list(got) == expected
+    check_all()
+    had_pandas = patsy.missing.have_pandas
+    try:
+        patsy.missing.have_pandas = False
+        check_all()
+    finally:
+        patsy.missing.have_pandas = had_pandas
+    if have_pandas:
+        assert np.array_equal(
+            NAAction().is_categorical_NA_array(pandas.Series(["a", None])),
+            [False, True])
+
+    # Subclasses that change what counts as NA are respected
+    class EmptyStringNA(NAAction):
+        def is_categorical_NA(self, obj):
+            return obj == "" or NAAction.is_categorical_NA(self, obj)
+    assert np.array_equal(
+        EmptyStringNA().is_categorical_NA_array(np.asarray(["", "a", "nan"])),
+        [True, False, True])
+
 def test_NAAction_drop():
     action = NAAction("drop")
     in_values = [np.asarray([-1, 2, -1, 4, 5]),
@@ -233,7 +375,15 @@ def test_NAAction_drop():
     assert np.array_equal(out_values[0], [2, 4])
     assert np.array_equal(out_values[1], [20.0, 40.0])
     assert np.array_equal(out_values[2], [[3.0, 4.0], [6.0, 7.0]])
-    
+    assert np.array_equal(action.handle_NA_rows(is_NAs, [None] * 3), [1, 3])
+
+    # If there's nothing to drop, nothing gets copied
+    is_NAs = [np.zeros(5, dtype=bool)] * 3
+    out_values = action.handle_NA(in_values, is_NAs, [None] * 3)
+    assert all(out is v for out, v in zip(out_values, in_values))
+    assert action.handle_NA_rows(is_NAs, [None] * 3) is None
+    assert action.handle_NA_rows([], []) is None
+
 def test_NAAction_raise():
     action = NAAction(on_NA="raise")
 
@@ -260,3 +410,10 @@ def test_NAAction_raise():
         assert False
     except PatsyError as e:
         assert e.origin is o2
+    try:
+        action.handle_NA_rows(is_NAs, [o1, o2])
+        assert False
+    except PatsyError as e:
+        assert e.origin is o2
+    assert action.handle_NA_rows([np.asarray([False, False])] * 2,
+                                 [o1, o2]) is None
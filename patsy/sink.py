@@ -0,0 +1,245 @@
+# This file is part of Patsy
+# Copyright (C) 2016 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# Writing design matrices to disk, and reading them back.
+#
+# The on-disk format is a plain .npy file holding the matrix (so it can be
+# read back with np.load by anyone, patsy or no), plus a small JSON "sidecar"
+# file next to it with the design matrix metadata. Since we don't know in
+# advance how many rows we'll end up with (NAs may be dropped from each
+# chunk), the .npy header is written with a fixed amount of padding, and
+# rewritten with the final shape when the sink is closed.
+
+import json
+import numpy as np
+from patsy import PatsyError
+from patsy.design_info import DesignInfo, DesignMatrix
+from patsy.util import no_pickling, assert_no_pickling
+
+# These are made available in the patsy.* namespace
+__all__ = ["NpySink", "load_design_matrix"]
+
+# Total size of the .npy preamble + header. A multiple of 64, so that the
+# data is nicely aligned (and so that numpy's own .npy writers agree).
+_NPY_HEADER_LEN = 256
+
+def _npy_header(dtype, shape):
+    magic = b"\x93NUMPY\x01\x00"
+    header = ("{'descr': %r, 'fortran_order': False, 'shape': (%d, %d), }"
+              % (np.lib.format.dtype_to_descr(dtype), shape[0], shape[1]))
+    header_len = _NPY_HEADER_LEN - len(magic) - 2
+    assert len(header) < header_len
+    header = header.ljust(header_len - 1) + "\n"
+    return (magic
+            + np.array([header_len], dtype="<u2").tobytes()
+            + header.encode("ascii"))
+
+def _sidecar_path(path):
+    return path + ".design_info.json"
+
+class NpySink(object):
+    """An output sink that writes a design matrix to a ``.npy`` file on disk.
+
+    An :class:`NpySink` can be passed as an entry in the ``out=`` argument
+    to :func:`build_design_matrices` or :func:`build_design_matrices_iter`,
+    in place of a preallocated array. Each time a design matrix is built
+    into it, the rows are appended to the file: the file is extended, the
+    new rows are mapped into memory with :class:`numpy.memmap`, and the
+    design matrix is built directly into that mapping, so the matrix never
+    has to fit in RAM. Combined with :func:`build_design_matrices_iter`, this
+    makes it possible to build arbitrarily large design matrices chunk by
+    chunk::
+
+      with NpySink("X.npy", X_design_info) as sink:
+          for _ in build_design_matrices_iter([X_design_info], chunks,
+                                              out=[sink]):
+              pass
+      X = load_design_matrix("X.npy")
+
+    When the sink is closed, the ``.npy`` header is updated with the final
+    number of rows, and the design matrix metadata (column and term names)
+    is written to a JSON "sidecar" file alongside, named by appending
+    ``.design_info.json`` to `path`. The ``.npy`` file itself is a normal
+    one, and can be read with :func:`numpy.load`.
+
+    :arg path: The filename to write to. Any existing file is overwritten.
+    :arg design_info: The :class:`DesignInfo` describing the design matrix
+      that will be written.
+    :arg dtype: The dtype of the design matrix.
+
+    Matrices are always stored in C (row-major) order, since that's the
+    layout that allows rows to be appended.
+
+    .. versionadded:: 0.5.0
+    """
+    def __init__(self, path, design_info, dtype=np.dtype(float)):
+        self.path = path
+        self.design_info = design_info
+        self.dtype = np.dtype(dtype)
+        self.num_rows = 0
+        self._num_columns = len(design_info.column_names)
+        self._file = open(path, "w+b")
+        self._file.write(_npy_header(self.dtype, (0, self._num_columns)))
+        self._file.flush()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def allocate(self, num_rows):
+        """Append `num_rows` rows to the file, and return a writeable array
+        (normally a :class:`numpy.memmap`) that maps onto them."""
+        if self.closed:
+            raise PatsyError("can't write to a closed NpySink")
+        shape = (num_rows, self._num_columns)
+        offset = (_NPY_HEADER_LEN
+                  + self.num_rows * self._num_columns * self.dtype.itemsize)
+        size = num_rows * self._num_columns * self.dtype.itemsize
+        self.num_rows += num_rows
+        if size == 0:
+            # mmap refuses to create empty mappings
+            return np.empty(shape, dtype=self.dtype)
+        self._file.truncate(offset + size)
+        return np.memmap(self._file, dtype=self.dtype, mode="r+",
+                         offset=offset, shape=shape)
+
+    def close(self):
+        """Finish writing: update the ``.npy`` header with the final shape,
+        write the sidecar file, and close the output file.
+
+        Calling this more than once has no effect."""
+        if self.closed:
+            return
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype,
+                                     (self.num_rows, self._num_columns)))
+        self._file.close()
+        self._file = None
+        di = self.design_info
+        metadata = {
+            "column_names": di.column_names,
+            "term_name_slices": [[name, slice_.start, slice_.stop]
+                                 for name, slice_
+                                 in di.term_name_slices.items()],
+            "dtype": self.dtype.str,
+            "shape": [self.num_rows, self._num_columns],
+            }
+        with open(_sidecar_path(self.path), "w") as f:
+            json.dump(metadata, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    __getstate__ = no_pickling
+
+def load_design_matrix(path, design_info=None, mmap_mode="r"):
+    """Load a design matrix written by :class:`NpySink`.
+
+    :arg path: The path of the ``.npy`` file.
+    :arg design_info: Optionally, the :class:`DesignInfo` that was used to
+      write the matrix, which will be attached to the result. Its column
+      names are checked against those recorded in the sidecar file. If not
+      given, a :class:`DesignInfo` is created from the recorded column and
+      term names; this knows which columns belong to which term, but (since
+      factors and terms can't be stored on disk) it has no
+      :attr:`DesignInfo.terms` or :attr:`DesignInfo.factor_infos`.
+    :arg mmap_mode: Passed to :func:`numpy.load`. The default, ``"r"``,
+      memory-maps the file read-only, so the returned matrix is a zero-copy
+      view onto the file; use ``None`` to read it into memory instead.
+
+    Returns a :class:`DesignMatrix`.
+
+    .. versionadded:: 0.5.0
+    """
+    with open(_sidecar_path(path)) as f:
+        metadata = json.load(f)
+    column_names = list(metadata["column_names"])
+    if design_info is None:
+        term_name_slices = [(name, slice(start, stop))
+                            for name, start, stop
+                            in metadata["term_name_slices"]]
+        design_info = DesignInfo(column_names,
+                                 term_name_slices=term_name_slices)
+    elif design_info.column_names != column_names:
+        raise PatsyError("design_info column names %r don't match the "
+                         "column names %r recorded in %s"
+                         % (design_info.column_names, column_names,
+                            _sidecar_path(path)))
+    if 0 in metadata["shape"]:
+        # mmap refuses to create empty mappings
+        mmap_mode = None
+    return DesignMatrix(np.load(path, mmap_mode=mmap_mode), design_info)
+
+def _memmap_backed(arr):
+    while isinstance(arr, np.ndarray):
+        if isinstance(arr, np.memmap):
+            return True
+        arr = arr.base
+    return False
+
+def test_NpySink():
+    import os
+    import shutil
+    import tempfile
+    from nose.tools import assert_raises
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "x.npy")
+        di = DesignInfo(["a", "b", "c"])
+        sink = NpySink(path, di, dtype=np.float32)
+        assert_no_pickling(sink)
+        block = sink.allocate(2)
+        assert isinstance(block, np.memmap)
+        assert block.shape == (2, 3)
+        assert block.dtype == np.dtype(np.float32)
+        block[...] = [[1, 2, 3], [4, 5, 6]]
+        assert sink.allocate(0).shape == (0, 3)
+        sink.allocate(1)[...] = [[7, 8, 9]]
+        assert sink.num_rows == 3
+        sink.close()
+        assert sink.closed
+        sink.close()
+        assert_raises(PatsyError, sink.allocate, 1)
+
+        # It's a plain .npy file
+        expected = np.arange(1, 10).reshape((3, 3))
+        raw = np.load(path)
+        assert raw.dtype == np.dtype(np.float32)
+        assert np.array_equal(raw, expected)
+
+        loaded = load_design_matrix(path)
+        assert isinstance(loaded, DesignMatrix)
+        assert _memmap_backed(loaded)
+        assert loaded.design_info.column_names == ["a", "b", "c"]
+        assert np.array_equal(loaded, expected)
+        del raw, loaded
+        loaded = load_design_matrix(path, design_info=di, mmap_mode=None)
+        assert loaded.design_info is di
+        assert not _memmap_backed(loaded)
+        assert_raises(PatsyError, load_design_matrix, path,
+                      design_info=DesignInfo(["x", "y", "z"]))
+
+        # Term structure survives the round trip
+        di_terms = DesignInfo(["Intercept", "a[T.b]", "a[T.c]"],
+                              term_name_slices=[("Intercept", slice(0, 1)),
+                                                ("a", slice(1, 3))])
+        with NpySink(path, di_terms) as sink:
+            sink.allocate(1)[...] = [[1, 0, 1]]
+        loaded = load_design_matrix(path)
+        assert loaded.design_info.column_names == di_terms.column_names
+        assert loaded.design_info.term_names == ["Intercept", "a"]
+        assert loaded.design_info.slice("a") == slice(1, 3)
+        del loaded
+
+        # Empty matrices work too
+        with NpySink(path, di) as sink:
+            pass
+        loaded = load_design_matrix(path)
+        assert loaded.shape == (0, 3)
+        assert loaded.dtype == np.dtype(float)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -9,7 +9,8 @@ __all__ = ["bs"]
 
 import numpy as np
 
-from patsy.util import have_pandas, no_pickling, assert_no_pickling
+from patsy.util import (have_pandas, float_dtype_for,
+                        no_pickling, assert_no_pickling)
 from patsy.state import stateful_transform
 
 if have_pandas:
@@ -52,7 +53,7 @@ def _eval_bspline_basis(x, knots, degree):
     # Note: the order of a spline is the same as its degree + 1.
     # Note: there are (len(knots) - order) basis functions.
     n_bases = len(knots) - (degree + 1)
-    basis = np.empty((x.shape[0], n_bases), dtype=float)
+    basis = np.empty((x.shape[0], n_bases), dtype=float_dtype_for(x))
     for i in range(n_bases):
         coefs = np.zeros((n_bases,))
         coefs[i] = 1
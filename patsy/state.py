@@ -26,14 +26,23 @@
 
 from functools import wraps
 import numpy as np
+import six
+from patsy import PatsyError
 from patsy.util import (atleast_2d_column_default,
                         asarray_or_pandas, pandas_friendly_reshape,
-                        wide_dtype_for, safe_issubdtype,
+                        wide_dtype_for, float_dtype_for, safe_issubdtype,
+                        have_pandas, safe_is_pandas_categorical,
+                        safe_scalar_isnan, SortAnythingKey,
                         no_pickling, assert_no_pickling)
+from patsy.categorical import (_CategoricalBox, _categorical_shape_fix,
+                               _factorize)
+
+if have_pandas:
+    import pandas
 
 # These are made available in the patsy.* namespace
 __all__ = ["stateful_transform",
-           "center", "standardize", "scale",
+           "center", "standardize", "scale", "lump",
            ]
 
 def stateful_transform(class_):
@@ -162,11 +171,10 @@ class Standardize(object):
         pass
 
     def transform(self, x, center=True, rescale=True, ddof=0):
-        # XX: this forces all inputs to double-precision real, even if the
-        # input is single- or extended-precision or complex. But I got all
-        # tangled up in knots trying to do that without breaking something
-        # else (e.g. by requiring an extra copy).
-        x = asarray_or_pandas(x, copy=True, dtype=float)
+        # Floating point inputs keep their precision, so that e.g. float32
+        # data doesn't get silently doubled in size; everything else
+        # (including complex!) is converted to double-precision real.
+        x = asarray_or_pandas(x, copy=True, dtype=float_dtype_for(x))
         x_2d = atleast_2d_column_default(x, preserve_pandas=True)
         if center:
             x_2d -= self.current_mean
@@ -179,3 +187,146 @@ class Standardize(object):
 standardize = stateful_transform(Standardize)
 # R compatibility:
 scale = standardize
+
+# Lump can't tell which values are missing (that depends on the NA_action,
+# which stateful transforms don't get to see), so it leaves anything that
+# might be missing alone, and lets categorical_to_int sort it out later.
+def _maybe_NA(value):
+    return value is None or safe_scalar_isnan(value)
+
+# Converts categorical data to a 1d array.
+def _categorical_values(x):
+    if safe_is_pandas_categorical(x):
+        x = np.asarray(x)
+    x = _categorical_shape_fix(x)
+    if hasattr(x, "dtype"):
+        return np.asarray(x)
+    # np.asarray would turn e.g. a list of tuples into a 2d array
+    values = np.empty(len(x), dtype=object)
+    for i, value in enumerate(x):
+        values[i] = value
+    return values
+
+class Lump(object):
+    """lump(x, min_count=None, top_k=None, other="other")
+
+    A stateful transform for categorical data, which lumps together rarely
+    seen levels into a single catch-all level.
+
+    A level is kept if it occurs at least `min_count` times, and (if `top_k`
+    is given) it is one of the `top_k` most frequent levels. All other values
+    are replaced by `other`. The result is categorical, with the kept levels
+    (in sorted order) followed by `other` as its levels. For instance, this
+    keeps only the 100 most common zip codes::
+
+      dmatrix("lump(zipcode, top_k=100)", data)
+
+    Values that are not seen when building the design, but that show up in
+    new data later, are also lumped into `other`. Missing values (``None``
+    and ``NaN``) are left alone; how they are handled is determined by the
+    `NA_action` as usual.
+
+    To use a different coding for the result, wrap it in :func:`C`, e.g.
+    ``C(lump(x, min_count=10), Sum)``.
+
+    .. note:: Level counts are accumulated chunk by chunk, so this is
+       suitable for use with large incrementally processed data-sets.
+
+    .. versionadded:: 0.5.0
+    """
+    def __init__(self):
+        self._counts = {}
+        self._min_count = None
+        self._top_k = None
+        self._other = None
+        self._kept = None
+        self._levels = None
+
+    def memorize_chunk(self, x, min_count=None, top_k=None, other="other"):
+        if isinstance(x, _CategoricalBox):
+            x = x.data
+        if top_k is not None and top_k < 1:
+            raise PatsyError("top_k must be at least 1")
+        self._min_count = min_count
+        self._top_k = top_k
+        self._other = other
+        values = _categorical_values(x)
+        factorized = _factorize(values)
+        if factorized is None:
+            uniques = values
+            counts = np.ones(len(values), dtype=int)
+        else:
+            codes, uniques = factorized
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        for value, count in zip(uniques, counts):
+            if _maybe_NA(value):
+                continue
+            try:
+                self._counts[value] = self._counts.get(value, 0) + count
+            except TypeError:
+                raise PatsyError("Error interpreting categorical data: "
+                                 "all items must be hashable")
+
+    def memorize_finish(self):
+        counts = self._counts
+        kept = list(counts)
+        # Sort first, so that ties in the counts are broken consistently
+        try:
+            kept.sort()
+        except TypeError:
+            kept.sort(key=SortAnythingKey)
+        if self._min_count is not None:
+            kept = [level for level in kept
+                    if counts[level] >= self._min_count]
+        if self._top_k is not None:
+            by_count = sorted(kept, key=lambda level: -counts[level])
+            top = set(by_count[:self._top_k])
+            kept = [level for level in kept if level in top]
+        self._kept = set(kept)
+        self._levels = tuple(kept)
+        if len(kept) < len(counts):
+            if self._other in self._kept:
+                raise PatsyError("can't lump levels into %r, because that "
+                                 "is already one of the levels"
+                                 % (self._other,))
+            self._levels += (self._other,)
+        else:
+            # Nothing got lumped, so there's no 'other' level for new values
+            # to go into.
+            self._other = None
+        del self._counts
+
+    def _lump(self, value):
+        if (self._other is None
+            or _maybe_NA(value)
+            or value in self._kept):
+            return value
+        return self._other
+
+    def transform(self, x, min_count=None, top_k=None, other="other"):
+        contrast = None
+        if isinstance(x, _CategoricalBox):
+            contrast = x.contrast
+            x = x.data
+        values = _categorical_values(x)
+        factorized = _factorize(values)
+        out = np.empty(len(values), dtype=object)
+        if factorized is None:
+            for i, value in enumerate(values):
+                out[i] = self._lump(value)
+        else:
+            codes, uniques = factorized
+            lumped = np.empty(len(uniques) + 1, dtype=object)
+            for i, value in enumerate(uniques):
+                lumped[i] = self._lump(value)
+            out[...] = lumped[codes]
+            # Missing values (as pandas sees them) are passed through as is
+            missing = np.flatnonzero(codes == -1)
+            out[missing] = values[missing]
+        if have_pandas and isinstance(x, pandas.Series):
+            out = pandas.Series(out, index=x.index)
+        return _CategoricalBox(out, contrast, self._levels)
+
+    __getstate__ = no_pickling
+
+lump = stateful_transform(Lump)
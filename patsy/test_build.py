@@ -20,6 +20,7 @@ from patsy.build import *
 from patsy.categorical import C
 from patsy.user_util import balanced, LookupFactor
 from patsy.design_info import DesignMatrix, DesignInfo
+from patsy.eval import EvalEnvironment, EvalFactor
 
 if have_pandas:
     import pandas
@@ -248,6 +249,324 @@ def test_build_design_matrices_dtype():
         mat = build_design_matrices([builder], data, dtype=np.float128)[0]
         assert mat.dtype == np.dtype(np.float128)
 
+def test_build_design_matrices_out():
+    data = {"x": [1, 2, np.nan, 3], "a": ["a1", "a2", "a2", "a1"]}
+    def iter_maker():
+        yield data
+    builders = design_matrix_builders([make_termlist([], ["x"], ["a"]),
+                                       make_termlist([])],
+                                      iter_maker, 0)
+    expected = build_design_matrices(builders, data)
+    for order in ["C", "F"]:
+        out = [np.empty((3, 3), order=order), np.empty((3, 1), order=order)]
+        mats = build_design_matrices(builders, data, out=out)
+        for mat, out_array, expected_mat in zip(mats, out, expected):
+            assert isinstance(mat, DesignMatrix)
+            assert np.may_share_memory(mat, out_array)
+            assert np.array_equal(out_array, expected_mat)
+            assert mat.design_info is expected_mat.design_info
+
+    # None entries are allocated as usual
+    out = np.empty((3, 1), dtype=np.float32)
+    x_mat, int_mat = build_design_matrices(builders, data, dtype=np.float32,
+                                           out=[None, out])
+    assert np.array_equal(x_mat, expected[0])
+    assert np.may_share_memory(int_mat, out)
+    assert np.array_equal(out, [[1], [1], [1]])
+
+    if have_pandas:
+        out = np.empty((3, 3))
+        df, _ = build_design_matrices(builders, data, return_type="dataframe",
+                                      out=[out, None])
+        assert np.array_equal(df, expected[0])
+        assert np.array_equal(df.index, [0, 1, 3])
+        assert np.array_equal(out, expected[0])
+
+    # Wrong shape, dtype, type or number of arrays
+    for bad_out in [[np.empty((4, 3)), None],
+                    [np.empty((3, 3), dtype=np.float32), None],
+                    [[[0] * 3] * 3, None],
+                    [None]]:
+        assert_raises(PatsyError, build_design_matrices, builders, data,
+                      out=bad_out)
+    assert_raises(PatsyError, build_design_matrices, builders, data,
+                  return_type="sparse", out=[None, None])
+
+def test_build_design_matrices_order():
+    data = balanced(a=3, repeat=2)
+    data["x"] = np.arange(6.0)
+    def iter_maker():
+        yield data
+    builders = design_matrix_builders([make_termlist([], ["a"], ["x", "a"]),
+                                       make_termlist([])],
+                                      iter_maker, 0)
+    c_mats = build_design_matrices(builders, data)
+    f_mats = build_design_matrices(builders, data, order="F")
+    for c_mat, f_mat in zip(c_mats, f_mats):
+        assert c_mat.flags.c_contiguous
+        assert isinstance(f_mat, DesignMatrix)
+        assert f_mat.flags.f_contiguous
+        assert np.array_equal(c_mat, f_mat)
+    f_mat, _ = build_design_matrices(builders, data, order="F",
+                                     dtype=np.float32)
+    assert f_mat.flags.f_contiguous
+    assert f_mat.dtype == np.dtype(np.float32)
+    assert_raises(PatsyError, build_design_matrices, builders, data,
+                  order="Q")
+
+def test_build_design_matrices_n_jobs():
+    data = balanced(a=3, b=2, repeat=4)
+    data["x"] = np.arange(24.0)
+    data["y"] = np.column_stack((np.arange(24.0), np.arange(24.0) ** 2))
+    def iter_maker():
+        yield data
+    builders = design_matrix_builders([make_termlist("y"),
+                                       make_termlist([], ["a"], ["b"],
+                                                     ["a", "b"], ["x", "a"],
+                                                     ["x", "y"])],
+                                      iter_maker, 0)
+    serial = build_design_matrices(builders, data)
+    for n_jobs in [2, 4, -1]:
+        threaded = build_design_matrices(builders, data, n_jobs=n_jobs)
+        for s_mat, t_mat in zip(serial, threaded):
+            assert t_mat.design_info is s_mat.design_info
+            assert np.array_equal(s_mat, t_mat)
+    for mats in build_design_matrices_iter(builders, [data, data], n_jobs=4):
+        for s_mat, t_mat in zip(serial, mats):
+            assert np.array_equal(s_mat, t_mat)
+    assert_raises(PatsyError, build_design_matrices, builders, data,
+                  n_jobs=0)
+
+    # Errors don't depend on which thread finishes first
+    bad = dict(data)
+    bad["x"] = data["x"].copy()
+    bad["x"][3] = np.nan
+    bad["a"] = list(data["a"])
+    bad["a"][5] = None
+    origins = set()
+    for n_jobs in [1, 4]:
+        try:
+            build_design_matrices(builders, bad, NA_action="raise",
+                                  n_jobs=n_jobs)
+        except PatsyError as e:
+            origins.add(e.origin)
+        else:
+            assert False
+    assert len(origins) == 1
+
+def test_build_design_matrices_processes():
+    data = balanced(a=3, b=2, repeat=4)
+    data["x"] = np.arange(24.0)
+    data["x"][[1, 10, 11, 23]] = np.nan
+    data["a"][5] = None
+    def iter_maker():
+        yield data
+    builders = design_matrix_builders([make_termlist("x"),
+                                       make_termlist([], ["a"], ["b"],
+                                                     ["x", "a"])],
+                                      iter_maker, 0)
+    serial = build_design_matrices(builders, data)
+    assert serial[0].shape[0] == 19
+    for n_jobs in [2, 3, 7]:
+        for order in ["C", "F"]:
+            got = build_design_matrices(builders, data, n_jobs=n_jobs,
+                                        backend="processes", order=order)
+            for s_mat, p_mat in zip(serial, got):
+                assert isinstance(p_mat, DesignMatrix)
+                assert p_mat.design_info is s_mat.design_info
+                assert p_mat.flags[order + "_CONTIGUOUS"]
+                assert np.array_equal(s_mat, p_mat)
+    # No NAs, so nothing to pack
+    clean = {"x": np.arange(24.0), "a": data["a"], "b": data["b"]}
+    clean["a"] = ["a1"] + clean["a"][1:]
+    s_mat, _ = build_design_matrices(builders, clean)
+    p_mat, _ = build_design_matrices(builders, clean, n_jobs=4,
+                                     backend="processes")
+    assert np.array_equal(s_mat, p_mat)
+    out = [np.empty(mat.shape) for mat in serial]
+    got = build_design_matrices(builders, data, n_jobs=2,
+                                backend="processes", out=out)
+    for o, p_mat, s_mat in zip(out, got, serial):
+        assert np.may_share_memory(o, p_mat)
+        assert np.array_equal(p_mat, s_mat)
+
+    # Errors are raised just like in the serial case
+    def error_origin(**kwargs):
+        try:
+            build_design_matrices(builders, data, NA_action="raise", **kwargs)
+        except PatsyError as e:
+            return e.origin
+        assert False
+    assert (error_origin(n_jobs=3, backend="processes")
+            == error_origin())
+    assert_raises(PatsyError, build_design_matrices, builders, data,
+                  n_jobs=2, backend="processes", return_type="sparse")
+    assert_raises(PatsyError, build_design_matrices, builders,
+                  {"x": data["x"], "a": data["a"][:-1], "b": data["b"]},
+                  n_jobs=2, backend="processes")
+    assert_raises(PatsyError, build_design_matrices, builders, data,
+                  backend="fibers")
+
+    if have_pandas:
+        df = pandas.DataFrame(data, index=np.arange(24) * 10)
+        for frame in [df, data]:
+            serial = build_design_matrices(builders, frame,
+                                           return_type="dataframe")
+            got = build_design_matrices(builders, frame, n_jobs=4,
+                                        backend="processes",
+                                        return_type="dataframe")
+            for s_df, p_df in zip(serial, got):
+                assert isinstance(p_df, pandas.DataFrame)
+                assert np.array_equal(s_df.index, p_df.index)
+                assert np.array_equal(s_df.columns, p_df.columns)
+                assert np.array_equal(s_df, p_df)
+
+def test_build_design_matrices_processes_inputs():
+    data = balanced(a=3, repeat=4)
+    data["y"] = np.arange(12.0)
+    def check(data, *termlists):
+        # EvalFactors, so that variables can come from the environment
+        terms = [Term([EvalFactor(code) for code in termlist])
+                 for termlist in termlists]
+        builders = design_matrix_builders([terms], lambda: iter([data]),
+                                          EvalEnvironment.capture(1))
+        serial = build_design_matrices(builders, data)
+        got = build_design_matrices(builders, data, n_jobs=3,
+                                    backend="processes")
+        for s_mat, p_mat in zip(serial, got):
+            assert p_mat.design_info is s_mat.design_info
+            assert np.array_equal(s_mat, p_mat)
+    check(data, ["y"], [], ["a"], ["a", "y"])
+    check(dict(data, a=tuple(data["a"]), y=tuple(data["y"])),
+          ["y"], [], ["a"], ["a", "y"])
+    # A variable that comes from the environment, rather than from the data,
+    # can't be split up, so the build isn't split up either
+    x = np.arange(12.0) ** 2
+    check(data, ["y"], [], ["x"], ["x", "a"])
+    check(data, ["np.log(x + 1)"], [], ["a"])
+    if have_pandas:
+        check(dict(data, a=pandas.Categorical(data["a"])),
+              ["y"], [], ["a"], ["a", "y"])
+        check(dict(data, y=pandas.Index(data["y"])),
+              ["y"], [], ["a"], ["a", "y"])
+        check(dict(data, y=pandas.Series(data["y"], index=np.arange(12) * 2)),
+              ["y"], [], ["a"], ["a", "y"])
+
+def test_build_design_matrices_float32():
+    data = balanced(a=3, repeat=2)
+    data["x"] = np.arange(6.0)
+    data["y"] = np.column_stack((np.arange(6.0), np.arange(6.0) ** 2))
+    def iter_maker():
+        yield data
+    builders = design_matrix_builders([make_termlist([], ["a"], ["x", "a"],
+                                                     ["x", "y"])],
+                                      iter_maker, 0)
+    wide, = build_design_matrices(builders, data)
+    narrow, = build_design_matrices(builders, data, dtype=np.float32)
+    assert wide.dtype == np.dtype(float)
+    assert narrow.dtype == np.dtype(np.float32)
+    assert np.allclose(wide, narrow)
+    narrow_F, = build_design_matrices(builders, data, dtype=np.float32,
+                                      order="F")
+    assert narrow_F.dtype == np.dtype(np.float32)
+    assert np.array_equal(narrow, narrow_F)
+
+def test_build_design_matrices_iter():
+    chunks = [{"x": [1, 2, np.nan], "a": ["a1", "a2", "a1"]},
+              {"x": [4, 5], "a": ["a2", None]},
+              {"x": [6.0], "a": ["a1"]}]
+    def iter_maker():
+        for chunk in chunks:
+            yield chunk
+    builders = design_matrix_builders([make_termlist("x"),
+                                       make_termlist([], "a")],
+                                      iter_maker, 0)
+    got = list(build_design_matrices_iter(builders, iter_maker()))
+    assert len(got) == 3
+    assert [len(mats) for mats in got] == [2, 2, 2]
+    for mats, chunk in zip(got, chunks):
+        expected = build_design_matrices(builders, chunk)
+        for mat, exp in zip(mats, expected):
+            assert isinstance(mat, DesignMatrix)
+            assert mat.design_info is exp.design_info
+            assert np.array_equal(mat, exp)
+    assert np.array_equal(np.vstack([mats[0] for mats in got]),
+                          [[1], [2], [4], [6]])
+    # NA_action is applied consistently to every chunk
+    it = build_design_matrices_iter(builders, iter_maker(),
+                                    NA_action="raise")
+    assert_raises(PatsyError, next, it)
+    assert_raises(PatsyError, list,
+                  build_design_matrices_iter(builders, iter_maker(),
+                                             return_type="asdf"))
+
+    if have_pandas:
+        # The default index continues from one chunk to the next, so it
+        # identifies rows in the full data set
+        got = list(build_design_matrices_iter(builders, iter_maker(),
+                                              return_type="dataframe"))
+        assert np.array_equal(got[0][0].index, [0, 1])
+        assert np.array_equal(got[1][0].index, [3])
+        assert np.array_equal(got[2][0].index, [5])
+        for mats in got:
+            assert isinstance(mats[1], pandas.DataFrame)
+            assert np.array_equal(mats[0].index, mats[1].index)
+        # But chunks that have indexes of their own keep them
+        df_chunks = [pandas.DataFrame(chunk, index=np.arange(len(chunk["x"]))
+                                      + 10 * i)
+                     for i, chunk in enumerate(chunks)]
+        got = list(build_design_matrices_iter(builders, df_chunks,
+                                              return_type="dataframe"))
+        assert np.array_equal(got[0][0].index, [0, 1])
+        assert np.array_equal(got[1][0].index, [10])
+        assert np.array_equal(got[2][0].index, [20])
+
+def test_build_design_matrices_NpySink():
+    import os
+    import shutil
+    import tempfile
+    from patsy.sink import NpySink, load_design_matrix, _memmap_backed
+    chunks = [{"x": [1, 2, np.nan], "a": ["a1", "a2", "a1"]},
+              {"x": [4, 5], "a": ["a2", "a1"]}]
+    def iter_maker():
+        for chunk in chunks:
+            yield chunk
+    x_di, a_di = design_matrix_builders([make_termlist("x"),
+                                         make_termlist([], "a")],
+                                        iter_maker, 0)
+    whole = {"x": [1, 2, np.nan, 4, 5], "a": ["a1", "a2", "a1", "a2", "a1"]}
+    x_mat, a_mat = build_design_matrices([x_di, a_di], whole)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        x_path = os.path.join(tmpdir, "x.npy")
+        a_path = os.path.join(tmpdir, "a.npy")
+        with NpySink(x_path, x_di) as x_sink:
+            with NpySink(a_path, a_di) as a_sink:
+                for x_chunk, a_chunk in build_design_matrices_iter(
+                        [x_di, a_di], iter_maker(), out=[x_sink, a_sink]):
+                    assert _memmap_backed(x_chunk)
+                    assert x_chunk.design_info is x_di
+        loaded = load_design_matrix(x_path, design_info=x_di)
+        assert loaded.design_info is x_di
+        assert np.array_equal(loaded, x_mat)
+        loaded = load_design_matrix(a_path)
+        assert loaded.design_info.column_names == a_di.column_names
+        assert np.array_equal(loaded, a_mat)
+        del loaded
+
+        # Sinks work with the one-shot API too, and are checked
+        with NpySink(x_path, x_di, dtype=np.float32) as x_sink:
+            assert_raises(PatsyError, build_design_matrices,
+                          [x_di], whole, out=[x_sink])
+            assert_raises(PatsyError, build_design_matrices,
+                          [a_di], whole, out=[x_sink], dtype=np.float32)
+            assert x_sink.num_rows == 0
+            build_design_matrices([x_di], whole, out=[x_sink],
+                                  dtype=np.float32)
+        assert np.array_equal(load_design_matrix(x_path), x_mat)
+    finally:
+        shutil.rmtree(tmpdir)
+
 def test_return_type():
     data = {"x": [1, 2, 3]}
     def iter_maker():
@@ -263,6 +582,60 @@ def test_return_type():
                   build_design_matrices, [builder], data,
                   return_type="asdfsadf")
 
+def test_return_type_sparse():
+    import scipy.sparse
+    data = balanced(a=3, b=2, repeat=2)
+    data["x"] = np.linspace(0, 1, len(data["a"]))
+    data["y"] = np.column_stack((data["x"] ** 2, -data["x"]))
+    def iter_maker():
+        yield data
+    for entries in [([], ["a"], ["a", "b"], ["x", "a"]),
+                    (["a"], ["y", "b"], ["a", "b", "x"]),
+                    ([],),
+                    ()]:
+        builders = design_matrix_builders([make_termlist(*entries),
+                                           make_termlist(["x"])],
+                                          iter_maker, 0)
+        dense, _ = build_design_matrices(builders, data)
+        sparse, _ = build_design_matrices(builders, data,
+                                          return_type="sparse")
+        assert scipy.sparse.isspmatrix_csc(sparse)
+        assert sparse.dtype == np.dtype(float)
+        assert sparse.design_info is builders[0]
+        assert sparse.shape == dense.shape
+        assert np.array_equal(sparse.toarray(), dense)
+
+    builder = design_matrix_builders([make_termlist(["a"])], iter_maker, 0)[0]
+    sparse, = build_design_matrices([builder], data, return_type="sparse",
+                                    dtype=np.float32)
+    assert sparse.dtype == np.dtype(np.float32)
+    # With no intercept, there is exactly one non-zero entry per row:
+    assert sparse.nnz == len(data["a"])
+
+    # NAs are dropped just like for dense matrices
+    x_a_builder = design_matrix_builders([make_termlist(["x", "a"])],
+                                         iter_maker, 0)[0]
+    sparse, = build_design_matrices([x_a_builder],
+                                    {"x": [1.0, np.nan, 3.0],
+                                     "a": ["a2", "a1", None]},
+                                    return_type="sparse")
+    assert np.array_equal(sparse.toarray(), [[0, 1, 0]])
+
+    int_builder = design_matrix_builders([make_termlist([])], iter_maker, 0)[0]
+    assert_raises(PatsyError, build_design_matrices,
+                  [int_builder], data, return_type="sparse")
+
+    import patsy.build
+    orig_import = patsy.build._import_scipy_sparse
+    def no_scipy():
+        raise PatsyError("no scipy")
+    try:
+        patsy.build._import_scipy_sparse = no_scipy
+        assert_raises(PatsyError, build_design_matrices,
+                      [builder], data, return_type="sparse")
+    finally:
+        patsy.build._import_scipy_sparse = orig_import
+
 def test_NA_action():
     initial_data = {"x": [1, 2, 3], "c": ["c1", "c2", "c1"]}
     def iter_maker():
@@ -308,6 +681,42 @@ def test_NA_action():
                                    dtype=object)},
                   NA_action="raise")
 
+def test_NA_action_rows():
+    # NAAction drops rows by telling the builder which rows to keep, but a
+    # subclass that overrides handle_NA has to be given the values to drop
+    # from. Either way we should get the same results, for every kind of
+    # output.
+    from patsy.missing import NAAction
+    class CopyingNAAction(NAAction):
+        def handle_NA(self, values, is_NAs, origins):
+            return NAAction.handle_NA(self, values, is_NAs, origins)
+    initial_data = {"x": [1, 2, 3], "c": ["c1", "c2", "c1"]}
+    def iter_maker():
+        yield initial_data
+    builder = design_matrix_builders([make_termlist("x", "c", ["x", "c"])],
+                                     iter_maker, 0)[0]
+    data = {"x": [10.0, np.nan, 20.0, 30.0],
+            "c": np.asarray(["c1", "c2", None, "c2"], dtype=object)}
+    assert builder.column_names == ["c[c1]", "c[c2]", "x", "x:c[T.c2]"]
+    expected = [[1.0, 0.0, 10.0, 0.0],
+                [0.0, 1.0, 30.0, 30.0]]
+    return_types = ["matrix", "sparse"]
+    if have_pandas:
+        return_types.append("dataframe")
+    for NA_action in [NAAction(), CopyingNAAction()]:
+        for return_type in return_types:
+            mat = build_design_matrices([builder], data,
+                                        NA_action=NA_action,
+                                        return_type=return_type)[0]
+            if return_type == "sparse":
+                mat = mat.toarray()
+            assert np.array_equal(np.asarray(mat), expected)
+            if return_type == "dataframe":
+                assert list(mat.index) == [0, 3]
+        chunks = list(build_design_matrices_iter([builder], [data, data],
+                                                 NA_action=NA_action))
+        assert np.array_equal(chunks[1][0], expected)
+
 def test_NA_drop_preserves_levels():
     # Even if all instances of some level are dropped, we still include it in
     # the output matrix (as an all-zeros column)
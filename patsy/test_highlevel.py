@@ -699,6 +699,238 @@ def test_dmatrix_NA_action():
                       dmatrices, "y ~ 1", data=data, return_type=return_type,
                       NA_action="raise")
 
+def test_eval_cache():
+    from patsy.cache import FactorEvalCache
+    data = {"y": np.arange(10.0), "x": np.arange(10.0) + 1,
+            "a": ["a1", "a2"] * 5}
+    calls = []
+    def f(x):
+        calls.append(x)
+        return np.log(x)
+    formulas = ["y ~ f(x)", "y ~ f(x) + C(a)", "y ~ f(x):a + center(x)",
+                "y ~ f(x) + center(x) + C(a)"]
+    # Not a list comprehension: on py3 that would be a separate frame, which
+    # couldn't see f
+    expected = []
+    for formula in formulas:
+        expected.append(dmatrices(formula, data))
+    uncached_calls = len(calls)
+    del calls[:]
+    cache = FactorEvalCache()
+    for formula, (exp_y, exp_X) in zip(formulas, expected):
+        y, X = dmatrices(formula, data, eval_cache=cache)
+        assert np.array_equal(y, exp_y)
+        assert np.array_equal(X, exp_X)
+        assert X.design_info.column_names == exp_X.design_info.column_names
+    # f(x) only had to be evaluated once, even though every formula (and
+    # every call) memorized its own state for it
+    assert uncached_calls > 1
+    assert len(calls) == 1
+    # Same again for dmatrix and the dataframe return type
+    X = dmatrix("f(x) + C(a)", data, eval_cache=cache,
+                return_type="dataframe")
+    assert np.array_equal(X, expected[1][1])
+    # Different data gives different results
+    data2 = dict(data, x=np.arange(10.0) + 2)
+    X = dmatrix("f(x)", data2, eval_cache=cache)
+    assert np.allclose(X[:, 1], np.log(data2["x"]))
+    # NA handling is respected
+    data3 = dict(data, x=np.arange(10.0) - 1)
+    assert dmatrix("np.log(x)", data3, eval_cache=cache).shape[0] == 9
+    try:
+        dmatrix("np.log(x)", data3, NA_action="raise", eval_cache=cache)
+    except PatsyError:
+        pass
+    else:
+        assert False
+
+def test_dmatrix_order():
+    data = {"x": [1, 2, 3], "a": ["a1", "a2", "a1"]}
+    mat = dmatrix("x + a", data, order="F")
+    assert mat.flags.f_contiguous
+    assert np.array_equal(mat, dmatrix("x + a", data))
+    lmat, rmat = dmatrices("x ~ a", data, order="F")
+    assert lmat.flags.f_contiguous
+    assert rmat.flags.f_contiguous
+    # Explicit matrices get converted
+    mat = dmatrix(np.arange(6.0).reshape((3, 2)), order="F")
+    assert mat.flags.f_contiguous
+    assert np.array_equal(mat, [[0, 1], [2, 3], [4, 5]])
+    assert_raises(PatsyError, dmatrix, "x", data, order="Q")
+
+def test_return_sparse():
+    import scipy.sparse
+    data = {"x": [1, 2, 3, np.nan], "a": ["a1", "a2", "a3", "a1"]}
+    mat = dmatrix("x + a", data, return_type="sparse")
+    assert scipy.sparse.isspmatrix_csc(mat)
+    assert mat.design_info.column_names == ["Intercept", "a[T.a2]",
+                                            "a[T.a3]", "x"]
+    assert np.array_equal(mat.toarray(), [[1, 0, 0, 1],
+                                          [1, 1, 0, 2],
+                                          [1, 0, 1, 3]])
+
+    lmat, rmat = dmatrices("x ~ 0 + a", data, return_type="sparse")
+    assert lmat.design_info.column_names == ["x"]
+    assert np.array_equal(lmat.toarray(), [[1], [2], [3]])
+    assert np.array_equal(rmat.toarray(), np.eye(3))
+
+    # Explicit matrices are converted too
+    mat = dmatrix([[1, 0], [0, 2]], return_type="sparse")
+    assert scipy.sparse.isspmatrix_csc(mat)
+    assert mat.design_info.column_names == ["x0", "x1"]
+    assert np.array_equal(mat.toarray(), [[1, 0], [0, 2]])
+
+def test_hashed_categorical():
+    import scipy.sparse
+    from patsy.categorical import _hash_bucket
+    data = {"x": [1, 2, 3, 4], "u": ["u1", "u2", None, "u1"]}
+    buckets = [_hash_bucket(u, 16) for u in ["u1", "u2", "u1"]]
+    mat = dmatrix("H(u, n_buckets=16)", data, return_type="sparse")
+    assert scipy.sparse.isspmatrix_csc(mat)
+    assert mat.shape == (3, 17)
+    assert mat.nnz == 6
+    assert mat.design_info.column_names == (
+        ["Intercept"] + ["H(u, n_buckets=16)[%s]" % (i,) for i in range(16)])
+    expected = np.zeros((3, 17))
+    expected[:, 0] = 1
+    expected[np.arange(3), np.asarray(buckets) + 1] = 1
+    assert np.array_equal(mat.toarray(), expected)
+    # Dense output gives the same thing
+    assert np.array_equal(dmatrix("H(u, n_buckets=16)", data), expected)
+    # And so does new data that was never seen while building the design
+    new_data = {"u": ["u1", "never seen before"]}
+    new_mat = build_design_matrices([mat.design_info], new_data,
+                                    return_type="sparse")[0]
+    assert new_mat.shape == (2, 17)
+    assert np.array_equal(new_mat.toarray()[0, :], expected[0, :])
+    assert new_mat[1, _hash_bucket("never seen before", 16) + 1] == 1
+    # Interactions
+    mat = dmatrix("0 + x:H(u, n_buckets=16)", data, return_type="sparse")
+    assert np.array_equal(mat.toarray(), expected[:, 1:] * [[1], [2], [4]])
+    # The factor knows its levels are hashed, so coding new data never has
+    # to look at all of them
+    fi, = [fi for fi in six.itervalues(new_mat.design_info.factor_infos)]
+    assert fi.categories.n_buckets == 16
+    assert fi._category_to_int is None
+    from patsy.design_info import FactorInfo
+    other_fi = FactorInfo(fi.factor, "categorical", fi.state,
+                          categories=fi.categories)
+    assert other_fi.categories is fi.categories
+
+def test_lump():
+    data = {"a": ["a1", "a2", "a1", "a3", "a2", "a1"]}
+    mat = dmatrix("lump(a, min_count=2)", data)
+    assert mat.design_info.column_names == [
+        "Intercept",
+        "lump(a, min_count=2)[T.a2]",
+        "lump(a, min_count=2)[T.other]"]
+    assert np.array_equal(mat, [[1, 0, 0],
+                                [1, 1, 0],
+                                [1, 0, 0],
+                                [1, 0, 1],
+                                [1, 1, 0],
+                                [1, 0, 0]])
+    # Unseen values are lumped too
+    new_mat = build_design_matrices([mat.design_info],
+                                    {"a": ["a4", "a2", "a3"]})[0]
+    assert np.array_equal(new_mat, [[1, 0, 1], [1, 1, 0], [1, 0, 1]])
+    # Works with C()
+    mat = dmatrix("C(lump(a, top_k=1), Sum)", data)
+    assert mat.design_info.column_names == [
+        "Intercept", "C(lump(a, top_k=1), Sum)[S.a1]"]
+    assert np.array_equal(mat[:, 1], [1, -1, 1, -1, -1, 1])
+
+def test_shared_subexpressions():
+    calls = []
+    class LogCounted(np.ndarray):
+        # Records each time np.log is applied to one of these
+        def __array_wrap__(self, out_arr, context=None, *args):
+            if context is not None and context[0] is np.log:
+                calls.append(context)
+            return np.ndarray.__array_wrap__(self, out_arr, context, *args)
+    data = {"x": np.array([1.0, 2.0, 3.0]).view(LogCounted),
+            "y": np.array([4.0, 5.0, 6.0]).view(LogCounted)}
+    y, X = dmatrices("np.log(y) ~ np.log(x) + I(np.log(x) ** 2)", data)
+    # Once to check the factor types, and once to build the matrices, but
+    # never separately for each factor
+    assert len(calls) == 2 * 2
+    assert np.allclose(X, np.column_stack(([1, 1, 1],
+                                           np.log(data["x"]),
+                                           np.log(data["x"]) ** 2)))
+    assert np.allclose(y, np.log(data["y"])[:, np.newaxis])
+    # ufuncs made from Python functions might have side-effects, so they're
+    # called separately for each factor
+    py_calls = []
+    def counting_log(x):
+        py_calls.append(x)
+        return np.log(x)
+    log = np.frompyfunc(counting_log, 1, 1)
+    data = {"x": [1.0, 2.0, 3.0]}
+    dmatrix("I(log(x).astype(float)) + I(log(x).astype(float) ** 2)", data)
+    assert len(py_calls) == 2 * 3 * 2
+    # Functions that modify their argument in place never see a shared
+    # value, so they can't corrupt other factors
+    def scale_(v):
+        v *= 10
+        return v
+    x = np.array([1.0, 2.0, 3.0])
+    mat = dmatrix("0 + np.exp(x) + scale_(np.exp(x))", {"x": x})
+    assert np.allclose(mat, np.column_stack((np.exp(x), 10 * np.exp(x))))
+    mat = dmatrix("0 + scale_(np.exp(x)) + np.exp(x)", {"x": x})
+    assert np.allclose(mat, np.column_stack((10 * np.exp(x), np.exp(x))))
+
+def test_structured_contrasts_not_densified():
+    data = {"a": ["a%s" % (i % 5,) for i in range(20)],
+            "b": ["b%s" % (i % 3,) for i in range(20)]}
+    for contrast in ["Sum", "Helmert", "Diff"]:
+        formula = "C(a, %s) + C(a, %s):C(b, Sum)" % (contrast, contrast)
+        dense = dmatrix(formula, data)
+        sparse = dmatrix(formula, data, return_type="sparse")
+        assert np.array_equal(sparse.toarray(), dense)
+        # Neither build needed the level-by-column contrast matrices
+        for subterms in six.itervalues(dense.design_info.term_codings):
+            for subterm in subterms:
+                for cm in six.itervalues(subterm.contrast_matrices):
+                    assert cm._structured()
+
+def test_C_levels_of_different_types():
+    # True == 1 and 1.0 == 1, but the column names have to come out right
+    # even when the levels were coded before with a different type
+    data = {"a": [False, True], "b": [0, 1], "c": [1.0, 2.0], "e": [1, 2]}
+    assert (dmatrix("C(a)", data).design_info.column_names
+            == ["Intercept", "C(a)[T.True]"])
+    assert (dmatrix("C(b)", data).design_info.column_names
+            == ["Intercept", "C(b)[T.1]"])
+    assert (dmatrix("C(c)", data).design_info.column_names
+            == ["Intercept", "C(c)[T.2.0]"])
+    assert (dmatrix("C(e)", data).design_info.column_names
+            == ["Intercept", "C(e)[T.2]"])
+
+def test_incr_dbuilder_data_sweeps():
+    chunks = [{"x": [1.0, 2.0], "a": ["a1", "a2"]},
+              {"x": [3.0, 4.0], "a": ["a2", "a3"]}]
+    reads = []
+    def data_iter_maker():
+        reads.append(0)
+        for chunk in chunks:
+            reads[-1] += 1
+            yield chunk
+    # Without stateful transforms, one sweep is enough
+    incr_dbuilder("x + a", data_iter_maker)
+    assert reads == [2]
+    # The categorical factor is examined while center() is memorizing, so
+    # the final sweep only has to look at a single chunk to see that
+    # center(x) is numerical
+    del reads[:]
+    builder = incr_dbuilder("center(x) + a", data_iter_maker)
+    assert reads == [2, 1]
+    assert builder.column_names == ["Intercept", "a[T.a2]", "a[T.a3]",
+                                    "center(x)"]
+    # Nested transforms need one sweep per level of nesting
+    del reads[:]
+    incr_dbuilder("center(center(x)) + a", data_iter_maker)
+    assert reads == [2, 2, 1]
+
 def test_0d_data():
     # Use case from statsmodels/statsmodels#1881
     data_0d = {"x1": 1.1, "x2": 1.2, "a": "a1"}
@@ -4,7 +4,7 @@
 
 from __future__ import print_function
 import numpy as np
-from patsy.state import Center, Standardize, center
+from patsy.state import Center, Standardize, center, Lump
 from patsy.util import atleast_2d_column_default
 
 def check_stateful(cls, accepts_multicolumn, input, output, *args, **kwargs):
@@ -156,8 +156,15 @@ def test_Standardize():
                    [12.0, 11.0, 10.0],
                    [np.sqrt(3./2), 0, -np.sqrt(3./2)])
 
-    # XX: see the comment in Standardize.transform about why this doesn't
-    # work:
+    # Floating point precision is preserved
+    s = Standardize()
+    s.memorize_chunk(np.array([12.0, 11.0, 10.0], dtype=np.float32))
+    s.memorize_finish()
+    got = s.transform(np.array([12.0, 11.0, 10.0], dtype=np.float32))
+    assert got.dtype == np.dtype(np.float32)
+    assert np.allclose(got, [np.sqrt(3./2), 0, -np.sqrt(3./2)])
+
+    # XX: complex input is still converted to real, so this doesn't work:
     # check_stateful(Standardize,
     #               [12.0+0j, 11.0+0j, 10.0],
     #               [np.sqrt(3./2)+0j, 0, -np.sqrt(3./2)])
@@ -187,3 +194,71 @@ def test_Standardize():
                    r20,
                    r20,
                    center=False, rescale=False, ddof=1)
+
+def test_Lump():
+    from nose.tools import assert_raises
+    from patsy.categorical import _CategoricalBox
+    from patsy.util import have_pandas
+    from patsy import PatsyError
+    def t(chunks, kwargs, exp_levels, exp_values, new_data=None):
+        t = Lump()
+        for chunk in chunks:
+            t.memorize_chunk(chunk, **kwargs)
+        t.memorize_finish()
+        box = t.transform(new_data if new_data is not None else chunks[0],
+                          **kwargs)
+        assert isinstance(box, _CategoricalBox)
+        assert tuple(box.levels) == exp_levels
+        assert list(box.data) == exp_values
+    data = ["a", "b", "a", "c", "a", "b", "d"]
+    for prep in [list, np.asarray, lambda x: np.asarray(x, dtype=object)]:
+        t([prep(data)], {"min_count": 2},
+          ("a", "b", "other"), ["a", "b", "a", "other", "a", "b", "other"])
+        t([prep(data)], {"top_k": 1},
+          ("a", "other"),
+          ["a", "other", "a", "other", "a", "other", "other"])
+        # Counts accumulate across chunks
+        t([prep(data[:3]), prep(data[3:])], {"min_count": 3, "other": "z"},
+          ("a", "z"), ["a", "z", "a"])
+    # Ties are broken by level order
+    t([["b", "a", "c"]], {"top_k": 2}, ("a", "b", "other"),
+      ["b", "a", "other"])
+    # Nothing lumped means no extra level, and new values are left alone
+    t([data], {}, ("a", "b", "c", "d"), data)
+    t([data], {}, ("a", "b", "c", "d"), ["e"], new_data=["e"])
+    # New values go into 'other'
+    t([data], {"min_count": 2}, ("a", "b", "other"), ["other", "a"],
+      new_data=["e", "a"])
+    # Missing values are left alone, and aren't levels
+    t([["a", None, np.nan, "a", "b"]], {"min_count": 2}, ("a", "other"),
+      ["a", None, "other"], new_data=["a", None, "b"])
+    t([[1.0, np.nan, 1.0, 2.0]], {"min_count": 2}, (1.0, "other"),
+      [1.0, "other"], new_data=[1.0, 2.0])
+    # Tuples are fine
+    t([[("a", 1), ("a", 1), ("b", 2)]], {"min_count": 2},
+      (("a", 1), "other"), [("a", 1), ("a", 1), "other"])
+    # Contrasts are passed through
+    from patsy.categorical import C
+    t = Lump()
+    t.memorize_chunk(C(["a", "b", "a"], "CONTRAST"), min_count=2)
+    t.memorize_finish()
+    box = t.transform(C(["a", "b"], "CONTRAST"), min_count=2)
+    assert box.contrast == "CONTRAST"
+    assert list(box.data) == ["a", "other"]
+    if have_pandas:
+        import pandas
+        t = Lump()
+        s = pandas.Series(["a", "b", "a"], index=[10, 20, 30])
+        t.memorize_chunk(s, min_count=2)
+        t.memorize_finish()
+        box = t.transform(s, min_count=2)
+        assert isinstance(box.data, pandas.Series)
+        assert list(box.data.index) == [10, 20, 30]
+        assert list(box.data) == ["a", "other", "a"]
+    # Errors
+    t = Lump()
+    assert_raises(PatsyError, t.memorize_chunk, [[1], [2]], min_count=2)
+    assert_raises(PatsyError, t.memorize_chunk, ["a"], top_k=0)
+    t = Lump()
+    t.memorize_chunk(["other", "other", "a"], min_count=2)
+    assert_raises(PatsyError, t.memorize_finish)
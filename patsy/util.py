@@ -6,6 +6,7 @@
 
 __all__ = ["atleast_2d_column_default", "uniqueify_list",
            "widest_float", "widest_complex", "wide_dtype_for", "widen",
+           "float_dtype_for",
            "repr_pretty_delegate", "repr_pretty_impl",
            "SortAnythingKey", "safe_scalar_isnan", "safe_isnan",
            "iterable",
@@ -27,7 +28,7 @@ import sys
 import numpy as np
 import six
 from six.moves import cStringIO as StringIO
-from .compat import optional_dep_ok
+from .compat import optional_dep_ok, OrderedDict
 
 try:
     import pandas
@@ -302,6 +303,25 @@ def test_wide_dtype_for_and_widen():
     from nose.tools import assert_raises
     assert_raises(ValueError, widen, ["hi"])
 
+# The dtype to use for floating point results computed from 'arr': floating
+# point inputs keep their precision (so e.g. float32 data stays float32), and
+# everything else gets converted to float64.
+def float_dtype_for(arr):
+    dtype = np.asarray(arr).dtype
+    if safe_issubdtype(dtype, np.floating):
+        return dtype
+    return np.dtype(float)
+
+def test_float_dtype_for():
+    assert float_dtype_for([1, 2, 3]) == np.dtype(float)
+    assert float_dtype_for([True]) == np.dtype(float)
+    assert float_dtype_for(np.zeros(3, dtype=np.float32)) == np.float32
+    assert float_dtype_for(np.zeros(3, dtype=np.float64)) == np.float64
+    assert float_dtype_for(widen([1.0])) == widest_float
+    if have_pandas:
+        s = pandas.Series([1, 2], dtype=np.float32)
+        assert float_dtype_for(s) == np.float32
+
 class PushbackAdapter(object):
     def __init__(self, it):
         self._it = it
@@ -353,6 +373,81 @@ def test_PushbackAdapter():
     assert list(it) == [20, 10, 3, 4]
     assert not it.has_more()
 
+# A mapping that holds at most 'max_size' worth of values, discarding the
+# least recently used entries to make room for new ones. Each value's size is
+# given when it's stored (by default every value has size 1, so 'max_size' is
+# just the number of entries). Values that are bigger than 'max_size' on
+# their own are never stored. Safe to use from multiple threads.
+class LRUCache(object):
+    def __init__(self, max_size):
+        import threading
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                return default
+            # Re-inserting moves it to the most-recently-used end
+            self._entries[key] = (value, size)
+            return value
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            while self._entries and self.size + size > self.max_size:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+            self._entries[key] = (value, size)
+            self.size += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+def test_LRUCache():
+    cache = LRUCache(3)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("c", 3)
+    assert len(cache) == 3
+    assert cache.get("a") == 1
+    # "b" is now the least recently used
+    cache.put("d", 4)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("b", "default") == "default"
+    assert [cache.get(k) for k in "acd"] == [1, 3, 4]
+    # Sized entries
+    cache.put("e", 5, size=2)
+    assert len(cache) == 2
+    assert cache.size == 3
+    assert "a" not in cache and "c" not in cache
+    cache.put("e", 50, size=1)
+    assert cache.size == 2
+    assert cache.get("e") == 50
+    # Too big to store at all
+    cache.put("f", 6, size=4)
+    assert "f" not in cache
+    assert cache.size == 2
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+
 # The IPython pretty-printer gives very nice output that is difficult to get
 # otherwise, e.g., look how much more readable this is than if it were all
 # smooshed onto one line: